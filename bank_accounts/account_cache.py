@@ -0,0 +1,140 @@
+# Account cache
+# The list of Accounts a User holds is read by the account list, account detail and transfer views on nearly every
+# request. It is cached per holder with Django's cache framework: local memory by default, or any backend named by the
+# BANK_ACCOUNTS_CACHE setting (e.g. a shared Redis or Memcached cache when running several processes).
+
+# Entries are deleted whenever one of the holder's Accounts changes: on Account save and delete (see signals), and when
+# a transfer commits, since transfers change balances with UPDATE queries that send no signals. Deletes happen both
+# right away and again when the transaction commits, so a request reading in between cannot cache stale balances.
+# Accounts read from a replica, which may lag behind, are not cached. Once the transaction commits, the holders' event
+# streams are woken up too (see bank_accounts.events).
+
+# Only the Accounts' field values are cached, never model instances: the cache may be shared, and an Account's holder
+# would bring the User's password hash along. Accounts are rebuilt from the values on every read, with the User they
+# were requested for as their holder.
+
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Sum, OuterRef, Subquery
+
+from .models import Account, BalanceSlot
+from . import routers, events
+
+CACHE_ALIAS = getattr(settings, 'BANK_ACCOUNTS_CACHE', 'default')
+TIMEOUT = getattr(settings, 'BANK_ACCOUNTS_CACHE_TIMEOUT', 5 * 60)
+
+_FIELDS = [field.attname for field in Account._meta.concrete_fields]  # Values cached of each Account
+
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}  # Counted per process
+_stats_lock = threading.Lock()
+
+
+def holder_accounts(user):
+    """
+    :param user:
+    :return: list of the Accounts a User holds, with their holder and slot balances loaded
+    """
+    cache = caches[CACHE_ALIAS]
+    key = _key(user.pk)
+
+    cached = cache.get(key)
+    if cached is not None:
+        _count('hits')
+        return _load(user, cached)
+
+    _count('misses')
+    queryset = _accounts(user)
+    cached = queryset.db, list(queryset)
+    if not routers.reading_replica():
+        cache.set(key, cached, TIMEOUT)
+    return _load(user, cached)
+
+
+async def aholder_accounts(user):
+    """
+    Like holder_accounts, for async views.
+    :param user:
+    :return: list of the Accounts a User holds, with their holder and slot balances loaded
+    """
+    cache = caches[CACHE_ALIAS]
+    key = _key(user.pk)
+
+    cached = await cache.aget(key)
+    if cached is not None:
+        _count('hits')
+        return _load(user, cached)
+
+    _count('misses')
+    queryset = _accounts(user)
+    cached = queryset.db, [row async for row in queryset]
+    if not routers.reading_replica():
+        await cache.aset(key, cached, TIMEOUT)
+    return _load(user, cached)
+
+
+def invalidate(*holder_pks):
+    """
+    Forgets the cached Accounts of holders, now and when the current transaction commits, and then wakes their event
+    streams.
+    :param holder_pks: primary keys of Users. None is ignored.
+    :return:
+    """
+    holder_pks = {pk for pk in holder_pks if pk is not None}
+    if not holder_pks:
+        return
+
+    keys = [_key(pk) for pk in holder_pks]
+    cache = caches[CACHE_ALIAS]
+    cache.delete_many(keys)
+    _count('invalidations')
+
+    def committed():
+        cache.delete_many(keys)
+        events.hub.publish(*holder_pks)
+    transaction.on_commit(committed, using=routers.primary())
+
+
+def stats():
+    """
+    :return: dict of this process's cache hits, misses and invalidations
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _accounts(user):
+    """
+    :return: queryset of the field values and slot balance of each Account a User holds, as tuples
+    """
+    slot_balance = BalanceSlot.objects.filter(account=OuterRef('pk')).order_by().values('account')\
+        .annotate(total=Sum('balance')).values('total')
+    return Account.objects.filter(holder=user).annotate(slot_balance=Subquery(slot_balance)).order_by('pk')\
+        .values_list(*_FIELDS, 'slot_balance')
+
+
+def _load(user, cached):
+    """
+    :param user: holder of the Accounts
+    :param cached: (alias of the database the Accounts were read from, list of tuples from _accounts)
+    :return: list of the Accounts
+    """
+    alias, rows = cached
+    accounts = []
+    for row in rows:
+        account = Account.from_db(alias, _FIELDS, row[:-1])
+        account.slot_balance = row[-1]
+        account.holder = user
+        accounts.append(account)
+    return accounts
+
+
+def _key(holder_pk):
+    return 'bank_accounts:holder_accounts:%d' % holder_pk
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
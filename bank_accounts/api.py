@@ -0,0 +1,291 @@
+# JSON API
+# A versioned JSON API over a User's Accounts, transfer history and transfers, for mobile and partner clients that
+# would otherwise download whole HTML pages. Version 1 lives under api/v1/. A change that breaks clients goes into a
+# new version, and v1 keeps answering as it does.
+
+# GET responses carry a strong ETag: a hash of the exact bytes of the body. History pages also carry a Last-Modified,
+# the date of their newest transfer. A client sending the ETag back in If-None-Match gets a 304 Not Modified without a
+# body when nothing changed. The rows are still read, but nothing is rendered or sent. If-Modified-Since is answered
+# too, but only notices new transfers, so clients should prefer the ETag.
+
+# Bodies are compact JSON, without whitespace. The "fields" GET parameter selects the fields of each object, e.g.
+# ?fields=id,balance. History is paged like the HTML lists (see bank_accounts.pagination): "next" holds the cursor of
+# the next page, passed back as the "cursor" GET parameter, and "page_size" picks the number of transfers per page.
+
+# Transfers are POSTed as JSON objects, with the session's CSRF token in the X-CSRFToken header. Like the HTML forms,
+# they honour the Idempotency-Key header (see bank_accounts.idempotency). Errors are answered as {"error": message}.
+
+import functools
+import hashlib
+import json
+
+from django.db.models import Q
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .models import InternalTransferReceipt, ExternalTransferReceipt, ArchivedInternalTransferReceipt, \
+    ArchivedExternalTransferReceipt, IdempotencyKey
+from .forms import InternalTransferApiForm, ExternalTransferForm
+from .exceptions import TransferError, ConcurrentUpdate
+from . import transfers, idempotency, account_cache, payees, pagination, batch
+
+ACCOUNT_FIELDS = ['id', 'type', 'balance', 'bank', 'routing_number']
+INTERNAL_TRANSFER_FIELDS = ['id', 'date', 'amount', 'from_account', 'to_account']
+PAYMENT_FIELDS = ['id', 'date', 'amount', 'direction', 'payer', 'payee', 'from_account', 'to_account', 'comment']
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class BadRequest(Exception):
+    pass  # Request can't be answered as given. The message is sent back to the client.
+
+
+def api_view(*methods):
+    """
+    Decorator for API views: answers clients that aren't logged in with 401 instead of a redirect to the login page,
+    methods other than those listed with 405, and BadRequest with 400.
+    :param methods: HTTP methods the view handles
+    :return:
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not request.user.is_authenticated:
+                return error_response('Authentication required.', 401)
+            if request.method not in methods:
+                response = error_response('Method not allowed.', 405)
+                response['Allow'] = ', '.join(methods)
+                return response
+            try:
+                return view(request, *args, **kwargs)
+            except BadRequest as error:
+                return error_response(str(error), 400)
+        return wrapper
+    return decorator
+
+
+def accounts(request):
+    """
+    :param request:
+    :return: JSON response listing the User's Accounts
+    """
+    fields = _fields(request, ACCOUNT_FIELDS)
+    return json_response(request, {'accounts': [_select(_account(account), fields)
+                                                for account in account_cache.holder_accounts(request.user)]})
+
+
+def account(request, pk):
+    """
+    :param request:
+    :param pk:
+    :return: JSON response with one of the User's Accounts, or 404 if the User holds no such Account
+    """
+    fields = _fields(request, ACCOUNT_FIELDS)
+    for held_account in account_cache.holder_accounts(request.user):
+        if held_account.pk == pk:
+            return json_response(request, _select(_account(held_account), fields))
+    return error_response('Account not found.', 404)
+
+
+def internal_transfers(request):
+    """
+    :param request:
+    :return: JSON response with a page of the User's internal transfers, newest first
+    """
+    fields = _fields(request, INTERNAL_TRANSFER_FIELDS)
+    page = pagination.paginate(
+        InternalTransferReceipt.objects.filter(user=request.user).select_related('from_account', 'to_account'),
+        request.GET.get('cursor'), _page_size(request),
+        ArchivedInternalTransferReceipt.objects.filter(user=request.user).select_related('from_account', 'to_account'))
+    return _page_response(request, page, [_select(_internal_transfer(receipt), fields)
+                                          for receipt in page.object_list])
+
+
+def payments(request):
+    """
+    :param request:
+    :return: JSON response with a page of the payments the User sent or received, newest first
+    """
+    fields = _fields(request, PAYMENT_FIELDS)
+    sides = (Q(payer=request.user), Q(payee=request.user))  # Each read through its own index, see pagination
+    related = ('payer', 'payee', 'from_account', 'to_account')
+    page = pagination.paginate(
+        [ExternalTransferReceipt.objects.filter(side).select_related(*related) for side in sides],
+        request.GET.get('cursor'), _page_size(request),
+        [ArchivedExternalTransferReceipt.objects.filter(side).select_related(*related) for side in sides])
+    return _page_response(request, page, [_select(_payment(receipt, request.user), fields)
+                                          for receipt in page.object_list])
+
+
+def make_internal_transfer(request):
+    """
+    Moves funds between two of the User's Accounts. The body is a JSON object with from_account, to_account and amount.
+    :param request:
+    :return: JSON response with the transfer, 201 if made now or 200 if an earlier request with the same idempotency
+    key made it
+    """
+    form = InternalTransferApiForm(_body(request))
+    if not form.is_valid():
+        raise BadRequest('Invalid transfer: ' + ', '.join(form.errors))
+    data = form.cleaned_data
+    receipt_id, replayed = _run(request, IdempotencyKey.INTERNAL_TRANSFER, lambda: transfers.internal_transfer(
+        request.user, data['from_account'], data['to_account'], data['amount']))
+    receipt = InternalTransferReceipt.objects.select_related('from_account', 'to_account').get(pk=receipt_id)
+    return json_response(request, _internal_transfer(receipt), status=200 if replayed else 201)
+
+
+def make_payment(request):
+    """
+    Pays another User. The body is a JSON object with from_account, payee (primary key) or payee_username, amount and
+    optionally comment.
+    :param request:
+    :return: JSON response with the payment, 201 if made now or 200 if an earlier request with the same idempotency
+    key made it
+    """
+    form = ExternalTransferForm(_body(request))
+    if not form.is_valid():
+        raise BadRequest('Invalid payment: ' + ', '.join(form.errors))
+    data = form.cleaned_data
+    payee = data['payee'] if data['payee'] is not None else payees.payee_pk(data['payee_username'])
+    if payee is None:
+        raise BadRequest('The user you are making the payment to does not exist.')
+    receipt_id, replayed = _run(request, IdempotencyKey.EXTERNAL_TRANSFER, lambda: transfers.external_transfer(
+        request.user, data['from_account'], payee, data['amount'], data['comment']))
+    receipt = ExternalTransferReceipt.objects.select_related('payer', 'payee', 'from_account', 'to_account')\
+        .get(pk=receipt_id)
+    return json_response(request, _payment(receipt, request.user), status=200 if replayed else 201)
+
+
+def json_response(request, data, last_modified=None, status=200):
+    """
+    Answers with compact JSON and its strong ETag, or 304 Not Modified if the client already has it.
+    :param request:
+    :param data: object to serialize
+    :param last_modified: aware datetime the data last changed, or None if unknown
+    :param status: status code when the data is sent
+    :return:
+    """
+    body = json.dumps(data, separators=(',', ':')).encode()
+    etag = '"%s"' % hashlib.sha1(body).hexdigest()
+    timestamp = int(last_modified.timestamp()) if last_modified is not None else None
+
+    response = None
+    if status == 200:
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = HttpResponse(body, content_type='application/json', status=status)
+    response['ETag'] = etag
+    if timestamp is not None:
+        response['Last-Modified'] = http_date(timestamp)
+    response['Cache-Control'] = 'private, no-cache'  # Clients may keep it, but must revalidate
+    return response
+
+
+def error_response(message, status):
+    return HttpResponse(json.dumps({'error': message}, separators=(',', ':')), content_type='application/json',
+                        status=status)
+
+
+def _run(request, kind, transfer):
+    """
+    Runs a transfer once per idempotency key.
+    :return: (receipt id, True if an earlier request made the transfer)
+    :raise BadRequest: if the transfer is refused
+    """
+    try:
+        return idempotency.run_once(request.user, kind, idempotency.request_key(request), transfer)
+    except TransferError as error:
+        raise BadRequest(batch.ERROR_MESSAGES[type(error)])
+    except ConcurrentUpdate:
+        raise BadRequest('Accounts are busy. Please try again.')
+
+
+def _body(request):
+    """
+    :return: the JSON object a request carries
+    :raise BadRequest: if it carries something else
+    """
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except ValueError:  # Includes malformed JSON and bad encodings
+        raise BadRequest('Body must be a JSON object.')
+    if not isinstance(data, dict):
+        raise BadRequest('Body must be a JSON object.')
+    return data
+
+
+def _fields(request, available):
+    """
+    :param request:
+    :param available: names of every field, in the order they are sent
+    :return: names of the fields the "fields" GET parameter asks for, all of them if it's missing
+    :raise BadRequest: if it names an unknown field
+    """
+    wanted = request.GET.get('fields')
+    if not wanted:
+        return available
+    wanted = set(wanted.split(','))
+    unknown = wanted.difference(available)
+    if unknown:
+        raise BadRequest('Unknown fields: ' + ', '.join(sorted(unknown)))
+    return [field for field in available if field in wanted]
+
+
+def _page_size(request):
+    try:
+        page_size = int(request.GET.get('page_size', PAGE_SIZE))
+    except ValueError:
+        raise BadRequest('page_size must be a number.')
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise BadRequest('page_size must be between 1 and %d.' % MAX_PAGE_SIZE)
+    return page_size
+
+
+def _page_response(request, page, results):
+    last_modified = page.object_list[0].date if page.object_list else None  # Newest first
+    return json_response(request, {'results': results, 'next': page.next_cursor}, last_modified)
+
+
+def _select(data, fields):
+    return {field: data[field] for field in fields}
+
+
+def _account(account):
+    return {
+        'id': account.pk,
+        'type': account.account_type,
+        'balance': account.total_balance,
+        'bank': account.bank,
+        'routing_number': account.routing_number,
+    }
+
+
+def _internal_transfer(receipt):
+    # Related objects are None once deleted, also for archived receipts, which keep the deleted primary keys
+    return {
+        'id': receipt.pk,
+        'date': receipt.date.isoformat(),
+        'amount': receipt.amount,
+        'from_account': _pk(receipt.from_account),
+        'to_account': _pk(receipt.to_account),
+    }
+
+
+def _payment(receipt, user):
+    return {
+        'id': receipt.pk,
+        'date': receipt.date.isoformat(),
+        'amount': receipt.amount,
+        'direction': 'sent' if receipt.payer_id == user.pk else 'received',
+        'payer': receipt.payer.username if receipt.payer else None,
+        'payee': receipt.payee.username if receipt.payee else None,
+        'from_account': _pk(receipt.from_account),
+        'to_account': _pk(receipt.to_account),
+        'comment': receipt.comment,
+    }
+
+
+def _pk(instance):
+    return instance.pk if instance is not None else None
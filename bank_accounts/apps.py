@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class AccountsConfig(AppConfig):
     name = 'bank_accounts'
+
+    def ready(self):
+        from . import signals  # Connects signal receivers
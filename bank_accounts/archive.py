@@ -0,0 +1,94 @@
+# Receipt archive
+# Receipts are only ever added, so their tables and indexes would grow forever, and with them the cost of every
+# receipt list, export and rollup rebuild. The archive_receipts command moves receipts older than
+# BANK_ACCOUNTS_ARCHIVE_AFTER days into archive tables (ArchivedInternalTransferReceipt and
+# ArchivedExternalTransferReceipt), so the hot tables only hold that many days of history. The archive tables keep only
+# the indexes paging needs, and keep each receipt's id, so ledger entries still point to it.
+
+# Receipts are dated when made, and archiving moves every receipt older than the horizon, so archived receipts are all
+# older than those still in the hot tables. Readers rely on that to read the archive only when they need to: receipt
+# lists page through the hot table first and continue into the archive once it runs out, and exports skip the archive
+# when their date range starts after the horizon. Lowering BANK_ACCOUNTS_ARCHIVE_AFTER is safe; raising it hides
+# receipts already archived from exports starting between the old and new horizons.
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import InternalTransferReceipt, ExternalTransferReceipt, ArchivedInternalTransferReceipt, \
+    ArchivedExternalTransferReceipt
+from . import routers
+
+# Archive table of each receipt table
+ARCHIVES = {
+    InternalTransferReceipt: ArchivedInternalTransferReceipt,
+    ExternalTransferReceipt: ArchivedExternalTransferReceipt,
+}
+
+# Receipts moved per transaction
+CHUNK_SIZE = 2000
+
+
+def archive_after():
+    """
+    :return: days receipts stay in the hot tables
+    """
+    return getattr(settings, 'BANK_ACCOUNTS_ARCHIVE_AFTER', 365)
+
+
+def horizon():
+    """
+    :return: datetime before which receipts may have been archived
+    """
+    return timezone.now() - datetime.timedelta(days=archive_after())
+
+
+def receipt_models(model, start=None):
+    """
+    :param model: InternalTransferReceipt or ExternalTransferReceipt
+    :param start: datetime the receipts wanted start at, None for all of them
+    :return: list of the models that may hold such receipts, the archive (holding the oldest receipts) first
+    """
+    if start is not None and start >= horizon():
+        return [model]
+    return [ARCHIVES[model], model]
+
+
+def archive(chunk_size=CHUNK_SIZE, log=None):
+    """
+    Moves receipts older than the horizon into the archive tables, on every shard.
+    :param chunk_size: receipts moved per transaction
+    :param log: function called with progress messages
+    :return: (internal transfer receipts moved, external transfer receipts moved)
+    """
+    log = log or (lambda message: None)
+    before = horizon()
+    moved = {InternalTransferReceipt: 0, ExternalTransferReceipt: 0}
+    for alias in routers.all_shards():
+        with routers.using_shard(alias):
+            for model in moved:
+                moved[model] += _move(model, before, chunk_size)
+        log('%s: %d internal, %d external transfer receipts archived' % (
+            alias, moved[InternalTransferReceipt], moved[ExternalTransferReceipt]))
+    return moved[InternalTransferReceipt], moved[ExternalTransferReceipt]
+
+
+def _move(model, before, chunk_size):
+    """
+    Moves one kind of receipt dated before a datetime into its archive table, a chunk per transaction.
+    :return: receipts moved
+    """
+    archived = ARCHIVES[model]
+    fields = [field.attname for field in archived._meta.concrete_fields]
+    moved = 0
+    while True:
+        with transaction.atomic(using=routers.primary()):
+            # Oldest receipts have the lowest ids, so scanning by id finds them without an index on date
+            rows = list(model.objects.filter(date__lt=before).order_by('pk').values(*fields)[:chunk_size])
+            if not rows:
+                return moved
+            archived.objects.bulk_create([archived(**row) for row in rows], batch_size=400)
+            model.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+        moved += len(rows)
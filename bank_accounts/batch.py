@@ -0,0 +1,329 @@
+# Batch transfers
+# Applies many internal transfers and payments for one User in a handful of queries, instead of one form post each.
+
+# Every Account and User referenced by the batch is loaded up front in bulk. Transfers are then checked one by one in
+# Python against running balances, in the order they were submitted, so a transfer may spend funds received earlier in
+# the same batch. Accepted transfers are summed into one balance change per Account, applied with a single UPDATE per
+# chunk of Accounts. Their receipts and ledger entries are written with bulk_create, and rollups are added to once per
+# Account and day.
+
+# Accounts are not locked while the batch is checked (see bank_accounts.versioning). Instead the balance changes of the
+# Accounts paid from are applied only if their versions are still the ones read, and otherwise the whole batch is
+# rolled back and checked again. In the pessimistic mode the Accounts are locked in primary key order as they are
+# loaded.
+
+# Payments to Users on another shard than the batch's User (see bank_accounts.routers) can't join the batch's
+# transaction. They are made one at a time once the rest of the batch has committed.
+
+# Payments are counted against the velocity rules (see bank_accounts.velocity) as they are checked, and uncounted if the
+# batch is rolled back.
+
+import csv
+import io
+import re
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, F, Q, Value, IntegerField
+from django.utils import timezone
+
+from .models import Account, InternalTransferReceipt, ExternalTransferReceipt, LedgerEntry
+from . import ledger, rollups, account_cache, versioning, routers, receiving, velocity
+from .transfers import external_transfer
+from .exceptions import TransferError, InsufficientFunds, InvalidAmount, InvalidAccount, SameAccount, \
+    NotCheckingAccount, InvalidPayee, SelfPayment, NoCheckingAccount, VelocityLimitExceeded, ConcurrentUpdate
+from django.contrib.auth.models import User
+
+INTERNAL = 'internal'
+EXTERNAL = 'external'
+
+# Largest number of transfers accepted in one batch
+MAX_BATCH_SIZE = getattr(settings, 'BANK_ACCOUNTS_MAX_BATCH_SIZE', 10000)
+
+# Number of rows read, updated or inserted per statement. Keeps us under SQLite's limit on query parameters.
+CHUNK_SIZE = 400
+
+ERROR_MESSAGES = {
+    InsufficientFunds: 'Not enough funds.',
+    InvalidAmount: 'Amount to transfer must be positive.',
+    InvalidAccount: 'Accounts selected invalid.',
+    SameAccount: 'Selected Accounts cannot be the same.',
+    NotCheckingAccount: 'You must make a payment from a checking account.',
+    InvalidPayee: 'The user you are making the payment to does not exist.',
+    SelfPayment: 'You cannot pay yourself.',
+    NoCheckingAccount: 'The user you are making the payment to does not have a checking account.',
+    VelocityLimitExceeded: 'Payment limit reached. Please try again later.',
+}
+
+
+class InvalidBatch(Exception):
+    pass  # Batch as a whole cannot be read
+
+
+def parse_json(data):
+    """
+    Reads transfers from decoded JSON: either a list of transfers, or an object with a "transfers" list.
+    Each transfer is an object with "type" ("internal" or "external"), "from_account", "amount" (an integer), and either
+    "to_account" (internal) or "payee" and optionally "comment" (external).
+    :param data:
+    :return: list of dicts
+    """
+    if isinstance(data, dict):
+        data = data.get('transfers')
+    if not isinstance(data, list):
+        raise InvalidBatch('Expected a list of transfers.')
+    return data
+
+
+def parse_csv(text):
+    """
+    Reads transfers from CSV text with a header row naming the same fields as the JSON format. Whole number amounts
+    are read as integers, and any other amount is left as text, to be refused.
+    :param text:
+    :return: list of dicts
+    """
+    items = list(csv.DictReader(io.StringIO(text)))
+    for item in items:
+        amount = item.get('amount')
+        if isinstance(amount, str) and re.fullmatch(r'\s*-?[0-9]+\s*', amount):
+            item['amount'] = int(amount)
+    return items
+
+
+def run_batch(user, items):
+    """
+    Performs a batch of transfers on behalf of a User. Transfers that are refused do not stop the rest.
+    :param user: User making the transfers. Must hold every Account transferred from.
+    :param items: list of dicts, see parse_json
+    :return: list with one result dict per transfer, in the order given
+    :raise ConcurrentUpdate: if the Accounts paid from kept changing while the batch was checked
+    """
+    if len(items) > MAX_BATCH_SIZE:
+        raise InvalidBatch('A batch may contain at most %d transfers.' % MAX_BATCH_SIZE)
+
+    results = [None] * len(items)
+    transfers = []  # (index, cleaned transfer) of well-formed transfers
+    for index, item in enumerate(items):
+        try:
+            transfers.append((index, _clean(item)))
+        except InvalidAmount:
+            results[index] = {'index': index, 'ok': False, 'error': ERROR_MESSAGES[InvalidAmount]}
+        except (TypeError, ValueError, KeyError):
+            results[index] = {'index': index, 'ok': False, 'error': 'Invalid transfer data.'}
+
+    shard = routers.shard_for(user.pk)
+    elsewhere = [(index, transfer) for index, transfer in transfers
+                 if transfer['type'] == EXTERNAL and routers.shard_for(transfer['payee']) != shard]
+    elsewhere_indexes = {index for index, transfer in elsewhere}
+    transfers = [(index, transfer) for index, transfer in transfers if index not in elsewhere_indexes]
+
+    with routers.using_shard(shard):
+        if versioning.MODE == versioning.PESSIMISTIC:
+            results = _run(user, transfers, results, lock=True)
+        else:
+            results = versioning.retry(lambda: _run(user, transfers, list(results), lock=False))
+
+    for index, transfer in elsewhere:
+        try:
+            external_transfer(user, transfer['from_account'], transfer['payee'], transfer['amount'],
+                              transfer['comment'])
+            results[index] = {'index': index, 'ok': True}
+        except TransferError as error:
+            results[index] = {'index': index, 'ok': False, 'error': ERROR_MESSAGES[type(error)]}
+    return results
+
+
+def _run(user, transfers, results, lock):
+    """
+    Checks and applies a batch's well-formed transfers in one transaction.
+    :param lock: True to lock the Accounts while checking, False to check their versions when applying instead
+    :return: results, completed
+    :raise ConcurrentUpdate: if an Account paid from changed while the batch was checked
+    """
+    reservations = []  # Payments counted against the velocity rules
+    try:
+        with transaction.atomic(using=routers.primary()):
+            accounts, receiving_accounts = _load(user, [transfer for index, transfer in transfers], lock)
+
+            balances = {pk: account.balance for pk, account in accounts.items()}
+            deltas = {}
+            debited = set()
+            internal_receipts = []
+            external_receipts = []
+            now = timezone.now()
+
+            for index, transfer in transfers:
+                try:
+                    from_pk, to_pk = _check(user, transfer, accounts, receiving_accounts, balances)
+                    if transfer['type'] == EXTERNAL:
+                        reservations.append(velocity.reserve(user.pk, from_pk, transfer['amount']))
+                except TransferError as error:
+                    results[index] = {'index': index, 'ok': False, 'error': ERROR_MESSAGES[type(error)]}
+                    continue
+
+                amount = transfer['amount']
+                balances[from_pk] -= amount
+                balances[to_pk] += amount
+                deltas[from_pk] = deltas.get(from_pk, 0) - amount
+                deltas[to_pk] = deltas.get(to_pk, 0) + amount
+                debited.add(from_pk)
+
+                if transfer['type'] == INTERNAL:
+                    internal_receipts.append(InternalTransferReceipt(user=user, from_account_id=from_pk,
+                                                                     to_account_id=to_pk, amount=amount, date=now))
+                else:
+                    external_receipts.append(ExternalTransferReceipt(payer=user, payee_id=transfer['payee'],
+                                                                     from_account_id=from_pk, to_account_id=to_pk,
+                                                                     comment=transfer['comment'], amount=amount,
+                                                                     date=now))
+                results[index] = {'index': index, 'ok': True}
+
+            # Balances were checked as read, so unlocked Accounts paid from must still be as read
+            apply_deltas(deltas, versions=None if lock else {pk: accounts[pk].version for pk in debited})
+            InternalTransferReceipt.objects.bulk_create(internal_receipts, batch_size=CHUNK_SIZE)
+            ExternalTransferReceipt.objects.bulk_create(external_receipts, batch_size=CHUNK_SIZE)
+            ledger.record_transfers(LedgerEntry.INTERNAL_TRANSFER, internal_receipts)
+            ledger.record_transfers(LedgerEntry.EXTERNAL_TRANSFER, external_receipts)
+            rollups.record_transfers(internal_receipts)
+            rollups.record_transfers(external_receipts)
+            account_cache.invalidate(user.pk, *{receipt.payee_id for receipt in external_receipts})
+    except Exception:
+        for reservation in reservations:
+            reservation.cancel()
+        raise
+
+    return results
+
+
+def _clean(item):
+    """
+    Converts a submitted transfer into the types we work with.
+    :param item: dict
+    :return: dict
+    :raise InvalidAmount: if the amount isn't an integer, e.g. a fraction of a dollar or text
+    """
+    amount = item['amount']
+    if not isinstance(amount, int) or isinstance(amount, bool):
+        raise InvalidAmount()
+    transfer = {
+        'type': item['type'],
+        'from_account': int(item['from_account']),
+        'amount': amount,
+    }
+    if transfer['type'] == INTERNAL:
+        transfer['to_account'] = int(item['to_account'])
+    elif transfer['type'] == EXTERNAL:
+        transfer['payee'] = int(item['payee'])
+        transfer['comment'] = str(item.get('comment') or '')[:500]
+    else:
+        raise ValueError(transfer['type'])
+    return transfer
+
+
+def _load(user, transfers, lock):
+    """
+    Loads every Account a batch touches.
+    :param user:
+    :param transfers: cleaned transfers
+    :param lock: True to lock the Accounts until the end of the transaction
+    :return: dict of Accounts by pk, and dict of receiving Checking Account pk by payee pk
+    """
+    payee_pks = {transfer['payee'] for transfer in transfers if transfer['type'] == EXTERNAL}
+
+    # Receiving Account of each payee, as in transfers.external_transfer. Read from the database rather than the cache,
+    # since they are locked below.
+    receiving_accounts = {}
+    for chunk in _chunks(sorted(payee_pks)):
+        receiving_accounts.update(receiving.receiving_accounts(chunk))
+
+    # Payees without a Checking Account may not exist at all
+    missing = payee_pks - set(receiving_accounts)
+    for chunk in _chunks(sorted(missing)):
+        for payee_pk in User.objects.filter(pk__in=chunk).values_list('pk', flat=True):
+            receiving_accounts[payee_pk] = None
+
+    account_pks = set(receiving_accounts.values()) - {None}
+    for transfer in transfers:
+        account_pks.add(transfer['from_account'])
+        if transfer['type'] == INTERNAL:
+            account_pks.add(transfer['to_account'])
+
+    # Lock in primary key order so concurrent batches and transfers cannot deadlock
+    accounts = {}
+    queryset = Account.objects.select_for_update() if lock else Account.objects.all()
+    for chunk in _chunks(sorted(account_pks)):
+        for account in queryset.filter(pk__in=chunk).order_by('pk'):
+            accounts[account.pk] = account
+
+    return accounts, receiving_accounts
+
+
+def _check(user, transfer, accounts, receiving_accounts, balances):
+    """
+    Applies the same rules as bank_accounts.transfers to one transfer of a batch.
+    :return: pks of the Accounts to withdraw from and deposit into
+    """
+    amount = transfer['amount']
+    from_account = accounts.get(transfer['from_account'])
+
+    if amount <= 0:
+        raise InvalidAmount()
+
+    if transfer['type'] == INTERNAL:
+        to_account = accounts.get(transfer['to_account'])
+        if transfer['from_account'] == transfer['to_account']:
+            raise SameAccount()
+        if from_account is None or to_account is None or \
+                from_account.holder_id != user.pk or to_account.holder_id != user.pk:
+            raise InvalidAccount()
+        to_pk = to_account.pk
+    else:
+        if transfer['payee'] == user.pk:
+            raise SelfPayment()
+        if transfer['payee'] not in receiving_accounts:
+            raise InvalidPayee()
+        to_pk = receiving_accounts[transfer['payee']]
+        if to_pk is None:
+            raise NoCheckingAccount()
+        if from_account is None or from_account.holder_id != user.pk:
+            raise InvalidAccount()
+        if from_account.account_type != Account.CHECKING:
+            raise NotCheckingAccount()
+
+    if amount > balances[from_account.pk]:
+        raise InsufficientFunds()
+
+    return from_account.pk, to_pk
+
+
+def apply_deltas(deltas, versions=None):
+    """
+    Adds each Account's net balance change in one UPDATE per chunk of Accounts.
+    :param deltas: dict of balance change by Account pk
+    :param versions: dict of version by Account pk, for Accounts to change only if still at that version
+    :return:
+    :raise ConcurrentUpdate: if an Account in versions is at another version. Roll back the transaction.
+    """
+    versions = versions or {}
+    changed = sorted(pk for pk, delta in deltas.items() if delta)
+    for chunk in _chunks(changed):
+        # One WHEN per distinct change rather than per Account: many Accounts often change by the same amount (e.g.
+        # interest), and building the expressions costs more than running the UPDATE
+        by_delta = {}
+        for pk in chunk:
+            by_delta.setdefault(deltas[pk], []).append(pk)
+        change = Case(*[When(pk__in=pks, then=Value(delta)) for delta, pks in by_delta.items()],
+                      output_field=IntegerField())
+
+        match = Q(pk__in=[pk for pk in chunk if pk not in versions])
+        for pk in chunk:
+            if pk in versions:
+                match |= Q(pk=pk, version=versions[pk])
+        updated = Account.objects.filter(match).update(balance=F('balance') + change, version=F('version') + 1)
+        if versions and updated != len(chunk):
+            raise ConcurrentUpdate()
+
+
+def _chunks(values):
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
@@ -0,0 +1,70 @@
+# Benchmark helpers
+# Benchmarks run against a throwaway copy of the configured database, created and destroyed the same way the test
+# runner does it, so they never touch real data.
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection, OperationalError
+from django.test.utils import setup_databases, teardown_databases
+
+
+@contextmanager
+def benchmark_database(verbosity=0):
+    """
+    Creates a test copy of every configured database for the duration of a benchmark.
+    :param verbosity:
+    :return:
+    """
+    old_config = setup_databases(verbosity=verbosity, interactive=False, serialized_aliases=set())
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=verbosity)
+
+
+def run_threads(workers, operations, operation):
+    """
+    Runs an operation many times from several threads at once, each with its own database connection.
+    Operations failing because the database is busy (e.g. SQLite's "database is locked") are retried.
+    :param workers: number of threads
+    :param operations: number of times each thread runs the operation
+    :param operation: function called with (worker number, operation number)
+    :return: (seconds taken, number of retries)
+    """
+    retries = [0] * workers
+
+    def work(worker):
+        try:
+            for number in range(operations):
+                while True:
+                    try:
+                        operation(worker, number)
+                        break
+                    except OperationalError:
+                        retries[worker] += 1
+                        time.sleep(0.001)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, sum(retries)
+
+
+def percentile(values, fraction):
+    """
+    :param values: list of numbers
+    :param fraction: between 0 and 1, e.g. 0.95 for the 95th percentile
+    :return: smallest value at least that fraction of values are less than or equal to, or None if there are none
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
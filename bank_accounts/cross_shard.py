@@ -0,0 +1,194 @@
+# Cross-shard payments
+# When the payer's and the payee's Accounts are on different shards (see bank_accounts.routers), no one transaction
+# covers both, so a payment is made in two phases, each a transaction on one shard:
+
+# 1. Prepare, on the payer's shard: withdraw, save the payer's receipt, ledger entry and rollups, and an outgoing
+#    CrossShardTransfer in the PREPARED state.
+# 2. Apply, on the payee's shard, once the first phase has committed: save an incoming CrossShardTransfer with the same
+#    transfer_id, and either deposit and save the payee's receipt, ledger entry and rollups, or, if the payee no longer
+#    has a Checking Account, record the payment as refused. transfer_id is unique, so whichever attempt saves the
+#    incoming side first decides the payment's fate once and for all, and later attempts only read it.
+# 3. Settle, on the payer's shard: mark the outgoing side COMMITTED, or refund the payer and mark it REFUNDED. The
+#    update only matches a PREPARED transfer, so a refund is never made twice.
+
+# A crash or an unreachable shard between the phases leaves a PREPARED transfer behind. The
+# resolve_cross_shard_transfers command finishes those, so every payment ends up deposited or refunded exactly once.
+# Until then the payer sees the payment and the payee doesn't yet.
+
+# Each shard's receipt leaves out the Account on the other shard, which it has no row for. A refund deletes the
+# payer's receipt, and takes the payment back out of the rollups. The ledger only ever grows, so the refund is a
+# credit entry that cancels the debit.
+
+import datetime
+import logging
+import uuid
+
+from django.db import transaction, IntegrityError, DatabaseError
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Account, ExternalTransferReceipt, LedgerEntry, CrossShardTransfer
+from .exceptions import NoCheckingAccount, TransferError
+from . import transfers, ledger, rollups, slots, account_cache, routers, receiving
+
+logger = logging.getLogger(__name__)
+
+# PREPARED transfers younger than this are left alone by resolve, as their payment may still be completing them
+RESOLVE_AFTER = 60
+
+
+def pay(payer, from_account_pk, payee_pk, amount, comment=''):
+    """
+    Pays a User on another shard than the payer's. Called by transfers.external_transfer with the payer's shard
+    current. If the payment is made inside a transaction, it is applied on the payee's shard once that commits, and
+    refused there without raising.
+    :param payer:
+    :param from_account_pk:
+    :param payee_pk:
+    :param amount:
+    :param comment:
+    :return: the payer's ExternalTransferReceipt
+    """
+    with routers.using_shard(routers.shard_for(payee_pk)):
+        to_account_pk, _ = receiving.receiving_account(payee_pk)  # Refuses unknown payees before withdrawing
+
+    shard = routers.primary()
+    outcome = []
+    with transaction.atomic(using=shard):
+        if not Account.objects.filter(pk=from_account_pk, holder=payer, account_type=Account.CHECKING,
+                                      balance__gte=amount)\
+                .update(balance=F('balance') - amount, version=F('version') + 1):
+            raise transfers._refused_debit(payer, from_account_pk)
+
+        receipt = ExternalTransferReceipt.objects.create(payer=payer, payee_id=payee_pk,
+                                                         from_account_id=from_account_pk, comment=comment,
+                                                         amount=amount)
+        ledger.record_transfers(LedgerEntry.EXTERNAL_TRANSFER, [receipt])
+        rollups.record_transfers([receipt])
+        outgoing = CrossShardTransfer.objects.create(transfer_id=uuid.uuid4(), direction=CrossShardTransfer.OUTGOING,
+                                                     status=CrossShardTransfer.PREPARED, payer_pk=payer.pk,
+                                                     payee_pk=payee_pk, from_account_pk=from_account_pk,
+                                                     to_account_pk=to_account_pk, amount=amount, comment=comment,
+                                                     date=receipt.date, receipt_id=receipt.pk)
+        account_cache.invalidate(payer.pk)
+        transaction.on_commit(lambda: outcome.append(_complete_or_log(outgoing)), using=shard)
+
+    if outcome == [CrossShardTransfer.REFUNDED]:  # Completed right away, and refused
+        raise NoCheckingAccount()
+    return receipt
+
+
+def complete(outgoing):
+    """
+    Applies a prepared payment on the payee's shard, then settles it on the payer's shard. May be called any number
+    of times, concurrently too.
+    :param outgoing: outgoing CrossShardTransfer, read from the payer's shard
+    :return: CrossShardTransfer.COMMITTED or CrossShardTransfer.REFUNDED
+    """
+    payer_shard = outgoing._state.db
+    with routers.using_shard(routers.shard_for(outgoing.payee_pk)):
+        status = _apply(outgoing)
+
+    with routers.using_shard(payer_shard), transaction.atomic(using=payer_shard):
+        if CrossShardTransfer.objects.filter(pk=outgoing.pk, status=CrossShardTransfer.PREPARED)\
+                .update(status=status) and status == CrossShardTransfer.REFUNDED:
+            _refund(outgoing)
+    outgoing.status = status
+    return status
+
+
+def resolve(older_than=RESOLVE_AFTER, log=None):
+    """
+    Completes the payments left PREPARED on every shard, e.g. by a crash.
+    :param older_than: seconds since the payment was made
+    :param log: function called with progress messages
+    :return: (payments committed, payments refunded)
+    """
+    log = log or (lambda message: None)
+    cutoff = timezone.now() - datetime.timedelta(seconds=older_than)
+    counts = {CrossShardTransfer.COMMITTED: 0, CrossShardTransfer.REFUNDED: 0}
+    for alias in routers.shards():
+        prepared = CrossShardTransfer.objects.using(alias)\
+            .filter(direction=CrossShardTransfer.OUTGOING, status=CrossShardTransfer.PREPARED, date__lt=cutoff)
+        for outgoing in list(prepared.order_by('date')):
+            counts[complete(outgoing)] += 1
+        log('%s: %d committed, %d refunded' % (alias, counts[CrossShardTransfer.COMMITTED],
+                                               counts[CrossShardTransfer.REFUNDED]))
+    return counts[CrossShardTransfer.COMMITTED], counts[CrossShardTransfer.REFUNDED]
+
+
+def _apply(outgoing):
+    """
+    Deposits a payment on the payee's shard, which must be current, unless an earlier attempt decided its fate.
+    :return: CrossShardTransfer.COMMITTED or CrossShardTransfer.REFUNDED
+    """
+    with transaction.atomic(using=routers.primary()):
+        try:
+            with transaction.atomic(using=routers.primary()):
+                incoming = CrossShardTransfer.objects.create(
+                    transfer_id=outgoing.transfer_id, direction=CrossShardTransfer.INCOMING,
+                    status=CrossShardTransfer.COMMITTED, payer_pk=outgoing.payer_pk, payee_pk=outgoing.payee_pk,
+                    from_account_pk=outgoing.from_account_pk, to_account_pk=outgoing.to_account_pk,
+                    amount=outgoing.amount, comment=outgoing.comment, date=outgoing.date)
+        except IntegrityError:  # Applied or refused before
+            return CrossShardTransfer.objects.get(transfer_id=outgoing.transfer_id).status
+
+        try:
+            # Read from the database, since a deposit refused here can't be retried
+            to_account_pk, to_account_slots = receiving.receiving_account(outgoing.payee_pk, cached=False)
+        except TransferError:
+            to_account_pk = None
+        if to_account_pk is None or \
+                not _deposit(slots.credit_target(to_account_pk, to_account_slots), outgoing.amount):
+            incoming.status = CrossShardTransfer.REFUNDED
+            incoming.save(update_fields=['status'])
+            return incoming.status
+
+        receipt = ExternalTransferReceipt.objects.create(payer_id=outgoing.payer_pk, payee_id=outgoing.payee_pk,
+                                                         to_account_id=to_account_pk, comment=outgoing.comment,
+                                                         amount=outgoing.amount, date=outgoing.date)
+        ledger.record_transfers(LedgerEntry.EXTERNAL_TRANSFER, [receipt])
+        rollups.record_transfers([receipt])
+        incoming.to_account_pk, incoming.receipt_id = to_account_pk, receipt.pk
+        incoming.save(update_fields=['to_account_pk', 'receipt_id'])
+        account_cache.invalidate(outgoing.payee_pk)
+        return incoming.status
+
+
+def _deposit(credit, amount):
+    if credit.model is Account:
+        return credit.update(balance=F('balance') + amount, version=F('version') + 1)
+    return credit.update(balance=F('balance') + amount)
+
+
+def _refund(outgoing):
+    """
+    Gives a refused payment back to the payer. Must be called in a transaction on the payer's shard, which must be
+    current.
+    """
+    if not Account.objects.filter(pk=outgoing.from_account_pk)\
+            .update(balance=F('balance') + outgoing.amount, version=F('version') + 1):
+        logger.error('Account %d was deleted before payment %s could be refunded',
+                     outgoing.from_account_pk, outgoing.transfer_id)
+        return
+
+    receipt = ExternalTransferReceipt.objects.filter(pk=outgoing.receipt_id).first()
+    if receipt is not None:
+        rollups.record_transfers([receipt], sign=-1)
+        receipt.delete()
+    LedgerEntry.objects.create(account_id=outgoing.from_account_pk, amount=outgoing.amount, date=timezone.now(),
+                               kind=LedgerEntry.EXTERNAL_TRANSFER, receipt_id=outgoing.receipt_id)
+    account_cache.invalidate(outgoing.payer_pk)
+
+
+def _complete_or_log(outgoing):
+    """
+    Completes a payment right after it was prepared. If the payee's shard can't be reached, the payment stays
+    PREPARED for resolve.
+    :return: status of the payment
+    """
+    try:
+        return complete(outgoing)
+    except DatabaseError:
+        logger.exception('Payment %s left prepared', outgoing.transfer_id)
+        return CrossShardTransfer.PREPARED
@@ -0,0 +1,218 @@
+# Synthetic data
+# Fills the database with Users, Accounts and transfer history at realistic scale, for load tests and for trying out
+# queries and indexes. Rows are written with bulk_create in chunks, and only the primary keys and running balances of
+# the generated Accounts are kept in memory, so millions of rows can be generated.
+
+# bulk_create skips model signals and the transfer service, so whatever they would have written is written here too:
+# an opening BalanceCheckpoint for every Account, and ledger entries and rollups for every receipt. Transfers are
+# generated in date order against running balances, so no balance ever goes negative and the ledger agrees with every
+# final balance.
+
+import datetime
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Account, InternalTransferReceipt, ExternalTransferReceipt, LedgerEntry, BalanceCheckpoint, \
+    DefaultReceivingAccount
+from . import ledger, rollups
+from .batch import apply_deltas
+
+# Rows inserted per statement
+CHUNK_SIZE = 400
+
+COMMENTS = ['', '', '', 'Rent', 'Dinner', 'Groceries', 'Tickets', 'Thanks!', 'Gift', 'Utilities']
+
+
+def generate(users=1000, accounts_per_user=2, internal_transfers=5000, external_transfers=5000, days=365,
+             max_balance=10000, mean_amount=50, payee_skew=1.0, username_prefix='user_', password='password',
+             seed=None, log=None):
+    """
+    Generates Users with Accounts and a history of internal transfers and payments between them, in one transaction.
+    :param users: number of Users
+    :param accounts_per_user: average number of Accounts per User. Every User's first Account is a Checking Account.
+    :param internal_transfers: number of internal transfers
+    :param external_transfers: number of payments
+    :param days: transfers are spread evenly over this many days before now
+    :param max_balance: opening balances are uniform between 0 and this
+    :param mean_amount: transfer amounts are exponentially distributed with this mean, capped by the balance
+    :param payee_skew: 1 picks payees uniformly. Higher values concentrate payments on fewer, popular payees.
+    :param username_prefix: usernames are this prefix followed by a number
+    :param password: password of every generated User
+    :param seed: seed of the random number generator, for repeatable data
+    :param log: function called with progress messages
+    :return: dict of the number of rows written, by kind
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+    end = timezone.now()
+    start = end - datetime.timedelta(days=days)
+    written = {}
+
+    with transaction.atomic():
+        holders = _create_users(users, username_prefix, make_password(password))
+        written['users'] = len(holders)
+        log('%d users' % len(holders))
+
+        accounts, balances = _create_accounts(rng, holders, accounts_per_user, max_balance, start)
+        written['accounts'] = len(balances)
+        log('%d accounts' % len(balances))
+
+        opening = dict(balances)
+        written['internal_transfers'], written['external_transfers'] = _create_transfers(
+            rng, holders, accounts, balances, internal_transfers, external_transfers, start, end, mean_amount,
+            payee_skew, log)
+
+        apply_deltas({pk: balance - opening[pk] for pk, balance in balances.items()})
+
+    return written
+
+
+def _create_users(count, username_prefix, password):
+    """
+    :return: list of User primary keys
+    """
+    first = (User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1
+    pks = []
+    for chunk in _chunks(range(first, first + count)):
+        pks.extend(user.pk for user in _insert(User, [User(username='%s%d' % (username_prefix, number),
+                                                            password=password) for number in chunk]))
+    return pks
+
+
+def _create_accounts(rng, holders, accounts_per_user, max_balance, opened):
+    """
+    Creates each User's Accounts with their opening checkpoints.
+    :return: list of each User's Account primary keys (Checking Account first), and dict of balance by Account pk
+    """
+    accounts = []
+    balances = {}
+    for chunk in _chunks(holders):
+        new_accounts = []
+        for holder in chunk:
+            for number in range(rng.randint(1, max(1, 2 * accounts_per_user - 1))):
+                account_type = Account.CHECKING if number == 0 else rng.choice(Account.ACCOUNT_TYPE_CHOICES)[0]
+                new_accounts.append(Account(account_type=account_type, creator='generate_bank_data', holder_id=holder,
+                                            balance=rng.randint(0, max_balance),
+                                            bank=rng.choice(Account.BANK_CHOICES)[0],
+                                            routing_number=rng.randint(0, 10000000)))
+        _insert(Account, new_accounts)
+        BalanceCheckpoint.objects.bulk_create([BalanceCheckpoint(account_id=account.pk, date=opened,
+                                                                 balance=account.balance)
+                                               for account in new_accounts])
+        # bulk_create sends no signals, so each holder's first Checking Account is made to receive payments here
+        DefaultReceivingAccount.objects.bulk_create([DefaultReceivingAccount(holder_id=account.holder_id,
+                                                                             account_id=account.pk)
+                                                     for account in new_accounts
+                                                     if account.account_type == Account.CHECKING],
+                                                    ignore_conflicts=True)
+
+        holder_accounts = {}
+        for account in new_accounts:
+            holder_accounts.setdefault(account.holder_id, []).append(account.pk)
+            balances[account.pk] = account.balance
+        accounts.extend(holder_accounts[holder] for holder in chunk)
+    return accounts, balances
+
+
+def _create_transfers(rng, holders, accounts, balances, internal_count, external_count, start, end, mean_amount,
+                      payee_skew, log):
+    """
+    Creates transfers in date order, updating balances as it goes.
+    :return: number of internal transfers and payments written
+    """
+    if not holders:
+        return 0, 0
+
+    # Only Users with several Accounts make internal transfers
+    multi_account = [index for index, pks in enumerate(accounts) if len(pks) > 1]
+    if not multi_account:
+        internal_count = 0
+
+    total = internal_count + external_count
+    internal_left = internal_count
+    internal_receipts = []
+    external_receipts = []
+    counts = [0, 0]
+
+    for number in range(total):
+        date = start + (end - start) * ((number + rng.random()) / total)
+        internal = rng.random() * (total - number) < internal_left
+        if internal:
+            internal_left -= 1
+            index = rng.choice(multi_account)
+            from_pk, to_pk = rng.sample(accounts[index], 2)
+        else:
+            index = rng.randrange(len(holders))
+            payee_index = int(len(holders) * rng.random() ** payee_skew)
+            if payee_index == index:
+                payee_index = (payee_index + 1) % len(holders)
+            if payee_index == index:
+                continue  # Only one User, nobody to pay
+            from_pk, to_pk = accounts[index][0], accounts[payee_index][0]
+
+        amount = min(balances[from_pk], 1 + int(rng.expovariate(1 / mean_amount)))
+        if amount <= 0:
+            continue  # Account is empty. Refused, like a real transfer would be.
+        balances[from_pk] -= amount
+        balances[to_pk] += amount
+
+        if internal:
+            internal_receipts.append(InternalTransferReceipt(user_id=holders[index], from_account_id=from_pk,
+                                                             to_account_id=to_pk, amount=amount, date=date))
+        else:
+            external_receipts.append(ExternalTransferReceipt(payer_id=holders[index], payee_id=holders[payee_index],
+                                                             from_account_id=from_pk, to_account_id=to_pk,
+                                                             amount=amount, comment=rng.choice(COMMENTS), date=date))
+
+        if len(internal_receipts) >= CHUNK_SIZE:
+            counts[0] += _write_receipts(LedgerEntry.INTERNAL_TRANSFER, internal_receipts)
+        if len(external_receipts) >= CHUNK_SIZE:
+            counts[1] += _write_receipts(LedgerEntry.EXTERNAL_TRANSFER, external_receipts)
+
+        if (number + 1) % 100000 == 0:
+            log('%d transfers' % (number + 1))
+
+    counts[0] += _write_receipts(LedgerEntry.INTERNAL_TRANSFER, internal_receipts)
+    counts[1] += _write_receipts(LedgerEntry.EXTERNAL_TRANSFER, external_receipts)
+    log('%d internal transfers, %d payments' % tuple(counts))
+    return counts[0], counts[1]
+
+
+def _write_receipts(kind, receipts):
+    """
+    Inserts receipts with their ledger entries and rollups, and empties the list.
+    :return: number of receipts written
+    """
+    if not receipts:
+        return 0
+    _insert(type(receipts[0]), receipts)
+    ledger.record_transfers(kind, receipts)
+    rollups.record_transfers(receipts)
+    count = len(receipts)
+    receipts.clear()
+    return count
+
+
+def _insert(model, objects):
+    """
+    bulk_create that always sets primary keys. On databases that can't return them from an INSERT, they are read back,
+    which is safe because generation is the only thing writing.
+    :return: objects
+    """
+    last_pk = model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    model.objects.bulk_create(objects)
+    if objects and objects[0].pk is None:
+        pks = model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:len(objects)]
+        for obj, pk in zip(objects, pks):
+            obj.pk = pk
+    return objects
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
@@ -0,0 +1,274 @@
+# Live updates
+# Clients that want to notice new transfers as they happen open a stream of server-sent events instead of polling the
+# account and receipt lists. Each stream sends the User's balances when it opens, then every new ledger entry of the
+# User's Accounts (a side of a transfer, or interest) as a "transfer" or "interest" event, followed by the balances
+# after it.
+
+# Streams don't poll the database themselves. Each waits on its own threading.Event, registered with this process's
+# hub, and only queries when woken up:
+# - by the writes of this process, which publish the holders whose Accounts changed once they commit (see
+#   account_cache.invalidate), and
+# - by the hub's poller thread, which notices the writes of other processes. While streams are open it reads the
+#   holders of the ledger entries added since it last looked every BANK_ACCOUNTS_EVENTS_POLL_INTERVAL seconds, two
+#   queries per shard for the whole process however many entries were added, and wakes their streams.
+
+# Ledger entry ids are the events' ids, so a client reconnecting with the Last-Event-ID header (as browsers do) catches
+# up on what it missed from the ledger. Ids only ever grow, and with SQLite, which commits one write at a time, they
+# are committed in order. With a database committing writes concurrently, an entry may commit after a higher id has
+# been sent. Its event is then skipped, but the balances sent with later events include it.
+
+# Streams end after MAX_DURATION, and clients reconnect after RETRY, so a worker is never held forever. Under WSGI each
+# open stream holds a worker thread. Under ASGI (see mysite3.asgi) streams are async generators waiting on the event
+# loop instead, so idle ones hold no thread.
+
+import asyncio
+import json
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.db.models import Max
+
+from .models import LedgerEntry
+from . import account_cache, routers
+
+# Seconds between comments keeping an idle stream's connection open
+HEARTBEAT = 15
+
+# Seconds a stream stays open
+MAX_DURATION = 5 * 60
+
+# Milliseconds clients wait before reconnecting
+RETRY = 3000
+
+# Ledger entries read per query
+CHUNK_SIZE = 500
+
+# Sent when nothing happened for HEARTBEAT seconds. A comment, which clients ignore.
+HEARTBEAT_COMMENT = ': heartbeat\n\n'
+
+
+def poll_interval():
+    """
+    :return: seconds between the hub's reads of the ledger, or None to only notice this process's writes
+    """
+    return getattr(settings, 'BANK_ACCOUNTS_EVENTS_POLL_INTERVAL', 1.0)
+
+
+class Hub:
+    """
+    Wakes the streams of Users whose Accounts changed. One per process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = {}  # Set of the threading.Events of open streams, by User pk
+        self._poller = None
+        self._cursors = {}  # Last ledger entry id the poller saw, by shard
+
+    def subscribe(self, user_pk, event=None):
+        """
+        :param user_pk:
+        :param event: object whose set method is called, from any thread, whenever the User's Accounts change.
+        Defaults to a new threading.Event.
+        :return: the event
+        """
+        event = event or threading.Event()
+        with self._lock:
+            self._waiting.setdefault(user_pk, set()).add(event)
+            if self._poller is None and poll_interval() is not None:
+                self._poller = threading.Thread(target=self._poll, name='bank_accounts events', daemon=True)
+                self._poller.start()
+        return event
+
+    def unsubscribe(self, user_pk, event):
+        with self._lock:
+            events = self._waiting.get(user_pk, set())
+            events.discard(event)
+            if not events:
+                self._waiting.pop(user_pk, None)
+
+    def publish(self, *user_pks):
+        """
+        Wakes the streams of Users.
+        :param user_pks: primary keys of Users. None is ignored.
+        :return:
+        """
+        with self._lock:
+            events = [event for pk in user_pks for event in self._waiting.get(pk, ())]
+        for event in events:
+            event.set()
+
+    def subscribers(self):
+        """
+        :return: number of open streams
+        """
+        with self._lock:
+            return sum(len(events) for events in self._waiting.values())
+
+    def poll(self):
+        """
+        Wakes the streams of the holders of Accounts with ledger entries added since the last poll.
+        :return:
+        """
+        for alias in routers.all_shards():
+            entries = LedgerEntry.objects.using(alias)
+            cursor = self._cursors.get(alias)
+            last = entries.aggregate(last=Max('id'))['last'] or 0
+            self._cursors[alias] = last
+            if cursor is None or last <= cursor:  # Streams send what was there when they opened, so start from now
+                continue
+            # Straight to the last entry, so the poller never falls behind however fast entries are added
+            self.publish(*entries.filter(id__gt=cursor, id__lte=last).order_by()
+                         .values_list('account__holder_id', flat=True).distinct())
+
+    def _poll(self):
+        try:
+            while True:
+                time.sleep(poll_interval() or HEARTBEAT)
+                with self._lock:
+                    if not self._waiting:
+                        self._poller = None
+                        self._cursors = {}
+                        return
+                self.poll()
+        finally:
+            connections.close_all()  # This thread's own connections
+
+
+hub = Hub()
+
+
+class AsyncEvent:
+    """
+    Event an async stream waits on, which the hub may set from any thread.
+    """
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def set(self):
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            pass  # The loop was closed, and the stream with it
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self, timeout):
+        """
+        :param timeout: seconds
+        :return: True if set, False if the timeout passed first
+        """
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+def last_event_id(request):
+    """
+    :param request:
+    :return: id of the last event a reconnecting client received, from the Last-Event-ID header or else the
+    last_event_id GET parameter (for a client's first connection, where it can't set headers), or None
+    """
+    value = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_event_id')
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def stream(user, cursor=None):
+    """
+    Generates the server-sent events of a User. Must be consumed with the User's shard current.
+    :param user:
+    :param cursor: id of the last event the client received, to send those after it, or None to start from now
+    :return: generator of chunks of text
+    """
+    event = hub.subscribe(user.pk)
+    try:
+        if cursor is None:
+            cursor = LedgerEntry.objects.aggregate(last=Max('id'))['last'] or 0
+        chunk, cursor = _changes(user, cursor, balances=True)
+        yield 'retry: %d\n\n' % RETRY + chunk
+
+        deadline = time.monotonic() + MAX_DURATION
+        while time.monotonic() < deadline:
+            if not event.wait(HEARTBEAT):
+                yield HEARTBEAT_COMMENT
+                continue
+            event.clear()  # Before reading, so changes committed meanwhile wake us again
+            chunk, cursor = _changes(user, cursor)
+            if chunk:
+                yield chunk
+    finally:
+        hub.unsubscribe(user.pk, event)
+
+
+async def astream(user, cursor=None):
+    """
+    Like stream, for ASGI: waits on the event loop instead of holding a thread.
+    :param user:
+    :param cursor: id of the last event the client received, or None to start from now
+    :return: async generator of chunks of text
+    """
+    event = hub.subscribe(user.pk, AsyncEvent())
+    try:
+        if cursor is None:
+            cursor = (await LedgerEntry.objects.aaggregate(last=Max('id')))['last'] or 0
+        chunk, cursor = await sync_to_async(_changes)(user, cursor, balances=True)
+        yield 'retry: %d\n\n' % RETRY + chunk
+
+        deadline = time.monotonic() + MAX_DURATION
+        while time.monotonic() < deadline:
+            if not await event.wait(HEARTBEAT):
+                yield HEARTBEAT_COMMENT
+                continue
+            event.clear()
+            chunk, cursor = await sync_to_async(_changes)(user, cursor)
+            if chunk:
+                yield chunk
+    finally:
+        hub.unsubscribe(user.pk, event)
+
+
+def _changes(user, cursor, balances=False):
+    """
+    :param balances: True to send the balances even if nothing changed
+    :return: events of the User's ledger entries after the cursor followed by the balances, or nothing if there are
+    none, and the new cursor
+    """
+    start = cursor
+    chunks = []
+    while True:
+        entries = list(LedgerEntry.objects.filter(account__holder=user, id__gt=cursor).order_by('id')
+                       .values_list('id', 'account_id', 'amount', 'date', 'kind', 'receipt_id')[:CHUNK_SIZE])
+        for pk, account_pk, amount, date, kind, receipt_pk in entries:
+            chunks.append(_event('interest' if kind == LedgerEntry.INTEREST else 'transfer', {
+                'account': account_pk,
+                'amount': amount,
+                'date': date.isoformat(),
+                'kind': kind,
+                'receipt': receipt_pk,
+            }, pk))
+        if entries:
+            cursor = entries[-1][0]
+        if len(entries) < CHUNK_SIZE:
+            break
+    if balances or cursor != start:
+        chunks.append(_balances(user))
+    return ''.join(chunks), cursor
+
+
+def _balances(user):
+    return _event('balances', {'accounts': [{'id': account.pk, 'balance': account.total_balance}
+                                            for account in account_cache.holder_accounts(user)]})
+
+
+def _event(name, data, pk=None):
+    lines = 'id: %d\n' % pk if pk is not None else ''
+    return lines + 'event: %s\ndata: %s\n\n' % (name, json.dumps(data, separators=(',', ':')))
@@ -1,2 +1,45 @@
-class InsufficientFunds(Exception):
+class TransferError(Exception):
+    """
+    Base class for the reasons a transfer of funds is refused.
+    """
     pass
+
+
+class InsufficientFunds(TransferError):
+    pass
+
+
+class InvalidAmount(TransferError):
+    pass  # Amount to transfer is not positive
+
+
+class InvalidAccount(TransferError):
+    pass  # Account does not exist or is not held by the User making the transfer
+
+
+class SameAccount(TransferError):
+    pass  # Transfer from an Account to itself
+
+
+class NotCheckingAccount(TransferError):
+    pass  # Payments must be made from a Checking Account
+
+
+class InvalidPayee(TransferError):
+    pass  # User receiving a payment does not exist
+
+
+class SelfPayment(TransferError):
+    pass  # User is paying himself
+
+
+class NoCheckingAccount(TransferError):
+    pass  # User receiving a payment has no Checking Account to receive it
+
+
+class VelocityLimitExceeded(TransferError):
+    pass  # Payment would send more, or more often, than a velocity rule allows (see bank_accounts.velocity)
+
+
+class ConcurrentUpdate(Exception):
+    pass  # Account kept changing while we tried to update it (see bank_accounts.versioning)
@@ -0,0 +1,160 @@
+# Receipt exports
+# Streams a User's transfer history as CSV or JSON Lines. Rows are read with a server-side iterator and written out one
+# at a time, so memory use stays the same no matter how long the history is. Receipts archived (see bank_accounts.archive)
+# are read first, being the oldest, unless the date range starts after them.
+
+import csv
+import datetime
+import json
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import InternalTransferReceipt, ExternalTransferReceipt
+from . import archive
+
+# Rows fetched from the database at a time
+CHUNK_SIZE = 2000
+
+CSV = 'csv'
+JSONL = 'jsonl'
+CONTENT_TYPES = {
+    CSV: 'text/csv',
+    JSONL: 'application/x-ndjson',
+}
+
+INTERNAL_FIELDS = ['id', 'date', 'amount', 'from_account', 'to_account']
+EXTERNAL_FIELDS = ['id', 'date', 'amount', 'direction', 'payer', 'payee', 'from_account', 'to_account', 'comment']
+
+# Shown in place of Accounts and Users deleted since the transfer, as in the receipt list templates
+DELETED_ACCOUNT = 'Deleted Account'
+DELETED_USER = 'Deleted User'
+
+
+def internal_rows(user, account_pk=None, start=None, end=None):
+    """
+    Generates a User's internal transfers, oldest first.
+    :param user:
+    :param account_pk: only transfers from or to this Account
+    :param start: only transfers at or after this datetime
+    :param end: only transfers before this datetime
+    :return: generator of dicts with INTERNAL_FIELDS
+    """
+    for model in archive.receipt_models(InternalTransferReceipt, start):
+        receipts = _filter(model.objects.filter(user=user), account_pk, start, end)\
+            .values_list('id', 'date', 'amount', 'from_account_id', 'from_account__account_type',
+                         'to_account_id', 'to_account__account_type')
+
+        for pk, date, amount, from_pk, from_type, to_pk, to_type in receipts.iterator(chunk_size=CHUNK_SIZE):
+            yield {
+                'id': pk,
+                'date': date.isoformat(),
+                'amount': amount,
+                'from_account': _account_label(from_pk, from_type),
+                'to_account': _account_label(to_pk, to_type),
+            }
+
+
+def external_rows(user, account_pk=None, start=None, end=None):
+    """
+    Generates the payments a User sent or received, oldest first.
+    :param user:
+    :param account_pk: only payments from or to this Account
+    :param start: only payments at or after this datetime
+    :param end: only payments before this datetime
+    :return: generator of dicts with EXTERNAL_FIELDS
+    """
+    for model in archive.receipt_models(ExternalTransferReceipt, start):
+        receipts = model.objects.filter(Q(payer=user) | Q(payee=user))
+        receipts = _filter(receipts, account_pk, start, end)\
+            .values_list('id', 'date', 'amount', 'payer_id', 'payer__username', 'payee__username',
+                         'from_account_id', 'from_account__account_type', 'to_account_id',
+                         'to_account__account_type', 'comment')
+
+        for pk, date, amount, payer_pk, payer, payee, from_pk, from_type, to_pk, to_type, comment in \
+                receipts.iterator(chunk_size=CHUNK_SIZE):
+            yield {
+                'id': pk,
+                'date': date.isoformat(),
+                'amount': amount,
+                'direction': 'sent' if payer_pk == user.pk else 'received',
+                'payer': payer or DELETED_USER,
+                'payee': payee or DELETED_USER,
+                'from_account': _account_label(from_pk, from_type),
+                'to_account': _account_label(to_pk, to_type),
+                'comment': comment,
+            }
+
+
+def render(rows, fields, export_format):
+    """
+    Writes rows out one line at a time.
+    :param rows: iterable of dicts
+    :param fields: names of the columns, in order
+    :param export_format: CSV or JSONL
+    :return: generator of lines of text
+    """
+    if export_format == JSONL:
+        for row in rows:
+            yield json.dumps(row) + '\n'
+        return
+
+    buffer = _Line()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    yield buffer.read()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.read()
+
+
+def parse_bound(value):
+    """
+    Reads a date range bound given as an ISO date (midnight in the current time zone) or datetime.
+    :param value:
+    :return: aware datetime, or None if value is empty
+    :raise ValueError: if value is not a date or datetime
+    """
+    if not value:
+        return None
+    date = parse_datetime(value)
+    if date is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError('Invalid date: %s' % value)
+        date = datetime.datetime.combine(day, datetime.time())
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date
+
+
+def _filter(receipts, account_pk, start, end):
+    if account_pk is not None:
+        receipts = receipts.filter(Q(from_account=account_pk) | Q(to_account=account_pk))
+    if start is not None:
+        receipts = receipts.filter(date__gte=start)
+    if end is not None:
+        receipts = receipts.filter(date__lt=end)
+    return receipts.order_by('date', 'id')
+
+
+def _account_label(pk, account_type):
+    if pk is None or account_type is None:  # Archived receipts keep the pks of deleted Accounts
+        return DELETED_ACCOUNT
+    return account_type + ' Account ' + str(pk)  # Same as Account.__str__
+
+
+class _Line:
+    """
+    File-like object that holds what csv.writer last wrote to it.
+    """
+    def __init__(self):
+        self._text = ''
+
+    def write(self, text):
+        self._text += text
+
+    def read(self):
+        text, self._text = self._text, ''
+        return text
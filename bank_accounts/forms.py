@@ -1,7 +1,7 @@
 # Create Django Form objects here
 
 from django import forms
-from .models import Account
+from .models import Account, RecurringTransfer
 
 # Django Forms have automatic validation dependent on fields
 
@@ -45,11 +45,57 @@ class InternalTransferForm(forms.Form):
     balance = forms.IntegerField()
 
 
+class InternalTransferApiForm(forms.Form):
+    """
+    Internal transfer submitted to the JSON API
+    """
+    from_account = forms.IntegerField()
+    to_account = forms.IntegerField()
+    amount = forms.IntegerField()
+
+
 class ExternalTransferForm(forms.Form):
     """
     Form for making an external transfer between Accounts
     """
     from_account = forms.IntegerField()
-    payee = forms.IntegerField()
+    # The payee is given either by primary key or by username
+    payee = forms.IntegerField(required=False)
+    payee_username = forms.CharField(max_length=150, required=False)
+    amount = forms.IntegerField()
+    comment = forms.CharField(max_length=500, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('payee') is None and not cleaned_data.get('payee_username'):
+            raise forms.ValidationError('Choose a user to pay.')
+        return cleaned_data
+
+
+class RecurringTransferForm(forms.Form):
+    """
+    Form for setting up a standing order
+    """
+    kind = forms.ChoiceField(choices=RecurringTransfer.KIND_CHOICES)
+    from_account = forms.IntegerField()
+    to_account = forms.IntegerField(required=False)  # Internal transfers
+    payee_username = forms.CharField(max_length=150, required=False)  # Payments
     amount = forms.IntegerField()
     comment = forms.CharField(max_length=500, required=False)
+    frequency = forms.ChoiceField(choices=RecurringTransfer.FREQUENCY_CHOICES)
+    first_run = forms.DateTimeField(required=False)  # Defaults to now
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('kind') == RecurringTransfer.INTERNAL_TRANSFER and cleaned_data.get('to_account') is None:
+            raise forms.ValidationError('Choose an account to transfer to.')
+        if cleaned_data.get('kind') == RecurringTransfer.EXTERNAL_TRANSFER and not cleaned_data.get('payee_username'):
+            raise forms.ValidationError('Choose a user to pay.')
+        return cleaned_data
+
+
+class ReceivingAccountForm(forms.Form):
+    """
+    Form for choosing the Checking Account that receives payments
+    """
+    account = forms.IntegerField()
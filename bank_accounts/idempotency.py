@@ -0,0 +1,106 @@
+# Idempotency keys
+# A client that retries a transfer request after a timeout cannot tell if the first attempt went through. If both
+# attempts carry the same Idempotency-Key header (or idempotency_key form field), only the first transfers funds; the
+# retry gets the original receipt back without touching any Account.
+
+# The key is saved in the same transaction as the transfer, and keys are unique per User and kind of transfer, so two
+# concurrent attempts cannot both commit. Only successful transfers are recorded: a refused transfer may be retried with
+# the same key. Keys expire after IDEMPOTENCY_TTL and are deleted by the purge_idempotency_keys command.
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+
+from .lru import LRUCache
+from .models import IdempotencyKey
+from . import routers, velocity
+
+IDEMPOTENCY_TTL = datetime.timedelta(seconds=getattr(settings, 'BANK_ACCOUNTS_IDEMPOTENCY_TTL', 24 * 60 * 60))
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'  # Idempotency-Key request header
+FORM_FIELD = 'idempotency_key'
+
+# Keys this process has seen recently, so most retries don't need the database at all
+_recent = LRUCache(maxsize=getattr(settings, 'BANK_ACCOUNTS_IDEMPOTENCY_CACHE_SIZE', 10000),
+                   ttl=IDEMPOTENCY_TTL.total_seconds())
+
+
+def request_key(request):
+    """
+    :param request:
+    :return: idempotency key of a request, or None if it has none
+    """
+    key = request.META.get(HEADER) or request.POST.get(FORM_FIELD)
+    if key:
+        return key[:IdempotencyKey._meta.get_field('key').max_length]
+    return None
+
+
+def run_once(user, kind, key, transfer):
+    """
+    Runs a transfer unless a transfer with the same key already succeeded.
+    :param user: User making the transfer
+    :param kind: IdempotencyKey.INTERNAL_TRANSFER or IdempotencyKey.EXTERNAL_TRANSFER
+    :param key: idempotency key, or None to always run the transfer
+    :param transfer: function performing the transfer and returning its receipt
+    :return: (receipt id, True if the transfer was a replay)
+    """
+    if not key:
+        return transfer().pk, False
+
+    receipt_id = lookup(user, kind, key)
+    if receipt_id is not None:
+        return receipt_id, True
+
+    try:
+        # Rolling back uncounts the payment from the velocity limits, even once the transfer itself has succeeded
+        with velocity.cancel_on_error(), transaction.atomic(using=routers.primary()):
+            receipt = transfer()
+            IdempotencyKey.objects.create(user=user, kind=kind, key=key, receipt_id=receipt.pk)
+    except IntegrityError:
+        # A concurrent attempt with the same key committed first, so ours was rolled back
+        receipt_id = lookup(user, kind, key)
+        if receipt_id is not None:
+            return receipt_id, True
+        # Or an expired key is still waiting to be purged
+        if IdempotencyKey.objects.filter(user=user, kind=kind, key=key, created__lt=_cutoff()).delete()[0]:
+            return run_once(user, kind, key, transfer)
+        raise
+
+    _recent.set((user.pk, kind, key), receipt.pk)
+    return receipt.pk, False
+
+
+def lookup(user, kind, key):
+    """
+    :param user:
+    :param kind:
+    :param key:
+    :return: receipt id of the transfer that used a key, or None if the key is unused or expired
+    """
+    receipt_id = _recent.get((user.pk, kind, key))
+    if receipt_id is None:
+        # Answered by the unique index on (user, kind, key)
+        receipt_id = IdempotencyKey.objects.filter(user=user, kind=kind, key=key, created__gte=_cutoff())\
+            .values_list('receipt_id', flat=True).first()
+        if receipt_id is not None:
+            _recent.set((user.pk, kind, key), receipt_id)
+    return receipt_id
+
+
+def purge_expired():
+    """
+    Deletes expired keys, on every shard.
+    :return: number of keys deleted
+    """
+    deleted = 0
+    for alias in routers.all_shards():
+        with routers.using_shard(alias):
+            deleted += IdempotencyKey.objects.filter(created__lt=_cutoff()).delete()[0]
+    return deleted
+
+
+def _cutoff():
+    return timezone.now() - IDEMPOTENCY_TTL
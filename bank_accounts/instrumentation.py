@@ -0,0 +1,318 @@
+# Instrumentation
+# InstrumentationMiddleware measures every request: its total latency, the number of SQL queries it issued and the time
+# spent running them, and the time spent rendering templates (with InstrumentedDjangoTemplates as the template
+# backend). Measurements are aggregated in memory, per view, into histograms that metrics_view exposes in the
+# Prometheus text format.
+
+# Views declare how many queries a request may issue, with the query_budget decorator on function views or a
+# query_budget attribute on class-based views. Requests over budget are logged and counted. With the
+# BANK_ACCOUNTS_ENFORCE_QUERY_BUDGETS setting on, as it is in the tests, they raise QueryBudgetExceeded instead, so a
+# change that adds queries to a view fails the build.
+
+# metrics_view shows the histograms only to staff Users, and to scrapers (e.g. Prometheus) at the addresses listed in
+# the BANK_ACCOUNTS_METRICS_ALLOWED_IPS setting.
+
+# Under ASGI, async views run their queries through the async ORM, on a thread Django keeps per request. Queries are
+# counted on that thread, so they are measured the same whether a view is sync or async.
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager, ExitStack
+
+from asgiref.local import Local
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+QUERY_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+# Transaction control isn't counted. Whether it shows up depends on the database backend, and on whether the view runs
+# inside another transaction, as it does in tests.
+UNCOUNTED_STATEMENTS = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+# Histograms reported for each view: (name, description, buckets, Measurement attribute)
+METRICS = (
+    ('request_duration_seconds', 'Time to respond, including streaming the response.', LATENCY_BUCKETS, 'latency'),
+    ('request_queries', 'SQL queries issued per request.', QUERY_BUCKETS, 'queries'),
+    ('request_db_seconds', 'Time spent running SQL queries per request.', LATENCY_BUCKETS, 'db_time'),
+    ('request_template_seconds', 'Time spent rendering templates per request.', LATENCY_BUCKETS, 'template_time'),
+)
+
+_histograms = {}  # Histograms by view name, then metric name. Per process.
+_budget_exceeded = {}  # Number of requests over budget by view name
+_lock = threading.Lock()
+_local = Local()  # Measurements in progress on this thread, or this task under ASGI
+
+
+class QueryBudgetExceeded(Exception):
+    pass  # A view issued more queries than its budget
+
+
+def query_budget(queries):
+    """
+    Decorator declaring the most queries a function view may issue per request, counting those of the middleware
+    (e.g. loading the session and User).
+    :param queries:
+    :return:
+    """
+    def decorator(view):
+        view.query_budget = queries
+        return view
+    return decorator
+
+
+class Measurement:
+    """
+    Queries and time spent by a request, or any other block of code (see measure).
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+
+    @property
+    def latency(self):
+        return time.perf_counter() - self.start
+
+    def __call__(self, execute, sql, params, many, context):  # Database execute wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            if not sql.startswith(UNCOUNTED_STATEMENTS):
+                self.queries += 1
+
+
+@contextmanager
+def measure(measurement=None):
+    """
+    Measures the queries and template rendering of a block of code on this thread, on every database.
+    Measurements may be nested, e.g. in a test of a view.
+    :param measurement: Measurement to add to, defaults to a new one
+    :return: context manager giving the Measurement
+    """
+    measurement = measurement or Measurement()
+    if not hasattr(_local, 'measurements'):
+        _local.measurements = []
+    _local.measurements.append(measurement)
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(measurement))
+            yield measurement
+    finally:
+        _local.measurements.remove(measurement)
+
+
+@asynccontextmanager
+async def ameasure(measurement=None):
+    """
+    Like measure, for async code. Measures the queries run on the thread that the async ORM runs the current task's
+    queries on (one per request under ASGI), and the templates rendered by the task.
+    :param measurement: Measurement to add to, defaults to a new one
+    :return: async context manager giving the Measurement
+    """
+    stack = ExitStack()
+    measurement = await sync_to_async(stack.enter_context)(measure(measurement))
+    try:
+        yield measurement
+    finally:
+        await sync_to_async(stack.close)()
+
+
+def record(view, measurement, budget=None):
+    """
+    Adds a finished request to the histograms of its view, and checks it against the view's query budget.
+    :param view: name of the view
+    :param measurement:
+    :param budget: most queries allowed, or None for no limit
+    :return:
+    """
+    with _lock:
+        histograms = _histograms.get(view)
+        if histograms is None:
+            histograms = _histograms[view] = {name: Histogram(buckets) for name, _, buckets, _ in METRICS}
+        for name, _, _, attribute in METRICS:
+            histograms[name].observe(getattr(measurement, attribute))
+        if budget is not None and measurement.queries > budget:
+            _budget_exceeded[view] = _budget_exceeded.get(view, 0) + 1
+
+    if budget is not None and measurement.queries > budget:
+        message = '%s issued %d queries, over its budget of %d' % (view, measurement.queries, budget)
+        if getattr(settings, 'BANK_ACCOUNTS_ENFORCE_QUERY_BUDGETS', False):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+def render_metrics():
+    """
+    :return: lines of the histograms in the Prometheus text format
+    """
+    with _lock:
+        snapshot = {view: {name: histogram.copy() for name, histogram in histograms.items()}
+                    for view, histograms in _histograms.items()}
+        exceeded = dict(_budget_exceeded)
+
+    lines = []
+    for name, description, buckets, _ in METRICS:
+        metric = 'bank_accounts_' + name
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s histogram' % metric)
+        for view in sorted(snapshot):
+            histogram = snapshot[view][name]
+            for bound, count in histogram.cumulative():
+                lines.append('%s_bucket{view="%s",le="%s"} %d' % (metric, view, bound, count))
+            lines.append('%s_sum{view="%s"} %s' % (metric, view, histogram.sum))
+            lines.append('%s_count{view="%s"} %d' % (metric, view, histogram.count))
+
+    lines.append('# TYPE bank_accounts_query_budget_exceeded_total counter')
+    for view in sorted(exceeded):
+        lines.append('bank_accounts_query_budget_exceeded_total{view="%s"} %d' % (view, exceeded[view]))
+    return lines
+
+
+def can_read_metrics(request):
+    """
+    :param request:
+    :return: True if the request comes from an allowed address, or else from a staff User
+    """
+    if request.META.get('REMOTE_ADDR') in getattr(settings, 'BANK_ACCOUNTS_METRICS_ALLOWED_IPS', []):
+        return True
+    return request.user.is_staff
+
+
+def reset():
+    """
+    Forgets every measurement recorded by this process.
+    :return:
+    """
+    with _lock:
+        _histograms.clear()
+        _budget_exceeded.clear()
+
+
+class Histogram:
+    """
+    Counts of observed values falling at or under each bucket's upper bound.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is unbounded
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, number of values at or under it), ending with "+Inf"
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+
+class InstrumentationMiddleware:
+    """
+    Measures each request and records it under the name of the view that handled it. Place it first in MIDDLEWARE so
+    the queries of every other middleware are counted too. Runs synchronously or, under ASGI, asynchronously.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+        measurement = Measurement()
+        with measure(measurement):
+            response = self.get_response(request)
+        return self._record(request, response, measurement)
+
+    async def _acall(self, request):
+        measurement = Measurement()
+        async with ameasure(measurement):
+            response = await self.get_response(request)
+        return self._record(request, response, measurement)
+
+    def _record(self, request, response, measurement):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        budget = getattr(request, 'query_budget', None)
+
+        if response.streaming:  # Queries run as the response is sent, so measure until it has been
+            stream = self._astream if response.is_async else self._stream
+            response.streaming_content = stream(response.streaming_content, measurement, view, budget)
+        else:
+            record(view, measurement, budget)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        budget = getattr(view_func, 'query_budget', None)
+        if budget is None and hasattr(view_func, 'view_class'):  # Class-based view
+            budget = getattr(view_func.view_class, 'query_budget', None)
+        request.query_budget = budget
+
+    def _stream(self, content, measurement, view, budget):
+        with measure(measurement):
+            yield from content
+        record(view, measurement, budget)
+
+    async def _astream(self, content, measurement, view, budget):
+        async with ameasure(measurement):
+            async for chunk in content:
+                yield chunk
+        record(view, measurement, budget)
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """
+    Django template backend that adds the time spent rendering to the measurements in progress.
+    """
+    def from_string(self, template_code):
+        return _TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return _TimedTemplate(super().get_template(template_name))
+
+
+class _TimedTemplate:
+    def __init__(self, template):
+        self._template = template
+
+    def __getattr__(self, name):
+        return getattr(self._template, name)
+
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return self._template.render(context, request)
+        finally:
+            elapsed = time.perf_counter() - start
+            for measurement in getattr(_local, 'measurements', ()):
+                measurement.template_time += elapsed
@@ -0,0 +1,113 @@
+# Interest
+# Credits monthly interest to every Savings Account, a chunk of Accounts at a time. For each chunk the balances are read
+# in one query, the interest of the whole chunk is computed at once (with NumPy when it is installed), and the results
+# are written with one UPDATE per few hundred Accounts, bulk INSERTs of InterestAccruals and ledger entries, and
+# increments of the daily rollups (see bank_accounts.rollups).
+
+# Each Account is credited at most once per period: its InterestAccrual for the period is saved in the same transaction
+# as the credit, and Accounts that already have one are skipped. Accruing a period again therefore picks up where an
+# interrupted run stopped, and otherwise changes nothing.
+
+# Interest is whole dollars, rounded down, on the balance including balance slots. Accounts earning nothing get no
+# InterestAccrual, so they are looked at again if the period is accrued again.
+
+# Every shard's Savings Accounts are credited in turn (see bank_accounts.routers).
+
+from decimal import Decimal
+from fractions import Fraction
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum, OuterRef, Subquery, Exists, Value, IntegerField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, interest is computed in pure Python without it
+    numpy = None
+
+from .models import Account, BalanceSlot, InterestAccrual
+from .batch import apply_deltas
+from . import ledger, rollups, account_cache, routers
+
+# Yearly interest rate of Savings Accounts, e.g. "0.01" for 1%
+ANNUAL_RATE = Decimal(str(getattr(settings, 'BANK_ACCOUNTS_INTEREST_RATE', '0.01')))
+
+# Accounts read and credited per transaction
+CHUNK_SIZE = 5000
+
+
+def current_period(now=None):
+    """
+    :param now: datetime, defaults to now
+    :return: accrual period containing a datetime, as YYYY-MM
+    """
+    return timezone.localtime(now or timezone.now()).strftime('%Y-%m')
+
+
+def compute(balances, rate, use_numpy=None):
+    """
+    Computes the interest of many balances at once: balance * rate rounded down, 0 for balances below zero.
+    The arithmetic is exact integer arithmetic, so NumPy and pure Python give the same results.
+    :param balances: list of balances
+    :param rate: interest rate of one period, as a Fraction
+    :param use_numpy: False to compute in pure Python even when NumPy is installed
+    :return: list of interest amounts
+    """
+    numerator, denominator = rate.numerator, rate.denominator
+    if numpy is not None and use_numpy is not False:
+        array = numpy.maximum(numpy.asarray(balances, dtype=numpy.int64), 0)
+        return (array * numerator // denominator).tolist()
+    return [max(balance, 0) * numerator // denominator for balance in balances]
+
+
+def accrue(period=None, annual_rate=ANNUAL_RATE, chunk_size=CHUNK_SIZE, use_numpy=None, log=None):
+    """
+    Credits a period's interest to every Savings Account not yet credited for it.
+    :param period: YYYY-MM, defaults to the current month
+    :param annual_rate: yearly interest rate. A month earns a twelfth of it.
+    :param chunk_size: Accounts per transaction
+    :param use_numpy: see compute
+    :param log: function called with progress messages
+    :return: (Accounts credited, total interest credited)
+    """
+    period = period or current_period()
+    rate = Fraction(Decimal(str(annual_rate))) / 12
+    log = log or (lambda message: None)
+
+    accrued = InterestAccrual.objects.filter(account=OuterRef('pk'), period=period)
+    slot_balance = BalanceSlot.objects.filter(account=OuterRef('pk')).order_by().values('account')\
+        .annotate(total=Sum('balance')).values('total')
+    accounts = Account.objects.filter(account_type=Account.SAVINGS).filter(~Exists(accrued))\
+        .annotate(slot_total=Coalesce(Subquery(slot_balance), Value(0), output_field=IntegerField())).order_by('pk')
+
+    credited = total = 0
+    for alias in routers.all_shards():
+        last_pk = 0
+        while True:
+            with routers.using_shard(alias), transaction.atomic(using=alias):
+                rows = list(accounts.select_for_update().filter(pk__gt=last_pk)
+                            .values_list('pk', 'holder_id', 'balance', 'slot_total')[:chunk_size])
+                if not rows:
+                    break
+                last_pk = rows[-1][0]
+
+                balances = [balance + slots for pk, holder_pk, balance, slots in rows]
+                amounts = compute(balances, rate, use_numpy)
+
+                now = timezone.now()
+                accruals = [InterestAccrual(account_id=pk, period=period, balance=balance, amount=amount, date=now)
+                            for (pk, holder_pk, _, _), balance, amount in zip(rows, balances, amounts) if amount > 0]
+                apply_deltas({accrual.account_id: accrual.amount for accrual in accruals})
+                InterestAccrual.objects.bulk_create(accruals, batch_size=400)
+                ledger.record_interest(accruals)
+                rollups.record_interest(accruals)
+                account_cache.invalidate(*[holder_pk for (pk, holder_pk, _, _), amount in zip(rows, amounts)
+                                           if amount > 0])
+
+            credited += len(accruals)
+            total += sum(accrual.amount for accrual in accruals)
+            log('%s: up to Account %d: %d credited, $%d' % (alias, last_pk, credited, total))
+
+    return credited, total
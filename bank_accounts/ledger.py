@@ -0,0 +1,192 @@
+# Ledger
+# Every transfer is recorded as a debit LedgerEntry on the Account paid from and a credit LedgerEntry on the Account
+# paid into, written in the same transaction as the balance change. Together the entries are a single stream, indexed
+# by (account, date), that can be replayed or audited.
+
+# Balances at a point in time come from BalanceCheckpoints: the latest checkpoint at or before that time plus the
+# entries dated after it. An opening checkpoint is written when an Account is created, and the ledger_checkpoint
+# command adds new ones periodically, so only a short tail of entries is ever summed.
+
+# Each shard keeps the ledger of its Accounts (see bank_accounts.routers). Checkpointing and migrating go over every
+# shard.
+
+import datetime
+
+from django.db.models import Sum, Count, Min, OuterRef, Subquery, Exists, F, Value, IntegerField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Account, InternalTransferReceipt, ExternalTransferReceipt, LedgerEntry, BalanceCheckpoint, \
+    BalanceSlot
+from . import routers
+
+# Entries newer than this are left out of new checkpoints, so transfers still committing when a checkpoint is taken
+# are not missed
+CHECKPOINT_LAG = datetime.timedelta(minutes=1)
+
+
+def record_transfers(kind, receipts):
+    """
+    Adds the debit and credit entries of transfers to the ledger, in one INSERT.
+    :param kind: LedgerEntry.INTERNAL_TRANSFER or LedgerEntry.EXTERNAL_TRANSFER
+    :param receipts: saved receipts of the transfers. A side without an Account, e.g. on another shard, gets no entry.
+    :return: number of entries written
+    """
+    entries = []
+    for receipt in receipts:
+        if receipt.from_account_id is not None:
+            entries.append(LedgerEntry(account_id=receipt.from_account_id, amount=-receipt.amount, date=receipt.date,
+                                       kind=kind, receipt_id=receipt.pk))
+        if receipt.to_account_id is not None:
+            entries.append(LedgerEntry(account_id=receipt.to_account_id, amount=receipt.amount, date=receipt.date,
+                                       kind=kind, receipt_id=receipt.pk))
+    LedgerEntry.objects.bulk_create(entries, batch_size=400)
+    return len(entries)
+
+
+def record_interest(accruals):
+    """
+    Adds the credit entries of interest to the ledger.
+    :param accruals: saved InterestAccruals
+    :return:
+    """
+    LedgerEntry.objects.bulk_create([LedgerEntry(account_id=accrual.account_id, amount=accrual.amount,
+                                                 date=accrual.date, kind=LedgerEntry.INTEREST, receipt_id=accrual.pk)
+                                     for accrual in accruals], batch_size=400)
+
+
+def open_account(account, date=None):
+    """
+    Writes the opening checkpoint of a new Account.
+    :param account:
+    :param date: when the Account opened, defaults to now
+    :return:
+    """
+    BalanceCheckpoint.objects.create(account=account, date=date or timezone.now(), balance=account.balance)
+
+
+def balance_at(account_pk, when):
+    """
+    Computes the balance an Account had at a point in time from its nearest earlier checkpoint and the entries since.
+    :param account_pk:
+    :param when: datetime
+    :return: balance, 0 if the Account did not exist yet
+    """
+    checkpoint = BalanceCheckpoint.objects.filter(account_id=account_pk, date__lte=when).order_by('-date').first()
+    if checkpoint is None:
+        return 0
+
+    tail = LedgerEntry.objects.filter(account_id=account_pk, date__gt=checkpoint.date, date__lte=when)
+    return checkpoint.balance + (tail.aggregate(total=Sum('amount'))['total'] or 0)
+
+
+def checkpoint_accounts(cutoff=None, min_entries=1, chunk_size=1000):
+    """
+    Writes a new checkpoint at cutoff for every Account with at least min_entries entries since its latest checkpoint,
+    on every shard.
+    :param cutoff: datetime of the new checkpoints, defaults to CHECKPOINT_LAG ago
+    :param min_entries: Accounts with fewer new entries keep their current checkpoint. 0 checkpoints every Account.
+    :param chunk_size: Accounts handled per query
+    :return: number of checkpoints written
+    :raise ValueError: if min_entries is negative
+    """
+    if min_entries < 0:
+        raise ValueError('min_entries must be at least 0.')
+    if cutoff is None:
+        cutoff = timezone.now() - CHECKPOINT_LAG
+
+    written = 0
+    for alias in routers.all_shards():
+        with routers.using_shard(alias):
+            written += _checkpoint_accounts(cutoff, min_entries, chunk_size)
+    return written
+
+
+def _checkpoint_accounts(cutoff, min_entries, chunk_size):
+    """
+    Checkpoints the Accounts of the current shard.
+    :return: number of checkpoints written
+    """
+    latest = BalanceCheckpoint.objects.filter(account=OuterRef('pk'), date__lte=cutoff).order_by('-date')
+    tail = LedgerEntry.objects.filter(account=OuterRef('pk'), date__gt=OuterRef('checkpoint_date'),
+                                      date__lte=cutoff).order_by().values('account')
+
+    written = 0
+    last_pk = 0
+    while True:
+        accounts = Account.objects.filter(pk__gt=last_pk).order_by('pk')\
+            .annotate(checkpoint_date=Subquery(latest.values('date')[:1]),
+                      checkpoint_balance=Subquery(latest.values('balance')[:1]))\
+            .annotate(tail_total=Subquery(tail.annotate(total=Sum('amount')).values('total')),
+                      tail_count=Subquery(tail.annotate(count=Count('id')).values('count')))\
+            .values_list('pk', 'checkpoint_date', 'checkpoint_balance', 'tail_total', 'tail_count')[:chunk_size]
+        accounts = list(accounts)
+        if not accounts:
+            return written
+
+        checkpoints = [BalanceCheckpoint(account_id=pk, date=cutoff, balance=balance + (total or 0))
+                       for pk, date, balance, total, count in accounts
+                       if date is not None and (count or 0) >= min_entries]
+        BalanceCheckpoint.objects.bulk_create(checkpoints)
+        written += len(checkpoints)
+        last_pk = accounts[-1][0]
+
+
+def migrate_receipts(chunk_size=2000):
+    """
+    Adds ledger entries for receipts saved before the ledger existed, and opening checkpoints for Accounts that have
+    none, on every shard. Running it again only adds what is still missing.
+    :param chunk_size: receipts read per query
+    :return: (entries written, opening checkpoints written)
+    """
+    entries = checkpoints = 0
+    for alias in routers.all_shards():
+        with routers.using_shard(alias):
+            shard_entries, shard_checkpoints = _migrate_receipts(chunk_size)
+        entries += shard_entries
+        checkpoints += shard_checkpoints
+    return entries, checkpoints
+
+
+def _migrate_receipts(chunk_size):
+    """
+    Migrates the receipts and Accounts of the current shard.
+    :return: (entries written, opening checkpoints written)
+    """
+    entries = 0
+    for kind, model in ((LedgerEntry.INTERNAL_TRANSFER, InternalTransferReceipt),
+                        (LedgerEntry.EXTERNAL_TRANSFER, ExternalTransferReceipt)):
+        recorded = LedgerEntry.objects.filter(kind=kind, receipt_id=OuterRef('pk'))
+        receipts = model.objects.filter(~Exists(recorded)).order_by('pk')\
+            .only('pk', 'from_account_id', 'to_account_id', 'amount', 'date')
+        last_pk = 0
+        while True:
+            # Walk by pk: receipts whose Accounts were both deleted get no entries, so they never drop out of receipts
+            chunk = list(receipts.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            entries += record_transfers(kind, chunk)
+            last_pk = chunk[-1].pk
+
+    # An Account's opening balance is whatever its current balance, including funds in its slots (see
+    # bank_accounts.slots), isn't explained by its entries
+    slot_balance = BalanceSlot.objects.filter(account=OuterRef('pk')).order_by().values('account')\
+        .annotate(total=Sum('balance')).values('total')
+    total_balance = F('balance') + Coalesce(Subquery(slot_balance), Value(0), output_field=IntegerField())
+    totals = {row['account']: row for row in
+              LedgerEntry.objects.filter(account__isnull=False).values('account')
+              .annotate(total=Sum('amount'), first=Min('date'))}
+    now = timezone.now()
+    checkpoints = []
+    for account_pk, balance in Account.objects.filter(balance_checkpoints__isnull=True)\
+            .annotate(total_balance=total_balance).values_list('pk', 'total_balance'):
+        row = totals.get(account_pk)
+        if row is None:
+            checkpoints.append(BalanceCheckpoint(account_id=account_pk, date=now, balance=balance))
+        else:
+            checkpoints.append(BalanceCheckpoint(account_id=account_pk,
+                                                 date=row['first'] - datetime.timedelta(microseconds=1),
+                                                 balance=balance - row['total']))
+    BalanceCheckpoint.objects.bulk_create(checkpoints, batch_size=400)
+
+    return entries, len(checkpoints)
@@ -0,0 +1,161 @@
+# Load test
+# Replays a mix of page views, searches, exports and transfers against the views in bank_accounts/urls.py, in process,
+# through Django's test client. Requests are made on behalf of Users picked at random from the database, each logged in
+# with its own session. Every request's latency and number of queries is recorded per view, so the effect of a change
+# on each view can be measured against data generated with the generate_bank_data command. A request failing with a
+# database error (e.g. SQLite's "database is locked" under contention) counts as an error, like a 500 response would.
+
+import json
+import random
+import uuid
+
+from django.db import DatabaseError
+from django.test import Client
+from django.urls import reverse
+
+from .benchmarks import percentile
+from .models import Account
+from . import instrumentation
+
+# Relative frequency of each request. Keys are a URL name from bank_accounts/urls.py and an HTTP method. Leaves out
+# metrics, which Users (not being staff) may not read.
+DEFAULT_MIX = {
+    'home GET': 5,
+    'account_list GET': 15,
+    'account_detail GET': 15,
+    'create GET': 1,
+    'update GET': 1,
+    'delete GET': 1,
+    'internal_transfer GET': 4,
+    'internal_transfer POST': 6,
+    'internal_transfer_receipt_list GET': 8,
+    'internal_transfer_export GET': 1,
+    'external_transfer GET': 4,
+    'external_transfer POST': 8,
+    'payee_search GET': 8,
+    'external_transfer_receipt_list GET': 8,
+    'external_transfer_export GET': 1,
+    'batch_transfer POST': 1,
+    'spending GET': 2,
+    'top_payees GET': 2,
+}
+
+# Transfers made by each batch_transfer request
+BATCH_SIZE = 10
+
+
+def run(requests=1000, sessions=20, mix=None, seed=None):
+    """
+    Makes requests as a random mix of logged in Users. POST requests transfer real funds between their Accounts.
+    :param requests: number of requests to make
+    :param sessions: number of Users making them
+    :param mix: dict of relative frequency by request, defaults to DEFAULT_MIX
+    :param seed: seed of the random number generator, for repeatable runs
+    :return: list of dicts, one per request kind: name, requests, errors (responses with status 400 or more), p50,
+    p95 and p99 latency in milliseconds, mean and max queries per request
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    users = _pick_sessions(rng, sessions)
+    if not users:
+        raise ValueError('No Users with Accounts to make requests as. Run generate_bank_data first.')
+
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    queries = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+
+    for name in rng.choices(names, weights, k=requests):
+        session = rng.choice(users)
+        method, path, data, content_type = _request(rng, name, session, users)
+
+        with instrumentation.measure() as measurement:
+            try:
+                if method == 'GET':
+                    response = session['client'].get(path, data)
+                elif content_type:
+                    response = session['client'].post(path, data, content_type=content_type)
+                else:
+                    response = session['client'].post(path, data)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                status = response.status_code
+            except DatabaseError:
+                status = 500
+            latencies[name].append(measurement.latency * 1000)
+
+        queries[name].append(measurement.queries)
+        if status >= 400:
+            errors[name] += 1
+
+    return [{'name': name,
+             'requests': len(latencies[name]),
+             'errors': errors[name],
+             'p50': percentile(latencies[name], 0.5),
+             'p95': percentile(latencies[name], 0.95),
+             'p99': percentile(latencies[name], 0.99),
+             'queries': sum(queries[name]) / len(queries[name]),
+             'max_queries': max(queries[name])}
+            for name in names if latencies[name]]
+
+
+def _pick_sessions(rng, count):
+    """
+    Logs in random Users that hold Accounts. Picks by random primary key, so it stays fast on millions of Accounts.
+    :return: list of dicts with each User's test client, username and Accounts
+    """
+    holders = Account.objects.filter(holder__isnull=False)
+    first = holders.order_by('pk').values_list('pk', flat=True).first()
+    last = holders.order_by('-pk').values_list('pk', flat=True).first()
+    if first is None:
+        return []
+
+    users = {}
+    for attempt in range(count * 10):
+        if len(users) == count:
+            break
+        account = holders.filter(pk__gte=rng.randint(first, last)).order_by('pk').select_related('holder').first()
+        users[account.holder_id] = account.holder
+
+    sessions = []
+    for user in users.values():
+        client = Client()
+        client.force_login(user)
+        accounts = list(Account.objects.filter(holder=user).order_by('pk').values_list('pk', 'account_type'))
+        checking = [pk for pk, account_type in accounts if account_type == Account.CHECKING]
+        sessions.append({'client': client, 'username': user.username, 'accounts': [pk for pk, _ in accounts],
+                         'checking': checking[0] if checking else accounts[0][0]})
+    return sessions
+
+
+def _request(rng, name, session, sessions):
+    """
+    Builds a request of the given kind.
+    :return: (method, path, data, content type or None for form data)
+    """
+    url_name, method = name.split()
+    accounts = session['accounts']
+    payee = rng.choice(sessions)['username']
+
+    if url_name in ('account_detail', 'update', 'delete'):
+        return method, reverse('bank_accounts:' + url_name, kwargs={'pk': rng.choice(accounts)}), {}, None
+
+    path = reverse('bank_accounts:' + url_name)
+    data = {}
+    if name == 'internal_transfer POST':
+        from_account, to_account = rng.sample(accounts, 2) if len(accounts) > 1 else (accounts[0], accounts[0])
+        data = {'from_account': from_account, 'to_account': to_account, 'balance': rng.randint(1, 20),
+                'idempotency_key': uuid.uuid4().hex}
+    elif name == 'external_transfer POST':
+        data = {'from_account': session['checking'], 'payee_username': payee, 'amount': rng.randint(1, 20),
+                'comment': 'Load test', 'idempotency_key': uuid.uuid4().hex}
+    elif name == 'batch_transfer POST':
+        transfers = [{'type': 'internal', 'from_account': rng.choice(accounts), 'to_account': rng.choice(accounts),
+                      'amount': rng.randint(1, 20)} for _ in range(BATCH_SIZE)]
+        return method, path, json.dumps(transfers), 'application/json'
+    elif url_name == 'payee_search':
+        data = {'q': payee[:rng.randint(1, len(payee))]}
+    elif url_name.endswith('_export'):
+        data = {'format': rng.choice(['csv', 'jsonl'])}
+    return method, path, data, None
@@ -0,0 +1,21 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from bank_accounts import interest
+
+
+class Command(BaseCommand):
+    help = 'Credits a month of interest to every Savings Account. Safe to run again: Accounts already credited for ' \
+           'the month are skipped, so an interrupted run can be resumed. Run monthly.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', help='Month to accrue, as YYYY-MM. Defaults to the current month.')
+        parser.add_argument('--rate', type=Decimal, default=interest.ANNUAL_RATE,
+                            help='Yearly interest rate, e.g. 0.01 for 1%%')
+        parser.add_argument('--chunk-size', type=int, default=interest.CHUNK_SIZE, help='Accounts per transaction')
+
+    def handle(self, *args, **options):
+        credited, total = interest.accrue(period=options['period'], annual_rate=options['rate'],
+                                          chunk_size=options['chunk_size'], log=self.stdout.write)
+        self.stdout.write('Credited $%d of interest to %d accounts.' % (total, credited))
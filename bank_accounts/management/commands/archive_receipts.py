@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from bank_accounts import archive
+
+
+class Command(BaseCommand):
+    help = 'Moves receipts older than BANK_ACCOUNTS_ARCHIVE_AFTER days into the archive tables, keeping the receipt ' \
+           'tables small. Receipt lists and exports still show archived receipts. Safe to run at any time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=archive.CHUNK_SIZE,
+                            help='Receipts moved per transaction')
+
+    def handle(self, *args, **options):
+        internal, external = archive.archive(options['chunk_size'], log=self.stdout.write)
+        self.stdout.write('%d internal and %d external transfer receipts archived.' % (internal, external))
@@ -0,0 +1,53 @@
+import threading
+
+from django.core.management.base import BaseCommand
+
+from bank_accounts import versioning
+from bank_accounts.benchmarks import benchmark_database, run_threads
+from bank_accounts.exceptions import ConcurrentUpdate
+from bank_accounts.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Measures Account read-modify-writes in the optimistic and pessimistic modes, with more or less ' \
+           'contention. Runs against a throwaway test database. SQLite has no row locks, so there the pessimistic ' \
+           'mode relies on the whole database being locked for each write.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', default='1,4,16,64',
+                            help='Comma separated numbers of Accounts the writers share. Fewer means more contention.')
+        parser.add_argument('--writers', type=int, default=8, help='Concurrent writers (threads)')
+        parser.add_argument('--writes', type=int, default=200, help='Writes made by each writer')
+
+    def handle(self, *args, **options):
+        writers, writes = options['writers'], options['writes']
+
+        with benchmark_database():
+            self.stdout.write('mode         accounts  writes/sec  rereads/write  busy retries  gave up')
+            for mode in (versioning.OPTIMISTIC, versioning.PESSIMISTIC):
+                for count in (int(value) for value in options['accounts'].split(',')):
+                    pks = [Account.objects.create(account_type=Account.CHECKING, creator='bench').pk
+                           for _ in range(count)]
+                    attempts = [0]
+                    gave_up = [0]
+                    lock = threading.Lock()
+
+                    def change(account):
+                        with lock:
+                            attempts[0] += 1
+                        return {'balance': account.balance + 1}  # Read-modify-write, lost if not protected
+
+                    def write(worker, number):
+                        try:
+                            versioning.update_account(pks[(worker + number) % count], change, mode=mode)
+                        except ConcurrentUpdate:
+                            with lock:
+                                gave_up[0] += 1
+
+                    seconds, retries = run_threads(writers, writes, write)
+
+                    made = writers * writes - gave_up[0]
+                    total = sum(Account.objects.filter(pk__in=pks).values_list('balance', flat=True))
+                    assert total == made, 'Writes were lost'
+                    self.stdout.write('%-11s  %8d  %10.1f  %13.2f  %12d  %7d' % (
+                        mode, count, made / seconds, (attempts[0] - made) / max(made, 1), retries, gave_up[0]))
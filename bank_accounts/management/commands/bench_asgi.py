@@ -0,0 +1,153 @@
+import asyncio
+import contextlib
+import io
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, close_old_connections
+from django.test import Client, AsyncClient, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from bank_accounts import datagen, sqlite_tuning
+from bank_accounts.benchmarks import benchmark_database, percentile
+from bank_accounts.models import Account
+
+# The async views, see bank_accounts.views
+PAGES = ('home', 'account_list', 'account_detail', 'internal_transfer_receipt_list', 'external_transfer_receipt_list')
+
+
+class Command(BaseCommand):
+    help = 'Compares the throughput of the async views with many clients connected at once, served by a pool of ' \
+           'WSGI worker threads and by the ASGI event loop. Requests go through Django\'s WSGI and ASGI handlers in ' \
+           'process, with the test clients, against a throwaway database file filled with generated data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, nargs='+', default=[10, 100],
+                            help='Clients connected at once, each making requests one after another')
+        parser.add_argument('--threads', type=int, default=8, help='WSGI worker threads')
+        parser.add_argument('--requests', type=int, default=500, help='Requests made to each server')
+        parser.add_argument('--users', type=int, default=200, help='Users to generate')
+        parser.add_argument('--seed', type=int, help='Seed for repeatable data and requests')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The default database is not SQLite.')
+        if max(options['connections']) > options['users']:
+            raise CommandError('Each connection needs its own User, so --users must be at least --connections.')
+
+        # Threads share a database file in WAL mode, so reads don't wait for each other
+        directory = tempfile.mkdtemp()
+        connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'bench.sqlite3')
+
+        setup_test_environment()  # Lets the test clients reach the site
+        try:
+            with override_settings(BANK_ACCOUNTS_SQLITE_PRAGMAS=sqlite_tuning.TUNED), benchmark_database():
+                datagen.generate(users=options['users'], internal_transfers=options['users'] * 10,
+                                 external_transfers=options['users'] * 10, seed=options['seed'],
+                                 log=self.stdout.write)
+                sessions = self.log_in(max(options['connections']), random.Random(options['seed']))
+
+                self.stdout.write('server  workers      connections  requests/sec  p50 ms  p95 ms  errors')
+                for count in options['connections']:
+                    for server, run, workers in (('wsgi', self.run_wsgi, '%d threads' % options['threads']),
+                                                 ('asgi', self.run_asgi, 'event loop')):
+                        seconds, latencies, errors = self.run(run, sessions[:count], options)
+                        self.stdout.write('%-6s  %-11s  %11d  %12.1f  %6.1f  %6.1f  %6d' % (
+                            server, workers, count, len(latencies) / seconds, percentile(latencies, 0.5),
+                            percentile(latencies, 0.95), errors))
+        finally:
+            connections.close_all()
+            teardown_test_environment()
+            shutil.rmtree(directory)
+
+    def log_in(self, count, rng):
+        """
+        :return: list of dicts with a logged in User's sync and async test clients, sharing its session cookie, and
+        the paths of the pages it requests
+        """
+        holders = sorted(set(Account.objects.filter(holder__isnull=False).values_list('holder_id', flat=True)))
+        accounts = Account.objects.filter(holder__isnull=False).select_related('holder').order_by('pk')
+        by_holder = {}
+        for account in accounts.filter(holder_id__in=rng.sample(holders, count)):
+            by_holder.setdefault(account.holder_id, []).append(account)
+
+        sessions = []
+        for held in by_holder.values():
+            client = Client(raise_request_exception=False)
+            client.force_login(held[0].holder)
+            async_client = AsyncClient(raise_request_exception=False)
+            async_client.cookies = client.cookies
+            paths = [reverse('bank_accounts:' + name, kwargs={'pk': held[0].pk} if name == 'account_detail' else {})
+                     for name in PAGES]
+            sessions.append({'client': client, 'async_client': async_client, 'paths': paths})
+        return sessions
+
+    def run(self, run, sessions, options):
+        """
+        Spreads the requests over the sessions, each making its requests one after another.
+        :return: (seconds, latencies in milliseconds, number of responses with status 400 or more)
+        """
+        per_session = [options['requests'] // len(sessions)] * len(sessions)
+        for index in range(options['requests'] % len(sessions)):
+            per_session[index] += 1
+        latencies = []
+        errors = [0]
+        start = time.perf_counter()
+        # Some views print debugging output, and failed requests log their errors, which would bury the report
+        logging.disable(logging.CRITICAL)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                asyncio.run(run(sessions, per_session, latencies, errors, options))
+        finally:
+            logging.disable(logging.NOTSET)
+        return time.perf_counter() - start, latencies, errors[0]
+
+    async def run_wsgi(self, sessions, per_session, latencies, errors, options):
+        """
+        Serves the connections with a pool of worker threads, each handling one request at a time, as a threaded WSGI
+        server does. Requests wait for a free thread.
+        """
+        loop = asyncio.get_running_loop()
+
+        def handle(client, path):
+            try:
+                return client.get(path).status_code
+            finally:
+                close_old_connections()  # As WSGI servers do when a request finishes
+
+        with ThreadPoolExecutor(options['threads']) as pool:
+            async def connect(session, requests):
+                for number in range(requests):
+                    start = time.perf_counter()
+                    status = await loop.run_in_executor(pool, handle, session['client'],
+                                                        session['paths'][number % len(PAGES)])
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    errors[0] += status >= 400
+
+            await asyncio.gather(*[connect(session, requests) for session, requests in zip(sessions, per_session)])
+
+    async def run_asgi(self, sessions, per_session, latencies, errors, options):
+        """
+        Serves the connections on this event loop, as an ASGI server does. Each request runs its synchronous work
+        (the async ORM's queries, sync middleware) on a thread of its own, like Django's ASGI handler.
+        """
+        async def connect(session, requests):
+            for number in range(requests):
+                start = time.perf_counter()
+                async with ThreadSensitiveContext():
+                    try:
+                        response = await session['async_client'].get(session['paths'][number % len(PAGES)])
+                    finally:
+                        await sync_to_async(close_old_connections)()
+                latencies.append((time.perf_counter() - start) * 1000)
+                errors[0] += response.status_code >= 400
+
+        await asyncio.gather(*[connect(session, requests) for session, requests in zip(sessions, per_session)])
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+
+from bank_accounts import slots, transfers
+from bank_accounts.benchmarks import benchmark_database, run_threads
+from bank_accounts.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Measures payment throughput into one hot Account for different numbers of balance slots. ' \
+           'Runs against a throwaway test database. SQLite locks the whole database for each write, so slots ' \
+           'only pay off on databases with row locks, such as PostgreSQL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slots', default='0,1,2,4,8,16', help='Comma separated numbers of balance slots to try')
+        parser.add_argument('--payers', type=int, default=8, help='Concurrent payers (threads)')
+        parser.add_argument('--payments', type=int, default=200, help='Payments made by each payer')
+
+    def handle(self, *args, **options):
+        payers, payments = options['payers'], options['payments']
+
+        with benchmark_database():
+            self.stdout.write('slots  payments/sec  retries')
+            for run, slot_count in enumerate(int(value) for value in options['slots'].split(',')):
+                payee = User.objects.create(username='payee_%d' % run)
+                hot_account = Account.objects.create(account_type=Account.CHECKING, creator='bench', holder=payee)
+                slots.configure(hot_account.pk, slot_count)
+
+                users = []
+                from_accounts = []
+                for payer in range(payers):
+                    user = User.objects.create(username='payer_%d_%d' % (run, payer))
+                    users.append(user)
+                    from_accounts.append(Account.objects.create(account_type=Account.CHECKING, creator='bench',
+                                                                holder=user, balance=payments).pk)
+
+                def pay(worker, number):
+                    transfers.external_transfer(users[worker], from_accounts[worker], payee.pk, 1)
+
+                seconds, retries = run_threads(payers, payments, pay)
+
+                hot_account.refresh_from_db()
+                assert hot_account.total_balance == payers * payments, 'Payments were lost'
+                self.stdout.write('%5d  %12.1f  %7d' % (slot_count, payers * payments / seconds, retries))
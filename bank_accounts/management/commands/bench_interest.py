@@ -0,0 +1,51 @@
+import random
+import time
+from fractions import Fraction
+
+from django.core.management.base import BaseCommand
+
+from bank_accounts import interest
+from bank_accounts.benchmarks import benchmark_database
+from bank_accounts.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Measures interest accrual over many Savings Accounts, with NumPy (when installed) and in pure Python. ' \
+           'Runs against a throwaway test database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', type=int, default=1000000)
+        parser.add_argument('--chunk-size', type=int, default=interest.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        count = options['accounts']
+        balances = [random.randint(0, 100000) for _ in range(count)]
+        rate = Fraction(interest.ANNUAL_RATE) / 12
+
+        # Computing interest alone
+        backends = [('pure Python', False)] + ([('NumPy', True)] if interest.numpy is not None else [])
+        for name, use_numpy in backends:
+            start = time.perf_counter()
+            interest.compute(balances, rate, use_numpy)
+            self.stdout.write('compute, %-11s %8.3f s' % (name, time.perf_counter() - start))
+
+        with benchmark_database():
+            start = time.perf_counter()
+            for offset in range(0, count, 5000):
+                Account.objects.bulk_create([Account(account_type=Account.SAVINGS, creator='bench', balance=balance)
+                                             for balance in balances[offset:offset + 5000]], batch_size=400)
+            self.stdout.write('%d accounts created in %.1f s' % (count, time.perf_counter() - start))
+
+            # Whole accruals, one period per backend, then a repeat that must credit nothing
+            for month, (name, use_numpy) in enumerate(backends, start=1):
+                period = '2000-%02d' % month
+                start = time.perf_counter()
+                credited, total = interest.accrue(period, chunk_size=options['chunk_size'], use_numpy=use_numpy)
+                seconds = time.perf_counter() - start
+                self.stdout.write('accrue,  %-11s %8.3f s  %10.0f accounts/s  %d credited, $%d' % (
+                    name, seconds, count / seconds, credited, total))
+
+            start = time.perf_counter()
+            credited, total = interest.accrue('2000-01', chunk_size=options['chunk_size'])
+            assert credited == 0, 'Accounts credited twice'
+            self.stdout.write('repeat               %8.3f s  nothing credited' % (time.perf_counter() - start))
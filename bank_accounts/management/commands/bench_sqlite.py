@@ -0,0 +1,95 @@
+import contextlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from bank_accounts import datagen, loadtest, sqlite_tuning, workers
+from bank_accounts.benchmarks import benchmark_database
+
+WRITES = ('internal_transfer POST', 'external_transfer POST')
+READS = ('account_detail GET', 'internal_transfer_receipt_list GET', 'external_transfer_receipt_list GET')
+
+
+class Command(BaseCommand):
+    help = 'Compares transfer and read throughput on SQLite with its defaults and with the mysite3.settings_sqlite ' \
+           'profile (WAL, tuned pragmas, persistent connections), with several processes making requests at once ' \
+           'through the test client. Runs against a throwaway database file filled with generated data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4)
+        parser.add_argument('--requests', type=int, default=500, help='Requests made by each process')
+        parser.add_argument('--sessions', type=int, default=10, help='Logged in Users in each process')
+        parser.add_argument('--write-share', type=float, default=0.3, help='Fraction of requests that transfer')
+        parser.add_argument('--users', type=int, default=500, help='Users to generate')
+        parser.add_argument('--seed', type=int, help='Seed for repeatable data')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The default database is not SQLite.')
+        share = options['write_share']
+        mix = dict({name: share / len(WRITES) for name in WRITES},
+                   **{name: (1 - share) / len(READS) for name in READS})
+
+        # Test databases are kept in memory by default, which has no WAL mode and can't be shared between processes
+        directory = tempfile.mkdtemp()
+        database = connection.settings_dict
+        database['TEST']['NAME'] = os.path.join(directory, 'bench.sqlite3')
+        saved = database['CONN_MAX_AGE'], dict(database['OPTIONS'])
+
+        setup_test_environment()  # Lets the test client reach the site
+        try:
+            with benchmark_database():
+                datagen.generate(users=options['users'], internal_transfers=options['users'] * 10,
+                                 external_transfers=options['users'] * 10, seed=options['seed'],
+                                 log=self.stdout.write)
+
+                self.stdout.write('profile   transfers/sec  reads/sec  transfer p50/p95 ms  read p50/p95 ms  errors')
+                for profile, pragmas, max_age, connection_options in (
+                        ('default', {'journal_mode': 'DELETE'}, 0, saved[1]),
+                        ('tuned', sqlite_tuning.TUNED, None, dict(saved[1], transaction_mode='IMMEDIATE'))):
+                    connections.close_all()
+                    database['CONN_MAX_AGE'], database['OPTIONS'] = max_age, connection_options
+                    with override_settings(BANK_ACCOUNTS_SQLITE_PRAGMAS=pragmas):
+                        connection.ensure_connection()  # Sets journal_mode, which the other processes then share
+                        self.report(profile, *self.run(options, mix))
+        finally:
+            connections.close_all()
+            database['CONN_MAX_AGE'], database['OPTIONS'] = saved
+            teardown_test_environment()
+            shutil.rmtree(directory)
+
+    def run(self, options, mix):
+        """
+        :return: (seconds, per process list of loadtest.run results)
+        """
+        start = time.perf_counter()
+        # Some views print debugging output, and failed requests log their errors, which would bury the report
+        logging.disable(logging.CRITICAL)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = workers.run_processes(options['processes'], loadtest.run, options['requests'],
+                                                options['sessions'], mix)
+        finally:
+            logging.disable(logging.NOTSET)
+        return time.perf_counter() - start, results
+
+    def report(self, profile, seconds, results):
+        rows = [row for process in results for row in process]
+        # Percentiles across processes are approximated by the worst process's
+        stats = {}
+        for kinds in (WRITES, READS):
+            kind_rows = [row for row in rows if row['name'] in kinds]
+            stats[kinds] = (sum(row['requests'] for row in kind_rows) / seconds,
+                            max([row['p50'] for row in kind_rows], default=0),
+                            max([row['p95'] for row in kind_rows], default=0))
+        self.stdout.write('%-8s  %13.1f  %9.1f  %8.1f / %-8.1f  %6.1f / %-6.1f  %6d' % (
+            profile, stats[WRITES][0], stats[READS][0], stats[WRITES][1], stats[WRITES][2], stats[READS][1],
+            stats[READS][2], sum(row['errors'] for row in rows)))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from bank_accounts import slots
+
+
+class Command(BaseCommand):
+    help = 'Folds the balance slots of Accounts that use them back into their balance. Run periodically.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account', type=int, help='Only consolidate this Account')
+
+    def handle(self, *args, **options):
+        if options['account']:
+            moved = slots.consolidate(options['account'])
+        else:
+            moved = slots.consolidate_all()
+        self.stdout.write('Moved $%d out of balance slots.' % moved)
@@ -0,0 +1,44 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from bank_accounts import exports
+
+
+class Command(BaseCommand):
+    help = "Exports a User's internal transfers or payments as CSV or JSON Lines, streaming rows from the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['internal', 'external'], help='Internal transfers or payments')
+        parser.add_argument('username', help='User whose history to export')
+        parser.add_argument('--format', choices=[exports.CSV, exports.JSONL], default=exports.CSV)
+        parser.add_argument('--account', type=int, help='Only transfers from or to this Account')
+        parser.add_argument('--start', help='Only transfers at or after this ISO date or datetime')
+        parser.add_argument('--end', help='Only transfers before this ISO date or datetime')
+        parser.add_argument('--output', help='File to write to, instead of standard output')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError('User %s does not exist.' % options['username'])
+        try:
+            start = exports.parse_bound(options['start'])
+            end = exports.parse_bound(options['end'])
+        except ValueError as error:
+            raise CommandError(str(error))
+
+        if options['kind'] == 'internal':
+            rows, fields = exports.internal_rows, exports.INTERNAL_FIELDS
+        else:
+            rows, fields = exports.external_rows, exports.EXTERNAL_FIELDS
+        lines = exports.render(rows(user, options['account'], start, end), fields, options['format'])
+
+        output = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        try:
+            for line in lines:
+                output.write(line)
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from bank_accounts import datagen
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with synthetic Users, Accounts, internal transfers and payments, using bulk inserts. ' \
+           'Ledger entries and balance checkpoints are written too, and balances agree with the transfer history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--accounts-per-user', type=int, default=2, help='Average number of Accounts per User')
+        parser.add_argument('--internal-transfers', type=int, default=5000)
+        parser.add_argument('--external-transfers', type=int, default=5000)
+        parser.add_argument('--days', type=int, default=365, help='Days of history to spread transfers over')
+        parser.add_argument('--max-balance', type=int, default=10000, help='Largest opening balance')
+        parser.add_argument('--mean-amount', type=int, default=50, help='Average amount transferred')
+        parser.add_argument('--payee-skew', type=float, default=1.0,
+                            help='1 picks payees uniformly, higher values concentrate payments on a few popular payees')
+        parser.add_argument('--username-prefix', default='user_')
+        parser.add_argument('--password', default='password', help='Password of every generated User')
+        parser.add_argument('--seed', type=int, help='Seed for repeatable data')
+
+    def handle(self, *args, **options):
+        written = datagen.generate(users=options['users'], accounts_per_user=options['accounts_per_user'],
+                                   internal_transfers=options['internal_transfers'],
+                                   external_transfers=options['external_transfers'], days=options['days'],
+                                   max_balance=options['max_balance'], mean_amount=options['mean_amount'],
+                                   payee_skew=options['payee_skew'], username_prefix=options['username_prefix'],
+                                   password=options['password'], seed=options['seed'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(', '.join('%d %s' % (count, kind.replace('_', ' '))
+                                                       for kind, count in written.items())))
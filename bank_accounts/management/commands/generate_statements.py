@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from bank_accounts import statements
+
+
+class Command(BaseCommand):
+    help = "Writes every Account's statement for a month as HTML and CSV files, in parallel processes. Run it again " \
+           "after a crash to write only the statements still missing."
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Statements are written to a subdirectory per month')
+        parser.add_argument('--period', help='Month as YYYY-MM. Defaults to last month.')
+        parser.add_argument('--processes', type=int, default=4)
+        parser.add_argument('--chunk-size', type=int, default=statements.CHUNK_SIZE,
+                            help='Accounts handed to a process at a time')
+
+    def handle(self, *args, **options):
+        period = options['period'] or statements.previous_period()
+        try:
+            totals = statements.generate(period, options['directory'], options['processes'], options['chunk_size'],
+                                         log=self.stdout.write)
+        except ValueError as error:
+            raise CommandError(str(error))
+        self.stdout.write('%d statements written, %d Accounts skipped in %.1f s (%.0f accounts/s).' % (
+            totals['written'], totals['skipped'], totals['seconds'],
+            (totals['written'] + totals['skipped']) / max(totals['seconds'], 1e-9)))
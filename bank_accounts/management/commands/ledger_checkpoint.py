@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from bank_accounts import ledger
+
+
+class Command(BaseCommand):
+    help = 'Writes balance checkpoints for Accounts with new ledger entries. Run periodically, e.g. hourly.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-entries', type=int, default=1,
+                            help='Only checkpoint Accounts with at least this many entries since their last checkpoint')
+
+    def handle(self, *args, **options):
+        if options['min_entries'] < 0:
+            raise CommandError('--min-entries must be at least 0.')
+        written = ledger.checkpoint_accounts(min_entries=options['min_entries'])
+        self.stdout.write('Wrote %d checkpoints.' % written)
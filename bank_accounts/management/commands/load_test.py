@@ -0,0 +1,51 @@
+import contextlib
+import io
+
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from bank_accounts import datagen, loadtest
+from bank_accounts.benchmarks import benchmark_database
+
+
+class Command(BaseCommand):
+    help = 'Replays a mix of page views and transfers through every bank_accounts view and reports latency ' \
+           'percentiles and queries per request. Runs against a throwaway test database filled with generated data, ' \
+           'unless --existing-data is given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--sessions', type=int, default=20, help='Number of logged in Users making requests')
+        parser.add_argument('--users', type=int, default=1000, help='Users to generate')
+        parser.add_argument('--internal-transfers', type=int, default=10000, help='Internal transfers to generate')
+        parser.add_argument('--external-transfers', type=int, default=10000, help='Payments to generate')
+        parser.add_argument('--payee-skew', type=float, default=1.0)
+        parser.add_argument('--seed', type=int, help='Seed for repeatable data and requests')
+        parser.add_argument('--existing-data', action='store_true',
+                            help='Use the configured database as is. Its Accounts WILL be transferred between.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()  # Lets the test client reach the site
+        try:
+            if options['existing_data']:
+                results = self.run(options)
+            else:
+                with benchmark_database():
+                    datagen.generate(users=options['users'], internal_transfers=options['internal_transfers'],
+                                     external_transfers=options['external_transfers'],
+                                     payee_skew=options['payee_skew'], seed=options['seed'], log=self.stdout.write)
+                    results = self.run(options)
+        finally:
+            teardown_test_environment()
+
+        self.stdout.write('%-36s %8s %6s %9s %9s %9s %8s %8s' % ('request', 'count', 'errors', 'p50 ms', 'p95 ms',
+                                                              'p99 ms', 'queries', 'max'))
+        for row in sorted(results, key=lambda row: row['name']):
+            self.stdout.write('%-36s %8d %6d %9.2f %9.2f %9.2f %8.1f %8d' % (
+                row['name'], row['requests'], row['errors'], row['p50'], row['p95'], row['p99'], row['queries'],
+                row['max_queries']))
+
+    def run(self, options):
+        # Some views print debugging output, which would bury the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            return loadtest.run(requests=options['requests'], sessions=options['sessions'], seed=options['seed'])
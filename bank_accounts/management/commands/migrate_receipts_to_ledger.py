@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from bank_accounts import ledger
+
+
+class Command(BaseCommand):
+    help = 'Adds ledger entries for existing transfer receipts and opening checkpoints for existing Accounts. ' \
+           'Safe to run more than once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Receipts read per query')
+
+    def handle(self, *args, **options):
+        entries, checkpoints = ledger.migrate_receipts(chunk_size=options['chunk_size'])
+        self.stdout.write('Wrote %d ledger entries and %d opening checkpoints.' % (entries, checkpoints))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from bank_accounts import idempotency
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired transfer idempotency keys. Run periodically, e.g. daily.'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Deleted %d expired idempotency keys.' % idempotency.purge_expired())
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from bank_accounts import rollups
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the daily Account totals and payee totals read by analytics from every receipt. Safe to run ' \
+           'while transfers are being made.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Accounts or Users per transaction')
+
+    def handle(self, *args, **options):
+        daily, payees = rollups.rebuild(chunk_size=options['chunk_size'], log=self.stdout.write)
+        self.stdout.write('Wrote %d daily totals and %d payee totals.' % (daily, payees))
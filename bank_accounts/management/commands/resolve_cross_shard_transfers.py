@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from bank_accounts import cross_shard
+
+
+class Command(BaseCommand):
+    help = 'Completes payments between shards left half done, e.g. by a crash. Safe to run at any time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=cross_shard.RESOLVE_AFTER,
+                            help='Seconds since the payment was made, leaving recent payments to complete themselves')
+
+    def handle(self, *args, **options):
+        committed, refunded = cross_shard.resolve(options['older_than'], log=self.stdout.write)
+        self.stdout.write('%d payments committed, %d refunded.' % (committed, refunded))
@@ -0,0 +1,36 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from bank_accounts import recurring, workers
+
+
+class Command(BaseCommand):
+    help = 'Makes the transfers of due standing orders. Several workers may run at once, in one or more ' \
+           'invocations of this command, and share the work.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=recurring.BATCH_SIZE,
+                            help='Standing orders claimed at a time')
+        parser.add_argument('--lease', type=int, default=int(workers.DEFAULT_LEASE.total_seconds()),
+                            help='Seconds a worker may take to make a batch before others may take it over')
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes to run')
+        parser.add_argument('--poll', type=float, default=10,
+                            help='Seconds to wait when nothing is due before looking again')
+        parser.add_argument('--once', action='store_true', help='Exit once nothing is due instead of waiting')
+
+    def handle(self, *args, **options):
+        results = workers.run_processes(options['processes'], work, options['batch_size'], options['lease'],
+                                        options['poll'], options['once'])
+        made, refused = sum(result[0] for result in results), sum(result[1] for result in results)
+        self.stdout.write('Made %d transfers, %d refused.' % (made, refused))
+
+
+def work(batch_size, lease, poll, once):
+    """
+    Runs one worker until nothing is due (with --once) or forever.
+    :return: (transfers made, transfers refused)
+    """
+    worker = workers.new_worker_id()
+    lease = datetime.timedelta(seconds=lease)
+    return workers.run_worker(lambda: recurring.run_due(worker, batch_size, lease), poll, once)
@@ -0,0 +1,36 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from bank_accounts import transfer_queue, workers
+
+
+class Command(BaseCommand):
+    help = 'Makes the payments queued to be made in the background. Several workers may run at once, in one or ' \
+           'more invocations of this command, and share the work.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=transfer_queue.BATCH_SIZE,
+                            help='Payments claimed at a time')
+        parser.add_argument('--lease', type=int, default=int(workers.DEFAULT_LEASE.total_seconds()),
+                            help='Seconds a worker may take to make a batch before others may take it over')
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes to run')
+        parser.add_argument('--poll', type=float, default=1,
+                            help='Seconds to wait when the queue is empty before looking again')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty instead of waiting')
+
+    def handle(self, *args, **options):
+        results = workers.run_processes(options['processes'], work, options['batch_size'], options['lease'],
+                                        options['poll'], options['once'])
+        made, refused = sum(result[0] for result in results), sum(result[1] for result in results)
+        self.stdout.write('Made %d payments, %d refused.' % (made, refused))
+
+
+def work(batch_size, lease, poll, once):
+    """
+    Runs one worker until the queue is empty (with --once) or forever.
+    :return: (payments made, payments refused)
+    """
+    worker = workers.new_worker_id()
+    lease = datetime.timedelta(seconds=lease)
+    return workers.run_worker(lambda: transfer_queue.run_batch(worker, batch_size, lease), poll, once)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from bank_accounts import slots
+from bank_accounts.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Spreads payments into an Account over a number of balance slots. 0 turns balance slots off.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('account', type=int, help='Account primary key')
+        parser.add_argument('slots', type=int, help='Number of balance slots')
+
+    def handle(self, *args, **options):
+        if not Account.objects.filter(pk=options['account']).exists():
+            raise CommandError('Account %d does not exist.' % options['account'])
+        if not 0 <= options['slots'] <= 256:
+            raise CommandError('Number of balance slots must be between 0 and 256.')
+
+        slots.configure(options['account'], options['slots'])
+        self.stdout.write('Account %d now has %d balance slots.' % (options['account'], options['slots']))
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_accounts', '0005_auto_20181105_1230'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='account',
+            name='bank',
+            field=models.CharField(choices=[('UCU', 'UCU'), ('Chase', 'Chase'), ('Wells Fargo', 'Wells Fargo'), ('Bank of America', 'Bank of America')], default='UCU', max_length=200, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='externaltransferreceipt',
+            index=models.Index(fields=['payer', 'date', 'id'], name='external_receipt_payer_date'),
+        ),
+        migrations.AddIndex(
+            model_name='externaltransferreceipt',
+            index=models.Index(fields=['payee', 'date', 'id'], name='external_receipt_payee_date'),
+        ),
+        migrations.AddIndex(
+            model_name='internaltransferreceipt',
+            index=models.Index(fields=['user', 'date', 'id'], name='internal_receipt_user_date'),
+        ),
+    ]
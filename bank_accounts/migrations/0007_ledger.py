@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:10
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_accounts', '0006_receipt_date_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField()),
+                ('balance', models.IntegerField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_checkpoints', to='bank_accounts.account')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['account', 'date'], name='checkpoint_account_date')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField()),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('kind', models.CharField(choices=[('internal', 'Internal transfer'), ('external', 'External transfer')], max_length=20)),
+                ('receipt_id', models.IntegerField(null=True)),
+                ('account', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='bank_accounts.account')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['account', 'date', 'id'], name='ledger_entry_account_date'), models.Index(fields=['kind', 'receipt_id'], name='ledger_entry_receipt')],
+            },
+        ),
+    ]
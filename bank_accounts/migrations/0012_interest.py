@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:41
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_accounts', '0011_transfer_queue'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='kind',
+            field=models.CharField(choices=[('internal', 'Internal transfer'), ('external', 'External transfer'), ('interest', 'Interest')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='InterestAccrual',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(max_length=7)),
+                ('balance', models.IntegerField()),
+                ('amount', models.IntegerField()),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='interest_accruals', to='bank_accounts.account')),
+            ],
+            options={
+                'unique_together': {('account', 'period')},
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_accounts', '0012_interest'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyAccountTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('kind', models.CharField(choices=[('internal', 'Internal transfer'), ('external', 'External transfer'), ('interest', 'Interest')], max_length=20)),
+                ('inflow', models.IntegerField(default=0)),
+                ('outflow', models.IntegerField(default=0)),
+                ('count', models.IntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_totals', to='bank_accounts.account')),
+            ],
+            options={
+                'unique_together': {('account', 'day', 'kind')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PayeeTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField(default=0)),
+                ('count', models.IntegerField(default=0)),
+                ('payee', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('payer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['payer', '-amount'], name='payee_total_payer_amount')],
+                'unique_together': {('payer', 'payee')},
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:09
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_accounts', '0014_account_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrossShardTransfer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transfer_id', models.UUIDField(unique=True)),
+                ('direction', models.CharField(choices=[('outgoing', 'Outgoing'), ('incoming', 'Incoming')], max_length=8)),
+                ('status', models.CharField(choices=[('prepared', 'Prepared'), ('committed', 'Committed'), ('refunded', 'Refunded')], max_length=9)),
+                ('payer_pk', models.IntegerField()),
+                ('payee_pk', models.IntegerField()),
+                ('from_account_pk', models.IntegerField()),
+                ('to_account_pk', models.IntegerField()),
+                ('amount', models.IntegerField()),
+                ('comment', models.CharField(blank=True, max_length=500)),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('receipt_id', models.IntegerField(null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'date'], name='cross_shard_status')],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_accounts', '0015_cross_shard_transfer'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedExternalTransferReceipt',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('amount', models.IntegerField()),
+                ('date', models.DateTimeField()),
+                ('comment', models.CharField(max_length=500)),
+                ('from_account', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='bank_accounts.account')),
+                ('payee', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('payer', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('to_account', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='bank_accounts.account')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['payer', 'date', 'id'], name='archived_external_payer_date'), models.Index(fields=['payee', 'date', 'id'], name='archived_external_payee_date')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedInternalTransferReceipt',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('amount', models.IntegerField()),
+                ('date', models.DateTimeField()),
+                ('from_account', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='bank_accounts.account')),
+                ('to_account', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='bank_accounts.account')),
+                ('user', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'date', 'id'], name='archived_internal_user_date')],
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def receive_in_first_checking_account(apps, schema_editor):
+    """
+    Payments were received in each User's first Checking Account, which stays the default.
+    """
+    Account = apps.get_model('bank_accounts', 'Account')
+    DefaultReceivingAccount = apps.get_model('bank_accounts', 'DefaultReceivingAccount')
+    alias = schema_editor.connection.alias
+    defaults = {}
+    for holder_pk, account_pk in Account.objects.using(alias).filter(holder__isnull=False, account_type='Checking')\
+            .order_by('holder_id', 'pk').values_list('holder_id', 'pk').iterator():
+        defaults.setdefault(holder_pk, account_pk)
+    DefaultReceivingAccount.objects.using(alias).bulk_create(
+        [DefaultReceivingAccount(holder_id=holder_pk, account_id=account_pk)
+         for holder_pk, account_pk in defaults.items()], batch_size=400)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('bank_accounts', '0016_receipt_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DefaultReceivingAccount',
+            fields=[
+                ('holder', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='bank_accounts.account')),
+            ],
+        ),
+        migrations.RunPython(receive_in_first_checking_account, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:18
+
+from django.db import migrations, models
+
+
+def keep_current_day(apps, schema_editor):
+    """
+    Monthly standing orders keep the day of the month they are next due on. Orders moved off their first day by a
+    short month before this can't be told apart, and stay on the day they moved to.
+    """
+    RecurringTransfer = apps.get_model('bank_accounts', 'RecurringTransfer')
+    alias = schema_editor.connection.alias
+    for order in RecurringTransfer.objects.using(alias).filter(frequency='monthly', next_run_at__isnull=False)\
+            .only('pk', 'next_run_at').iterator():
+        RecurringTransfer.objects.using(alias).filter(pk=order.pk).update(day=order.next_run_at.day)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_accounts', '0017_default_receiving_account'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recurringtransfer',
+            name='day',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(keep_current_day, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models  # Python objects that map to the database
+from django.db.models import F, Sum
 from django.contrib.auth.models import Permission, User  # User models from Django Auth
 
 from django.utils import timezone
@@ -59,20 +60,71 @@ class Account(models.Model):
     balance = models.IntegerField(default=0)
     bank = models.CharField(max_length=200, default='UCU', null=True, choices=BANK_CHOICES)
     routing_number = models.IntegerField(null=True)
+    # Number of BalanceSlots deposits are spread over, for Accounts receiving many payments. 0 means none.
+    # Change it with bank_accounts.slots.configure, never directly.
+    balance_slots = models.PositiveSmallIntegerField(default=0)
+    # Incremented by every write to the row, so a write can be made conditional on nothing having changed since the row
+    # was read (see bank_accounts.versioning)
+    version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.account_type + ' Account ' + str(self.id)
 
+    @property
+    def total_balance(self):
+        """
+        Balance including funds waiting in balance slots. This is the balance to show to Users.
+        """
+        if not self.balance_slots:
+            return self.balance
+        slot_balance = getattr(self, 'slot_balance', None)  # Annotated by bank_accounts.account_cache
+        if slot_balance is None:
+            slot_balance = self.slots.aggregate(total=Sum('balance'))['total'] or 0
+        return self.balance + slot_balance
+
+    # Balance arithmetic happens in the database, so concurrent deposits and withdrawals cannot lose updates.
+    # Transfers between Accounts should use bank_accounts.transfers instead, which does both sides atomically.
     def deposit(self, amount):
-        self.balance = self.balance + amount
-        self.save()
+        from .account_cache import invalidate
+        Account.objects.filter(pk=self.pk).update(balance=F('balance') + amount, version=F('version') + 1)
+        invalidate(self.holder_id)
+        self.refresh_from_db(fields=['balance', 'version'])
 
     def withdraw(self, amount):
-        if amount > self.balance:
+        from .account_cache import invalidate
+        # Only withdraw if the balance in the database covers the amount
+        if not Account.objects.filter(pk=self.pk, balance__gte=amount).update(balance=F('balance') - amount,
+                                                                              version=F('version') + 1):
             raise InsufficientFunds()
+        invalidate(self.holder_id)
+        self.refresh_from_db(fields=['balance', 'version'])
+
+
+class BalanceSlot(models.Model):
+    """
+    Each instance holds part of the balance of an Account that uses balance slots (see bank_accounts.slots).
+    """
+    account = models.ForeignKey(to=Account, on_delete=models.CASCADE, related_name='slots')
+    slot = models.PositiveSmallIntegerField()
+    balance = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('account', 'slot'),)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class DefaultReceivingAccount(models.Model):
+    """
+    Each instance names the Checking Account that receives the payments made to a User (see bank_accounts.receiving).
+    Users without a Checking Account have none. An Account receives the payments of at most one User.
+    """
+    holder = models.OneToOneField(to=User, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    account = models.OneToOneField(to=Account, on_delete=models.CASCADE, related_name='+')
 
-        self.balance = self.balance - amount
-        self.save()
+    def __str__(self):
+        return str(self.account_id)
 
 
 class InternalTransferReceipt(models.Model):
@@ -89,6 +141,12 @@ class InternalTransferReceipt(models.Model):
     date = models.DateTimeField(default=timezone.now)  # date of transfer
     # comment = models.CharField(max_length=500)  # User comments on nature of transfer
 
+    class Meta:
+        # Supports paging through a User's history, newest first (see bank_accounts.pagination)
+        indexes = [
+            models.Index(fields=['user', 'date', 'id'], name='internal_receipt_user_date'),
+        ]
+
     def __str__(self):
         return str(self.id)
 
@@ -109,8 +167,332 @@ class ExternalTransferReceipt(models.Model):
     date = models.DateTimeField(default=timezone.now)  # date of transfer
     comment = models.CharField(max_length=500)  # User comment on nature of transfer
 
+    class Meta:
+        # Supports paging through a User's payments sent and received, newest first (see bank_accounts.pagination)
+        indexes = [
+            models.Index(fields=['payer', 'date', 'id'], name='external_receipt_payer_date'),
+            models.Index(fields=['payee', 'date', 'id'], name='external_receipt_payee_date'),
+        ]
+
+    def __str__(self):
+        return str(self.id)
+
+
+class LedgerEntry(models.Model):
+    """
+    Each instance is one side of a movement of funds: a debit (negative amount) or credit (positive amount) of an
+    Account. A transfer adds one debit and one credit, interest only a credit. Entries are only ever added, never
+    changed.
+    """
+    INTERNAL_TRANSFER = 'internal'
+    EXTERNAL_TRANSFER = 'external'
+    INTEREST = 'interest'
+    KIND_CHOICES = (
+        (INTERNAL_TRANSFER, 'Internal transfer'),
+        (EXTERNAL_TRANSFER, 'External transfer'),
+        (INTEREST, 'Interest'),
+    )
+
+    account = models.ForeignKey(to=Account, on_delete=models.SET_NULL, null=True, related_name='ledger_entries')
+    amount = models.IntegerField()  # Change in balance
+    date = models.DateTimeField(default=timezone.now)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # Receipt of the transfer, in the receipt table named by kind (InterestAccrual for interest). Not a foreign key,
+    # so entries outlive receipts.
+    receipt_id = models.IntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['account', 'date', 'id'], name='ledger_entry_account_date'),
+            models.Index(fields=['kind', 'receipt_id'], name='ledger_entry_receipt'),
+        ]
+
     def __str__(self):
         return str(self.id)
 
 
+class BalanceCheckpoint(models.Model):
+    """
+    Each instance is the balance of an Account after every LedgerEntry dated up to and including date.
+    The balance at any time is the nearest earlier checkpoint plus the entries since (see bank_accounts.ledger).
+    """
+    account = models.ForeignKey(to=Account, on_delete=models.CASCADE, related_name='balance_checkpoints')
+    date = models.DateTimeField()
+    balance = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['account', 'date'], name='checkpoint_account_date'),
+        ]
+
+    def __str__(self):
+        return str(self.id)
+
+
+class IdempotencyKey(models.Model):
+    """
+    Each instance records that a transfer request carrying a client-chosen key succeeded, so that retries of the same
+    request return the original result instead of transferring again (see bank_accounts.idempotency).
+    """
+    INTERNAL_TRANSFER = 'internal'
+    EXTERNAL_TRANSFER = 'external'
+    KIND_CHOICES = (
+        (INTERNAL_TRANSFER, 'Internal transfer'),
+        (EXTERNAL_TRANSFER, 'External transfer'),
+    )
+
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    key = models.CharField(max_length=100)
+    receipt_id = models.IntegerField()  # Receipt of the transfer, in the receipt table named by kind
+    created = models.DateTimeField(default=timezone.now, db_index=True)  # Keys expire some time after this
+
+    class Meta:
+        unique_together = (('user', 'kind', 'key'),)
+
+    def __str__(self):
+        return self.key
+
+
+
+class RecurringTransfer(models.Model):
+    """
+    Each instance is a User's standing order: an internal transfer or payment repeated on a schedule.
+    Due transfers are made by the run_recurring_transfers worker (see bank_accounts.recurring).
+    """
+    INTERNAL_TRANSFER = 'internal'
+    EXTERNAL_TRANSFER = 'external'
+    KIND_CHOICES = (
+        (INTERNAL_TRANSFER, 'Internal transfer'),
+        (EXTERNAL_TRANSFER, 'Payment'),
+    )
+
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    MONTHLY = 'monthly'
+    FREQUENCY_CHOICES = (
+        (DAILY, 'Daily'),
+        (WEEKLY, 'Weekly'),
+        (MONTHLY, 'Monthly'),
+    )
+
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE)  # User making the transfers
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    from_account = models.ForeignKey(to=Account, on_delete=models.CASCADE, related_name='+')
+    to_account = models.ForeignKey(to=Account, on_delete=models.CASCADE, null=True, blank=True,
+                                   related_name='+')  # Internal transfers only
+    payee = models.ForeignKey(to=User, on_delete=models.CASCADE, null=True, blank=True,
+                              related_name='+')  # Payments only
+    amount = models.IntegerField()
+    comment = models.CharField(max_length=500, blank=True)
+    frequency = models.CharField(max_length=20, choices=FREQUENCY_CHOICES)
+    # Day of the month monthly transfers fall on, that of the first transfer. Months without it use their last day.
+    day = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    # When the next transfer is due. None once the standing order is cancelled or has stopped after failing.
+    next_run_at = models.DateTimeField(null=True, db_index=True)
+    last_run_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.CharField(max_length=200, blank=True)
+    failures = models.PositiveSmallIntegerField(default=0)  # Failed runs in a row
+
+    # Set by the worker making the transfer (see bank_accounts.workers). The claim lapses after claimed_until.
+    claimed_by = models.CharField(max_length=32, null=True, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    created = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class QueuedTransfer(models.Model):
+    """
+    Each instance is a payment queued to be made in the background by the run_transfer_queue worker, instead of during
+    the request (see bank_accounts.transfer_queue).
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
 
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE)  # User making the payment
+    from_account_pk = models.IntegerField()  # Checked when the payment is made, so may not exist
+    payee = models.ForeignKey(to=User, on_delete=models.SET_NULL, null=True, related_name='+')
+    amount = models.IntegerField()
+    comment = models.CharField(max_length=500, blank=True)
+    idempotency_key = models.CharField(max_length=100, null=True, blank=True)  # Retries of a request queue nothing
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    error = models.CharField(max_length=200, blank=True)  # Why a failed payment was refused
+    receipt_id = models.IntegerField(null=True)  # ExternalTransferReceipt of a payment made
+    created = models.DateTimeField(default=timezone.now)
+    completed = models.DateTimeField(null=True, blank=True)
+
+    # Set by the worker making the payment (see bank_accounts.workers). The claim lapses after claimed_until.
+    claimed_by = models.CharField(max_length=32, null=True, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (('user', 'idempotency_key'),)
+        indexes = [
+            models.Index(fields=['status', 'id'], name='queued_transfer_status'),
+        ]
+
+    def __str__(self):
+        return str(self.id)
+
+
+class InterestAccrual(models.Model):
+    """
+    Each instance is the interest credited to a Savings Account for one accrual period. An Account is credited at most
+    once per period (see bank_accounts.interest).
+    """
+    account = models.ForeignKey(to=Account, on_delete=models.CASCADE, related_name='interest_accruals')
+    period = models.CharField(max_length=7)  # Month, as YYYY-MM
+    balance = models.IntegerField()  # Balance the interest was computed on
+    amount = models.IntegerField()
+    date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = (('account', 'period'),)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class DailyAccountTotal(models.Model):
+    """
+    Each instance totals one kind of transfer into and out of an Account over one day. Kept up to date in the same
+    transaction as the transfers (see bank_accounts.rollups), so spending can be reported without reading receipts.
+    """
+    account = models.ForeignKey(to=Account, on_delete=models.CASCADE, related_name='daily_totals')
+    day = models.DateField()  # In the current time zone
+    kind = models.CharField(max_length=20, choices=LedgerEntry.KIND_CHOICES)
+    inflow = models.IntegerField(default=0)
+    outflow = models.IntegerField(default=0)
+    count = models.IntegerField(default=0)  # Transfers into or out of the Account
+
+    class Meta:
+        unique_together = (('account', 'day', 'kind'),)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class PayeeTotal(models.Model):
+    """
+    Each instance totals every payment from one User to another (see bank_accounts.rollups).
+    """
+    payer = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='+')
+    payee = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='+')
+    amount = models.IntegerField(default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('payer', 'payee'),)
+        indexes = [
+            models.Index(fields=['payer', '-amount'], name='payee_total_payer_amount'),  # Top payees
+        ]
+
+    def __str__(self):
+        return str(self.id)
+
+
+class CrossShardTransfer(models.Model):
+    """
+    Each instance is one side of a payment between Users whose Accounts are on different shards (see
+    bank_accounts.cross_shard). The payer's shard holds the outgoing side, which tracks the payment's progress. The
+    payee's shard holds the incoming side, whose unique transfer_id keeps the payment from being applied twice.
+    Accounts and Users are stored as plain primary keys, since each side's shard lacks the other side's Account.
+    """
+    OUTGOING = 'outgoing'
+    INCOMING = 'incoming'
+    DIRECTION_CHOICES = (
+        (OUTGOING, 'Outgoing'),
+        (INCOMING, 'Incoming'),
+    )
+
+    PREPARED = 'prepared'  # Withdrawn from the payer, not yet known to be deposited
+    COMMITTED = 'committed'  # Deposited to the payee
+    REFUNDED = 'refunded'  # Refused by the payee's shard, and given back to the payer
+    STATUS_CHOICES = (
+        (PREPARED, 'Prepared'),
+        (COMMITTED, 'Committed'),
+        (REFUNDED, 'Refunded'),
+    )
+
+    transfer_id = models.UUIDField(unique=True)
+    direction = models.CharField(max_length=8, choices=DIRECTION_CHOICES)
+    status = models.CharField(max_length=9, choices=STATUS_CHOICES)
+    payer_pk = models.IntegerField()
+    payee_pk = models.IntegerField()
+    from_account_pk = models.IntegerField()
+    to_account_pk = models.IntegerField()
+    amount = models.IntegerField()
+    comment = models.CharField(max_length=500, blank=True)
+    date = models.DateTimeField(default=timezone.now)  # When the payment was made
+    receipt_id = models.IntegerField(null=True)  # This side's ExternalTransferReceipt. None if refused.
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'date'], name='cross_shard_status'),
+        ]
+
+    def __str__(self):
+        return str(self.transfer_id)
+
+
+class ArchivedInternalTransferReceipt(models.Model):
+    """
+    An InternalTransferReceipt moved out of the hot table by the archive_receipts command (see bank_accounts.archive).
+    Keeps its id, so ledger entries still point to it. Foreign keys aren't constrained or indexed: deleting an Account or
+    User leaves the archive untouched, and joins to it find nothing, as if it had been set to NULL.
+    """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(to=User, on_delete=models.DO_NOTHING, null=True, db_constraint=False, db_index=False,
+                             related_name='+')
+    from_account = models.ForeignKey(to=Account, on_delete=models.DO_NOTHING, null=True, db_constraint=False,
+                                     db_index=False, related_name='+')
+    to_account = models.ForeignKey(to=Account, on_delete=models.DO_NOTHING, null=True, db_constraint=False,
+                                   db_index=False, related_name='+')
+    amount = models.IntegerField()
+    date = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'date', 'id'], name='archived_internal_user_date'),
+        ]
+
+    def __str__(self):
+        return str(self.id)
+
+
+class ArchivedExternalTransferReceipt(models.Model):
+    """
+    An ExternalTransferReceipt moved out of the hot table, like ArchivedInternalTransferReceipt.
+    """
+    id = models.IntegerField(primary_key=True)
+    payer = models.ForeignKey(to=User, on_delete=models.DO_NOTHING, null=True, db_constraint=False, db_index=False,
+                              related_name='+')
+    payee = models.ForeignKey(to=User, on_delete=models.DO_NOTHING, null=True, db_constraint=False, db_index=False,
+                              related_name='+')
+    from_account = models.ForeignKey(to=Account, on_delete=models.DO_NOTHING, null=True, db_constraint=False,
+                                     db_index=False, related_name='+')
+    to_account = models.ForeignKey(to=Account, on_delete=models.DO_NOTHING, null=True, db_constraint=False,
+                                   db_index=False, related_name='+')
+    amount = models.IntegerField()
+    date = models.DateTimeField()
+    comment = models.CharField(max_length=500)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['payer', 'date', 'id'], name='archived_external_payer_date'),
+            models.Index(fields=['payee', 'date', 'id'], name='archived_external_payee_date'),
+        ]
+
+    def __str__(self):
+        return str(self.id)
@@ -0,0 +1,173 @@
+# Keyset (cursor) pagination
+# Pages are ordered newest first by (date, id). Instead of an OFFSET, each page after the first starts strictly after
+# the (date, id) of the last row of the previous page, which the client passes back as a cursor. With an index ending
+# in (date, id) every page costs the same, no matter how deep into the history it is.
+
+# Rows may also have an older part in an archive table (see bank_accounts.archive). Pages then continue into the
+# archive once the current rows run out, costing one more query only for the pages that reach it.
+
+# Rows matching either of two conditions (e.g. payments sent or received by a User) would need an OR, which databases
+# plan as a scan of both indexes and a sort of every matching row. Such rows are given as one queryset per condition
+# instead, each read up to a page through its own index and merged in Python, so pages stay the same cost.
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class KeysetPage:
+    """
+    One page of rows, plus the cursor of the next page if there is one.
+    """
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(row):
+    """
+    :param row: model instance with date and id fields
+    :return: cursor string pointing just past the row
+    """
+    return '%s_%d' % (row.date.isoformat(), row.id)
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor: string made by encode_cursor
+    :return: (date, id), or None if the cursor is malformed
+    """
+    date, separator, pk = (cursor or '').rpartition('_')
+    try:
+        date = parse_datetime(date)
+        pk = int(pk)
+    except ValueError:
+        return None
+    if date is None:
+        return None
+    return date, pk
+
+
+def paginate(queryset, cursor, page_size, archived=None):
+    """
+    Returns the page of a queryset that starts after a cursor.
+    :param queryset: rows with date and id fields, or a list of querysets whose rows are merged
+    :param cursor: cursor from a previous page, or None for the first page
+    :param page_size:
+    :param archived: queryset (or list of querysets) of the archived rows, all older than those of queryset, or None
+    :return: KeysetPage
+    """
+    # Fetch one extra row to learn if there is a next page
+    rows = _read(queryset, decode_cursor(cursor), page_size + 1)
+    if len(rows) <= page_size and archived is not None:
+        rows += _read(archived, _last(rows, cursor), page_size + 1 - len(rows))
+    return _page(rows, page_size)
+
+
+async def apaginate(queryset, cursor, page_size, archived=None):
+    """
+    Like paginate, for async views.
+    :return: KeysetPage
+    """
+    rows = await _aread(queryset, decode_cursor(cursor), page_size + 1)
+    if len(rows) <= page_size and archived is not None:
+        rows += await _aread(archived, _last(rows, cursor), page_size + 1 - len(rows))
+    return _page(rows, page_size)
+
+
+def _read(querysets, position, limit):
+    """
+    :param querysets: queryset or list of querysets
+    :param position: (date, id) or None
+    :param limit:
+    :return: list of the first rows of the querysets strictly after position, newest first
+    """
+    if not isinstance(querysets, (list, tuple)):
+        return list(_after(querysets, position)[:limit])
+    return _merge([list(_after(queryset, position)[:limit]) for queryset in querysets], limit)
+
+
+async def _aread(querysets, position, limit):
+    """
+    Like _read, for async views.
+    """
+    if not isinstance(querysets, (list, tuple)):
+        return [row async for row in _after(querysets, position)[:limit]]
+    return _merge([[row async for row in _after(queryset, position)[:limit]] for queryset in querysets], limit)
+
+
+def _merge(lists, limit):
+    """
+    :param lists: lists of rows, each newest first
+    :param limit:
+    :return: list of the newest rows of all the lists, each row once, newest first
+    """
+    rows = {row.id: row for rows in lists for row in rows}
+    return sorted(rows.values(), key=lambda row: (row.date, row.id), reverse=True)[:limit]
+
+
+def _last(rows, cursor):
+    """
+    :return: (date, id) of the last row read, or of the cursor if none were
+    """
+    return (rows[-1].date, rows[-1].id) if rows else decode_cursor(cursor)
+
+
+def _page(rows, page_size):
+    """
+    :param rows: up to page_size + 1 rows
+    :param page_size:
+    :return: KeysetPage of the first page_size rows
+    """
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return KeysetPage(rows, encode_cursor(rows[-1]))
+    return KeysetPage(rows, None)
+
+
+def _after(queryset, position):
+    """
+    :param queryset: rows with date and id fields
+    :param position: (date, id) or None
+    :return: the rows strictly after position, newest first
+    """
+    queryset = queryset.order_by('-date', '-id')
+    if position is not None:
+        date, pk = position
+        # date__lte bounds the index range the OR alone can't
+        queryset = queryset.filter(Q(date__lte=date), Q(date__lt=date) | Q(date=date, id__lt=pk))
+    return queryset
+
+
+class KeysetPaginationMixin:
+    """
+    Replaces a ListView's offset pagination with keyset pagination. The cursor is read from the "cursor" GET parameter.
+    The page is available to templates as page_obj. Views whose rows are archived override get_archived_queryset.
+    Async views read the page with apaginate_queryset first.
+    """
+    paginate_by = 50
+    cursor_kwarg = 'cursor'
+    page = None  # Page read in advance by apaginate_queryset
+
+    def get_archived_queryset(self):
+        """
+        :return: queryset of the archived rows, all older than those of get_queryset, or None
+        """
+        return None
+
+    def paginate_queryset(self, queryset, page_size):
+        page = self.page
+        if page is None:
+            page = paginate(queryset, self.request.GET.get(self.cursor_kwarg), page_size, self.get_archived_queryset())
+        return None, page, page.object_list, page.has_next()
+
+    async def apaginate_queryset(self, queryset):
+        """
+        Reads the page of an async view without blocking, before get_context_data, which then uses it.
+        :param queryset:
+        :return:
+        """
+        self.page = await apaginate(queryset, self.request.GET.get(self.cursor_kwarg),
+                                    self.get_paginate_by(queryset), self.get_archived_queryset())
@@ -0,0 +1,40 @@
+# Payee lookup
+# Users pick who to pay by typing the start of a username, instead of choosing from a list of every User.
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from .lru import LRUCache
+
+# Most Users returned for one search
+MAX_RESULTS = getattr(settings, 'BANK_ACCOUNTS_PAYEE_SEARCH_RESULTS', 10)
+
+# Recent searches. Short-lived so new Users show up quickly.
+_search_cache = LRUCache(maxsize=getattr(settings, 'BANK_ACCOUNTS_PAYEE_SEARCH_CACHE_SIZE', 1024), ttl=60)
+
+
+def search_payees(prefix):
+    """
+    Finds Users whose username starts with a prefix, in username order.
+    The username column is unique, and therefore indexed. We search it with a range (prefix <= username < prefix +
+    highest code point) rather than LIKE, so every database can answer from the index.
+    :param prefix:
+    :return: list of (pk, username), at most MAX_RESULTS long
+    """
+    if not prefix:
+        return []
+
+    results = _search_cache.get(prefix)
+    if results is None:
+        results = list(User.objects.filter(username__gte=prefix, username__lt=prefix + '\U0010ffff')
+                       .order_by('username').values_list('pk', 'username')[:MAX_RESULTS])
+        _search_cache.set(prefix, results)
+    return results
+
+
+def payee_pk(username):
+    """
+    :param username:
+    :return: primary key of the User with the username, or None if there is none
+    """
+    return User.objects.filter(username=username).values_list('pk', flat=True).first()
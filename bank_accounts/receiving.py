@@ -0,0 +1,122 @@
+# Receiving Accounts
+# Payments to a User land in the User's receiving Account: the Checking Account the User chose, or else the first one
+# opened. It is kept in a DefaultReceivingAccount row per User, whose primary key is the User's, so finding where a
+# payment lands is one lookup by primary key instead of reading every Account of the payee.
+
+# The rows are kept up to date when Accounts are opened, changed or deleted (see signals), and when a User chooses
+# another Account. Lookups are cached per process for a short while. Another process may meanwhile change or delete
+# the receiving Account: a payment then lands in the Account received in until then, or, if it is gone, its deposit
+# matches no row and the payment looks the Account up again, bypassing the cache.
+
+from django.conf import settings
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.contrib.auth.models import User
+
+from .models import Account, DefaultReceivingAccount
+from .exceptions import InvalidAccount, NotCheckingAccount, InvalidPayee, NoCheckingAccount
+from .lru import LRUCache
+from . import routers
+
+# (pk, balance_slots) of receiving Accounts by (database alias, User pk)
+_cache = LRUCache(maxsize=getattr(settings, 'BANK_ACCOUNTS_RECEIVING_CACHE_SIZE', 10000), ttl=60)
+
+
+def receiving_account(payee_pk, cached=True):
+    """
+    Finds the Checking Account that receives payments made to a User.
+    :param payee_pk:
+    :param cached: False to read the database, e.g. after a deposit into the cached Account matched no row
+    :return: primary key and balance_slots of the Account
+    :raise InvalidPayee: if there is no such User
+    :raise NoCheckingAccount: if the User has no Checking Account
+    """
+    key = (routers.primary(), payee_pk)
+    to_account = _cache.get(key) if cached else None
+    if to_account is not None:
+        return to_account
+
+    to_account = DefaultReceivingAccount.objects.filter(holder_id=payee_pk)\
+        .values_list('account_id', 'account__balance_slots').first()
+    if to_account is None:
+        if not User.objects.filter(pk=payee_pk).exists():
+            raise InvalidPayee()
+        raise NoCheckingAccount()
+
+    _cache.set(key, to_account)
+    return to_account
+
+
+def receiving_accounts(payee_pks):
+    """
+    Finds the receiving Accounts of several Users in one query, bypassing the cache.
+    :param payee_pks: at most a few hundred primary keys of Users
+    :return: dict of receiving Account pk by User pk, leaving out Users without one
+    """
+    return dict(DefaultReceivingAccount.objects.filter(holder_id__in=payee_pks).values_list('holder_id', 'account_id'))
+
+
+def choose(holder, account_pk):
+    """
+    Makes one of a User's Checking Accounts receive the User's payments.
+    :param holder: User
+    :param account_pk:
+    :return:
+    :raise InvalidAccount: if the User holds no such Account
+    :raise NotCheckingAccount: if the Account is not a Checking Account
+    """
+    with transaction.atomic(using=routers.primary()):
+        account_type = Account.objects.select_for_update().filter(pk=account_pk, holder=holder)\
+            .values_list('account_type', flat=True).first()
+        if account_type is None:
+            raise InvalidAccount()
+        if account_type != Account.CHECKING:
+            raise NotCheckingAccount()
+        if not DefaultReceivingAccount.objects.filter(holder=holder).update(account_id=account_pk):
+            DefaultReceivingAccount.objects.create(holder=holder, account_id=account_pk)
+    forget(holder.pk)
+
+
+def opened(account, using=DEFAULT_DB_ALIAS):
+    """
+    Makes a new Checking Account receive its holder's payments if nothing else does. Called when an Account is created.
+    :param account:
+    :param using: alias of the database the Account was saved to
+    :return:
+    """
+    if account.holder_id is not None and account.account_type == Account.CHECKING:
+        DefaultReceivingAccount.objects.using(using).bulk_create(
+            [DefaultReceivingAccount(holder_id=account.holder_id, account_id=account.pk)], ignore_conflicts=True)
+
+
+def refresh(*holder_pks, using=DEFAULT_DB_ALIAS):
+    """
+    Checks that Users' receiving Accounts are still Checking Accounts they hold, and otherwise falls back to their first
+    Checking Account. Called when Accounts change in ways that may affect it: change type or holder, or are deleted.
+    :param holder_pks: primary keys of Users. None is ignored.
+    :param using: alias of the database holding the Users' Accounts
+    :return:
+    """
+    for holder_pk in dict.fromkeys(holder_pks):  # Former holders first, which may free the Account for the new one
+        if holder_pk is None:
+            continue
+        current = DefaultReceivingAccount.objects.using(using).filter(holder_id=holder_pk)\
+            .values_list('account__holder_id', 'account__account_type').first()
+        if current != (holder_pk, Account.CHECKING):
+            first = Account.objects.using(using).filter(holder_id=holder_pk, account_type=Account.CHECKING)\
+                .order_by('pk').values_list('pk', flat=True).first()
+            if first is None:
+                DefaultReceivingAccount.objects.using(using).filter(holder_id=holder_pk).delete()
+            elif not DefaultReceivingAccount.objects.using(using).filter(holder_id=holder_pk)\
+                    .update(account_id=first):
+                DefaultReceivingAccount.objects.using(using).bulk_create(
+                    [DefaultReceivingAccount(holder_id=holder_pk, account_id=first)], ignore_conflicts=True)
+        _cache.delete((using, holder_pk))
+
+
+def forget(holder_pk):
+    """
+    Drops a User's receiving Account from this process's cache.
+    :param holder_pk:
+    :return:
+    """
+    _cache.delete((routers.primary(), holder_pk))
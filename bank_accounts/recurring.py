@@ -0,0 +1,186 @@
+# Standing orders
+# A RecurringTransfer repeats an internal transfer or payment on a schedule. Workers (the run_recurring_transfers
+# command) find due standing orders with an indexed query on next_run_at, claim them in batches (see
+# bank_accounts.workers) and make each transfer through bank_accounts.transfers, under the same rules as the views.
+# Any number of workers may run at once.
+
+# A transfer and moving its standing order to the next date happen in one transaction, and only if the worker still
+# holds its claim, so a transfer is never made twice for the same date. Runs missed while no worker was running are not
+# made up: the standing order moves on to its next date in the future. A standing order whose transfers are refused
+# MAX_FAILURES times in a row stops.
+
+# Standing orders are kept on the shard of the User making them (see bank_accounts.routers). Workers claim from every
+# shard, and each transfer and its rescheduling commit together on that shard.
+
+import calendar
+import datetime
+import logging
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Account, RecurringTransfer
+from .exceptions import TransferError, InvalidAmount, InvalidAccount, SameAccount, NotCheckingAccount, \
+    InvalidPayee, SelfPayment
+from .batch import ERROR_MESSAGES
+from . import transfers, workers, routers
+
+logger = logging.getLogger(__name__)
+
+# Standing orders claimed by a worker at a time
+BATCH_SIZE = getattr(settings, 'BANK_ACCOUNTS_RECURRING_BATCH_SIZE', 100)
+
+# Refused transfers in a row before a standing order stops
+MAX_FAILURES = 3
+
+
+def create(user, kind, from_account_pk, amount, frequency, first_run=None, to_account_pk=None, payee_pk=None,
+           comment=''):
+    """
+    Sets up a standing order, checking it against the rules its transfers will be made under.
+    :param user: User making the transfers
+    :param kind: RecurringTransfer.INTERNAL_TRANSFER or RecurringTransfer.EXTERNAL_TRANSFER
+    :param from_account_pk:
+    :param amount:
+    :param frequency: one of RecurringTransfer.FREQUENCY_CHOICES
+    :param first_run: datetime of the first transfer, defaults to now
+    :param to_account_pk: Account of the User to transfer into, for internal transfers
+    :param payee_pk: User to pay, for payments
+    :param comment: comment of payments
+    :return: RecurringTransfer
+    """
+    if amount <= 0:
+        raise InvalidAmount()
+
+    held = Account.objects.filter(holder=user)
+    if kind == RecurringTransfer.INTERNAL_TRANSFER:
+        if from_account_pk == to_account_pk:
+            raise SameAccount()
+        if held.filter(pk__in=[from_account_pk, to_account_pk]).count() != 2:
+            raise InvalidAccount()
+        payee_pk = None
+        comment = ''
+    else:
+        if payee_pk == user.pk:
+            raise SelfPayment()
+        if not User.objects.filter(pk=payee_pk).exists():
+            raise InvalidPayee()
+        account_type = held.filter(pk=from_account_pk).values_list('account_type', flat=True).first()
+        if account_type is None:
+            raise InvalidAccount()
+        if account_type != Account.CHECKING:
+            raise NotCheckingAccount()
+        to_account_pk = None
+
+    first_run = first_run or timezone.now()
+    return RecurringTransfer.objects.create(user=user, kind=kind, from_account_id=from_account_pk,
+                                            to_account_id=to_account_pk, payee_id=payee_pk, amount=amount,
+                                            comment=comment, frequency=frequency, day=first_run.day,
+                                            next_run_at=first_run)
+
+
+def cancel(user, pk):
+    """
+    Stops a User's standing order. A transfer already being made by a worker is rolled back.
+    :param user:
+    :param pk:
+    :return: True if the User had such a standing order
+    """
+    return RecurringTransfer.objects.filter(pk=pk, user=user).update(next_run_at=None) > 0
+
+
+def next_date(date, frequency, day=None):
+    """
+    :param date: datetime of a run
+    :param frequency: one of RecurringTransfer.FREQUENCY_CHOICES
+    :param day: day of the month monthly runs fall on, defaults to that of date. Pass the standing order's, so a run
+    moved to the end of a short month moves back in the next.
+    :return: datetime of the run after it. Monthly runs fall on the same day of the month, or the month's last day.
+    """
+    if frequency == RecurringTransfer.DAILY:
+        return date + datetime.timedelta(days=1)
+    if frequency == RecurringTransfer.WEEKLY:
+        return date + datetime.timedelta(weeks=1)
+    year, month = (date.year + 1, 1) if date.month == 12 else (date.year, date.month + 1)
+    return date.replace(year=year, month=month, day=min(day or date.day, calendar.monthrange(year, month)[1]))
+
+
+def run_due(worker, batch_size=BATCH_SIZE, lease=workers.DEFAULT_LEASE):
+    """
+    Claims a batch of due standing orders on each shard and makes their transfers.
+    :param worker: id of the worker, see workers.new_worker_id
+    :param batch_size: standing orders claimed per shard
+    :param lease: how long the worker may take to make the batch's transfers
+    :return: (transfers made, transfers refused). Both 0 when nothing is due.
+    """
+    made = refused = 0
+    for alias in routers.all_shards():
+        with routers.using_shard(alias):
+            shard_made, shard_refused = _run_due(worker, batch_size, lease)
+        made += shard_made
+        refused += shard_refused
+    return made, refused
+
+
+def _run_due(worker, batch_size, lease):
+    """
+    Claims a batch of the current shard's due standing orders and makes their transfers.
+    :return: (transfers made, transfers refused)
+    """
+    due = RecurringTransfer.objects.filter(next_run_at__lte=timezone.now())
+    pks = workers.claim(due, worker, batch_size, order_by=['next_run_at'], lease=lease)
+
+    made = refused = 0
+    orders = RecurringTransfer.objects.filter(pk__in=pks, claimed_by=worker).select_related('user')\
+        .order_by('next_run_at')
+    for order in orders:
+        try:
+            if _run(order, worker):
+                made += 1
+            else:
+                refused += 1
+        except workers.LostClaim:
+            logger.warning('Claim on standing order %d lapsed, leaving it to another worker', order.pk)
+    return made, refused
+
+
+def _run(order, worker):
+    """
+    Makes one standing order's transfer and schedules its next one.
+    :return: True if the transfer was made, False if it was refused
+    """
+    try:
+        with transaction.atomic(using=routers.primary()):
+            if order.kind == RecurringTransfer.INTERNAL_TRANSFER:
+                transfers.internal_transfer(order.user, order.from_account_id, order.to_account_id, order.amount)
+            else:
+                transfers.external_transfer(order.user, order.from_account_id, order.payee_id, order.amount,
+                                            order.comment)
+            _reschedule(order, worker, '')
+        return True
+    except TransferError as error:
+        _reschedule(order, worker, ERROR_MESSAGES[type(error)])
+        return False
+
+
+def _reschedule(order, worker, error):
+    """
+    Moves a standing order to its next date in the future and releases the worker's claim on it.
+    :param error: why the transfer was refused, or an empty string
+    """
+    now = timezone.now()
+    failures = order.failures + 1 if error else 0
+    next_run_at = None
+    if failures < MAX_FAILURES:
+        next_run_at = order.next_run_at
+        while next_run_at <= now:
+            next_run_at = next_date(next_run_at, order.frequency, order.day)
+
+    # Changes nothing if the claim lapsed or the standing order was cancelled meanwhile
+    updated = RecurringTransfer.objects.filter(pk=order.pk, claimed_by=worker, next_run_at=order.next_run_at)\
+        .update(next_run_at=next_run_at, last_run_at=now, last_error=error, failures=failures, claimed_by=None,
+                claimed_until=None)
+    if not updated:
+        raise workers.LostClaim()
@@ -0,0 +1,224 @@
+# Rollups
+# Running totals that analytics read instead of receipts: a DailyAccountTotal per Account, day and kind of transfer
+# (interest credited by bank_accounts.interest counting as a kind of its own), and a PayeeTotal per pair of payer and
+# payee. Reports then cost the same however long a User's history is.
+
+# Totals are added to in the same transaction as the transfers and interest they count, wherever receipts and
+# InterestAccruals are written. Missing rows
+# are inserted as zeros, ignoring any that already exist, and then every row is incremented by one UPDATE, so
+# concurrent transfers adding to the same row never lose each other's increments.
+
+# The rebuild_rollups command recomputes every total from the receipts and InterestAccruals, archived ones included (see
+# bank_accounts.archive), e.g. after the rollups were added to an existing database, on every shard (see
+# bank_accounts.routers).
+
+import datetime
+import functools
+import operator
+
+from django.db import transaction
+from django.db.models import Q, F, Case, When, Value, IntegerField, Sum, Count, Exists, OuterRef
+from django.db.models.functions import TruncDate, TruncMonth
+from django.utils import timezone
+
+from django.contrib.auth.models import User
+
+from .models import Account, InternalTransferReceipt, ExternalTransferReceipt, LedgerEntry, DailyAccountTotal, \
+    PayeeTotal, InterestAccrual
+from . import archive, routers
+
+# Rows incremented per UPDATE. Keeps us under SQLite's limit on query parameters.
+CHUNK_SIZE = 100
+
+DAILY_KEY = ('account_id', 'day', 'kind')
+PAYEE_KEY = ('payer_id', 'payee_id')
+
+# Largest number of months and payees a report covers
+MAX_MONTHS = 60
+MAX_PAYEES = 100
+
+
+def record_transfers(receipts, sign=1):
+    """
+    Adds transfers to the totals. Must be called in the transaction that saves the receipts.
+    :param receipts: saved receipts, all InternalTransferReceipts or all ExternalTransferReceipts
+    :param sign: -1 to take transfers back out of the totals, e.g. when refunded
+    :return:
+    """
+    if not receipts:
+        return
+    external = isinstance(receipts[0], ExternalTransferReceipt)
+    kind = LedgerEntry.EXTERNAL_TRANSFER if external else LedgerEntry.INTERNAL_TRANSFER
+
+    daily = {}
+    payees = {}
+    for receipt in receipts:
+        day = timezone.localdate(receipt.date)
+        for account_pk, field in ((receipt.from_account_id, 'outflow'), (receipt.to_account_id, 'inflow')):
+            totals = daily.setdefault((account_pk, day, kind), {'inflow': 0, 'outflow': 0, 'count': 0})
+            totals[field] += sign * receipt.amount
+            totals['count'] += sign
+        if external:
+            totals = payees.setdefault((receipt.payer_id, receipt.payee_id), {'amount': 0, 'count': 0})
+            totals['amount'] += sign * receipt.amount
+            totals['count'] += sign
+
+    _add(DailyAccountTotal, DAILY_KEY, daily)
+    _add(PayeeTotal, PAYEE_KEY, payees)
+
+
+def record_interest(accruals):
+    """
+    Adds interest credits to the daily totals of the Accounts credited. Must be called in the transaction that saves
+    the InterestAccruals.
+    :param accruals: saved InterestAccruals
+    :return:
+    """
+    daily = {}
+    for accrual in accruals:
+        totals = daily.setdefault((accrual.account_id, timezone.localdate(accrual.date), LedgerEntry.INTEREST),
+                                  {'inflow': 0, 'outflow': 0, 'count': 0})
+        totals['inflow'] += accrual.amount
+        totals['count'] += 1
+    _add(DailyAccountTotal, DAILY_KEY, daily)
+
+
+def spending(user, months=12):
+    """
+    Totals the payments a User sent and received per month, from the daily totals of the User's Accounts.
+    :param user:
+    :param months: number of months to report, ending with the current one
+    :return: list of dicts with month (YYYY-MM), spent, received and payments, oldest first. Months without payments
+    are left out.
+    """
+    today = timezone.localdate()
+    first = today.replace(day=1)
+    for _ in range(min(months, MAX_MONTHS) - 1):
+        first = (first - datetime.timedelta(days=1)).replace(day=1)
+
+    rows = DailyAccountTotal.objects.filter(account__holder=user, kind=LedgerEntry.EXTERNAL_TRANSFER, day__gte=first)\
+        .annotate(month=TruncMonth('day')).values('month')\
+        .annotate(spent=Sum('outflow'), received=Sum('inflow'), payments=Sum('count')).order_by('month')
+    return [{'month': row['month'].strftime('%Y-%m'), 'spent': row['spent'], 'received': row['received'],
+             'payments': row['payments']} for row in rows]
+
+
+def top_payees(user, limit=10):
+    """
+    :param user:
+    :param limit: number of payees
+    :return: list of dicts with the username, total amount and number of payments of the Users a User has paid most,
+    largest first
+    """
+    rows = PayeeTotal.objects.filter(payer=user).order_by('-amount', 'payee_id')\
+        .values_list('payee__username', 'amount', 'count')[:min(limit, MAX_PAYEES)]
+    return [{'username': username, 'amount': amount, 'payments': count} for username, amount, count in rows]
+
+
+def rebuild(chunk_size=1000, log=None):
+    """
+    Recomputes every total from the receipts and InterestAccruals, on every shard, a chunk of Accounts or payers at a time. Each chunk's
+    Accounts are locked while it is recomputed, so transfers made meanwhile are counted exactly once.
+    :param chunk_size: Accounts or Users per transaction
+    :param log: function called with progress messages
+    :return: (DailyAccountTotals written, PayeeTotals written)
+    """
+    log = log or (lambda message: None)
+    written = [0, 0]
+    for alias in routers.all_shards():
+        with routers.using_shard(alias):
+            _rebuild(alias, written, chunk_size, log)
+    return written[0], written[1]
+
+
+def _rebuild(alias, written, chunk_size, log):
+    """
+    Recomputes the totals of one shard, the current one.
+    :param alias: alias of the shard
+    :param written: [DailyAccountTotals written, PayeeTotals written], added to
+    """
+    last_pk = 0
+    while True:
+        with transaction.atomic(using=alias):
+            pks = list(Account.objects.select_for_update().filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            DailyAccountTotal.objects.filter(account_id__in=pks).delete()
+            written[0] += len(DailyAccountTotal.objects.bulk_create(_daily_totals(pks), batch_size=400))
+        log('%s: up to Account %d: %d daily totals' % (alias, last_pk, written[0]))
+
+    last_pk = 0
+    while True:
+        with transaction.atomic(using=alias):
+            pks = list(User.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            list(Account.objects.select_for_update().filter(holder_id__in=pks).values_list('pk'))  # Lock payments
+            PayeeTotal.objects.filter(payer_id__in=pks).delete()
+            totals = {}
+            for model in archive.receipt_models(ExternalTransferReceipt):
+                # Archived receipts keep the pks of deleted payees
+                rows = model.objects.filter(Exists(User.objects.filter(pk=OuterRef('payee_id'))), payer_id__in=pks)\
+                    .order_by().values_list('payer_id', 'payee_id').annotate(amount=Sum('amount'), count=Count('id'))
+                for payer_pk, payee_pk, amount, count in rows:
+                    row = totals.setdefault((payer_pk, payee_pk), PayeeTotal(payer_id=payer_pk, payee_id=payee_pk))
+                    row.amount += amount
+                    row.count += count
+            written[1] += len(PayeeTotal.objects.bulk_create(totals.values(), batch_size=400))
+        log('%s: up to User %d: %d payee totals' % (alias, last_pk, written[1]))
+
+
+def _daily_totals(account_pks):
+    """
+    :return: list of unsaved DailyAccountTotals of some Accounts, computed from their receipts and InterestAccruals
+    """
+    totals = {}
+    for receipts, kind in ((InternalTransferReceipt, LedgerEntry.INTERNAL_TRANSFER),
+                           (ExternalTransferReceipt, LedgerEntry.EXTERNAL_TRANSFER)):
+        for model in archive.receipt_models(receipts):
+            for account_field, field in (('from_account_id', 'outflow'), ('to_account_id', 'inflow')):
+                rows = model.objects.filter(**{account_field + '__in': account_pks}).order_by()\
+                    .annotate(day=TruncDate('date')).values(account_field, 'day')\
+                    .annotate(amount=Sum('amount'), count=Count('id'))
+                for values in rows:
+                    account_pk, day = values[account_field], values['day']
+                    row = totals.setdefault((account_pk, day, kind),
+                                            DailyAccountTotal(account_id=account_pk, day=day, kind=kind))
+                    setattr(row, field, getattr(row, field) + values['amount'])
+                    row.count += values['count']
+
+    rows = InterestAccrual.objects.filter(account_id__in=account_pks).order_by()\
+        .annotate(day=TruncDate('date')).values('account_id', 'day').annotate(amount=Sum('amount'), count=Count('id'))
+    for values in rows:
+        totals[(values['account_id'], values['day'], LedgerEntry.INTEREST)] = DailyAccountTotal(
+            account_id=values['account_id'], day=values['day'], kind=LedgerEntry.INTEREST, inflow=values['amount'],
+            count=values['count'])
+    return list(totals.values())
+
+
+def _add(model, key_fields, totals):
+    """
+    Adds to rows of a totals table, creating those missing.
+    :param model: DailyAccountTotal or PayeeTotal
+    :param key_fields: names of the fields identifying a row, in order
+    :param totals: dict of increments by field name, by key (tuple of values of key_fields)
+    :return:
+    """
+    keys = sorted(key for key in totals if None not in key)  # Skips Accounts and Users deleted since
+    if not keys:
+        return
+    model.objects.bulk_create([model(**dict(zip(key_fields, key))) for key in keys], batch_size=400,
+                              ignore_conflicts=True)
+
+    fields = list(totals[keys[0]])
+    for start in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[start:start + CHUNK_SIZE]
+        matches = [Q(**dict(zip(key_fields, key))) for key in chunk]
+        increments = {field: F(field) + Case(*[When(match, then=Value(totals[key][field]))
+                                               for match, key in zip(matches, chunk)],
+                                             default=Value(0), output_field=IntegerField())
+                      for field in fields}
+        model.objects.filter(functools.reduce(operator.or_, matches)).update(**increments)
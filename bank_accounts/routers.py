@@ -0,0 +1,211 @@
+# Database routing
+# Two optional ways of spreading the bank_accounts tables over several databases, each off unless configured:
+
+# Read replicas: BANK_ACCOUNTS_REPLICAS maps a database alias to aliases of read-only copies of it. Views marked
+# read_only (e.g. the account and receipt lists) read bank_accounts rows from a random replica, and everything else
+# from the primary. Replicas lag behind their primary, so a client that has just written (made any request other than
+# GET, HEAD or OPTIONS) is pinned to the primary by a cookie for BANK_ACCOUNTS_REPLICA_LAG seconds, and sees its own
+# writes. Users and sessions are always read from the primary.
+
+# Shards: BANK_ACCOUNTS_SHARDS lists the aliases of databases that each hold some Users' Accounts, and every other
+# bank_accounts row belonging to them (receipts, ledger, rollups, ...). A User's shard is picked by holder: the User's
+# pk modulo the number of shards. Users, sessions and other apps' tables stay on 'default', and Users are copied to
+# every shard (see signals) so foreign keys to them hold everywhere. A request reads and writes its User's shard. Code
+# running outside requests (commands, workers) goes over every shard in turn (all_shards), each with using_shard.
+# Payments between Users on different shards take the two-phase path of bank_accounts.cross_shard.
+# Each shard allocates the primary keys of its own rows, so bank_accounts rows on different shards may share a pk: a
+# row is identified by its shard and pk together, and caches of them are keyed by both. Users stay unique, being made
+# on 'default'.
+
+# The settings are read on every query rather than once, so tests can change them with override_settings.
+
+# The current shard is kept in an asgiref Local: per thread like a threading.local, and also per task under ASGI, where
+# requests share the event loop's thread. It follows async code into the threads its queries run in.
+
+import random
+from contextlib import contextmanager
+
+from asgiref.local import Local
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+APP_LABEL = 'bank_accounts'
+
+# Cookie pinning a client to the primary after it writes
+PIN_COOKIE = 'bank_accounts_primary'
+
+# Methods that don't write, and so don't pin a client to the primary
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_local = Local()  # Shard and replica use of the request or block in progress
+
+
+def replicas():
+    """
+    :return: dict of lists of replica aliases, by alias of their primary
+    """
+    return getattr(settings, 'BANK_ACCOUNTS_REPLICAS', {})
+
+
+def shards():
+    """
+    :return: list of shard aliases, empty when not sharding
+    """
+    return getattr(settings, 'BANK_ACCOUNTS_SHARDS', [])
+
+
+def all_shards():
+    """
+    :return: list of the aliases of the databases holding bank_accounts rows: the shards, or 'default' when not sharding
+    """
+    return shards() or [DEFAULT_DB_ALIAS]
+
+
+def replica_lag():
+    """
+    :return: seconds a client stays pinned to the primary after writing
+    """
+    return getattr(settings, 'BANK_ACCOUNTS_REPLICA_LAG', 5)
+
+
+def shard_for(holder_pk):
+    """
+    :param holder_pk: primary key of a User
+    :return: alias of the database holding the User's Accounts
+    """
+    aliases = shards()
+    return aliases[holder_pk % len(aliases)] if aliases else DEFAULT_DB_ALIAS
+
+
+def primary():
+    """
+    :return: alias of the database bank_accounts rows are written to in the current request or block. Transactions
+    around such writes must use it, e.g. transaction.atomic(using=primary()).
+    """
+    return getattr(_local, 'shard', None) or DEFAULT_DB_ALIAS
+
+
+def reading_replica():
+    """
+    :return: True if bank_accounts rows are being read from a replica, which may lag behind
+    """
+    return getattr(_local, 'replica', False) and bool(replicas().get(primary()))
+
+
+@contextmanager
+def using_shard(alias, replica=False):
+    """
+    Routes the bank_accounts queries of a block to a shard.
+    :param alias: shard alias, e.g. from shard_for
+    :param replica: True to read from the shard's replicas
+    :return:
+    """
+    previous = getattr(_local, 'shard', None), getattr(_local, 'replica', False)
+    _local.shard, _local.replica = alias, replica
+    try:
+        yield
+    finally:
+        _local.shard, _local.replica = previous
+
+
+def read_only(view):
+    """
+    Decorator marking a function view that only reads, so it may read from replicas. Class-based views set a
+    read_only attribute instead.
+    :param view:
+    :return:
+    """
+    view.read_only = True
+    return view
+
+
+class BankRouter:
+    """
+    Routes bank_accounts models to the current shard, and their reads to its replicas where allowed. Defers to Django's
+    defaults for everything else.
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._meta.app_label == APP_LABEL and instance._state.db:
+            return instance._state.db  # Related rows live beside the row they were reached from
+        alias = primary()
+        if getattr(_local, 'replica', False) and replicas().get(alias):
+            return random.choice(replicas()[alias])
+        return alias
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        return primary()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # Users are copied to every shard, and replicas hold the same rows as their primary
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if any(db in aliases for aliases in replicas().values()):
+            return False  # Replicas are copies, migrated with their primary
+        return None
+
+
+class RoutingMiddleware:
+    """
+    Routes each request to its User's shard, reads read_only views from replicas unless the client is pinned to the
+    primary, and pins clients that write. Place it after AuthenticationMiddleware. Runs synchronously or, under ASGI,
+    asynchronously.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+        request.routing = (None, False)  # Shard and replica use, set once the view is known
+        previous = getattr(_local, 'shard', None), getattr(_local, 'replica', False)
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.shard, _local.replica = previous
+        return self._respond(request, response)
+
+    async def _acall(self, request):
+        request.routing = (None, False)
+        previous = getattr(_local, 'shard', None), getattr(_local, 'replica', False)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _local.shard, _local.replica = previous
+        return self._respond(request, response)
+
+    def _respond(self, request, response):
+        if request.method not in SAFE_METHODS and replicas():
+            response.set_cookie(PIN_COOKIE, '1', max_age=replica_lag(), httponly=True, samesite='Lax')
+        if response.streaming:  # Rows are read as the response is sent, so keep routing until it has been
+            stream = self._astream if response.is_async else self._stream
+            response.streaming_content = stream(response.streaming_content, request.routing)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        shard = None
+        if shards() and request.user.is_authenticated:
+            shard = shard_for(request.user.pk)
+        read_only_view = getattr(view_func, 'read_only', False) or \
+            getattr(getattr(view_func, 'view_class', None), 'read_only', False)  # Class-based view
+        replica = read_only_view and request.method in SAFE_METHODS and PIN_COOKIE not in request.COOKIES
+        request.routing = _local.shard, _local.replica = shard, replica
+
+    def _stream(self, content, routing):
+        with using_shard(*routing):
+            yield from content
+
+    async def _astream(self, content, routing):
+        with using_shard(*routing):
+            async for chunk in content:
+                yield chunk
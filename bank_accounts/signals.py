@@ -0,0 +1,81 @@
+# Signal receivers
+# Connected when the app is ready (see AccountsConfig.ready)
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from django.contrib.auth.models import User
+
+from .models import Account
+from . import ledger, account_cache, routers, sqlite_tuning, receiving
+
+
+@receiver(post_save, sender=Account)
+def open_ledger(sender, instance, created, raw=False, **kwargs):
+    """
+    Every new Account starts its ledger with an opening checkpoint of its initial balance.
+    """
+    if created and not raw:  # raw is set when loading fixtures
+        ledger.open_account(instance)
+
+
+@receiver(post_init, sender=Account)
+def remember_holder(sender, instance, **kwargs):
+    """
+    Remembers who held an Account when it was loaded, so a change of holder invalidates both holders' caches.
+    """
+    instance._loaded_holder_id = instance.holder_id
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def invalidate_account_cache(sender, instance, **kwargs):
+    account_cache.invalidate(instance.holder_id, instance._loaded_holder_id)
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def update_receiving_account(sender, instance, created=False, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Keeps the receiving Accounts of the Account's holders, former and current, up to date.
+    """
+    if raw:
+        return
+    if created:
+        receiving.opened(instance, using)
+    else:
+        receiving.refresh(instance._loaded_holder_id, instance.holder_id, using=using)
+
+
+@receiver(post_save, sender=User)
+def copy_user_to_shards(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Copies each User saved on 'default' to every other shard, so the foreign keys of rows there hold.
+    """
+    if raw or using != DEFAULT_DB_ALIAS:
+        return
+    values = {field.attname: getattr(instance, field.attname) for field in User._meta.concrete_fields}
+    for alias in routers.shards():
+        if alias != DEFAULT_DB_ALIAS and not User.objects.using(alias).filter(pk=instance.pk).update(**values):
+            User.objects.using(alias).create(**values)
+
+
+@receiver(post_delete, sender=User)
+def delete_user_from_shards(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Deletes the copies of a User deleted from 'default', which applies on_delete to the rows of each shard.
+    """
+    if using != DEFAULT_DB_ALIAS:
+        return
+    for alias in routers.shards():
+        if alias != DEFAULT_DB_ALIAS:
+            User.objects.using(alias).filter(pk=instance.pk).delete()
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    """
+    Sets the pragmas of the BANK_ACCOUNTS_SQLITE_PRAGMAS setting on each new SQLite connection.
+    """
+    sqlite_tuning.configure(connection)
@@ -0,0 +1,84 @@
+# Balance slots for hot Accounts
+# Every payment into an Account updates its row, so a popular payee's Account serializes all of its payers.
+# An Account flagged with balance_slots = N instead receives payments into one of N BalanceSlot rows chosen at random,
+# spreading the writers over N rows. Its balance is Account.balance plus the sum of its slots.
+
+# Withdrawals only ever come out of Account.balance. When that isn't enough, the slots are first folded back into it
+# (consolidate) and the withdrawal is tried again. The consolidate_balance_slots command does the same periodically.
+
+import random
+
+from django.db import transaction
+from django.db.models import F, Sum
+
+from .models import Account, BalanceSlot
+from . import account_cache, routers
+
+
+def configure(account_pk, slots):
+    """
+    Sets the number of balance slots of an Account. 0 turns slots off. Funds in removed slots are consolidated first.
+    :param account_pk:
+    :param slots:
+    :return:
+    """
+    with transaction.atomic(using=routers.primary()):
+        consolidate(account_pk)
+        BalanceSlot.objects.filter(account_id=account_pk, slot__gte=slots).delete()
+        existing = set(BalanceSlot.objects.filter(account_id=account_pk).values_list('slot', flat=True))
+        BalanceSlot.objects.bulk_create([BalanceSlot(account_id=account_pk, slot=slot)
+                                         for slot in range(slots) if slot not in existing])
+        Account.objects.filter(pk=account_pk).update(balance_slots=slots, version=F('version') + 1)
+        account_cache.invalidate(Account.objects.filter(pk=account_pk).values_list('holder_id', flat=True).first())
+
+
+def credit_target(account_pk, slots):
+    """
+    Chooses where a deposit into an Account lands.
+    :param account_pk:
+    :param slots: the Account's balance_slots
+    :return: queryset of the one row to add the deposit's amount to
+    """
+    if not slots:
+        return Account.objects.filter(pk=account_pk)
+    return BalanceSlot.objects.filter(account_id=account_pk, slot=random.randrange(slots))
+
+
+def consolidate(account_pk):
+    """
+    Moves the funds in an Account's slots into Account.balance.
+    Each slot is reduced by the amount we read rather than set to zero, so deposits landing meanwhile are kept.
+    :param account_pk:
+    :return: amount moved
+    """
+    with transaction.atomic(using=routers.primary()):
+        slots = list(BalanceSlot.objects.select_for_update().filter(account_id=account_pk)
+                     .exclude(balance=0).order_by('slot').values_list('pk', 'balance'))
+        for pk, balance in slots:
+            BalanceSlot.objects.filter(pk=pk).update(balance=F('balance') - balance)
+
+        moved = sum(balance for pk, balance in slots)
+        if moved:
+            Account.objects.filter(pk=account_pk).update(balance=F('balance') + moved, version=F('version') + 1)
+        return moved
+
+
+def consolidate_all():
+    """
+    Consolidates every Account that uses slots, on every shard, one Account per transaction.
+    :return: total amount moved
+    """
+    moved = 0
+    for alias in routers.all_shards():
+        with routers.using_shard(alias):
+            for account_pk in Account.objects.filter(balance_slots__gt=0).values_list('pk', flat=True).iterator():
+                moved += consolidate(account_pk)
+    return moved
+
+
+def slot_balance(account_pk):
+    """
+    :param account_pk:
+    :return: sum of an Account's slots
+    """
+    return BalanceSlot.objects.filter(account_id=account_pk).aggregate(total=Sum('balance'))['total'] or 0
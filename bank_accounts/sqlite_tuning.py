@@ -0,0 +1,52 @@
+# SQLite tuning
+# With its default rollback journal, SQLite locks the whole database file while a write commits, and readers wait for
+# it. In WAL mode writes are appended to a write-ahead log instead: readers keep reading the last committed state while
+# the one writer writes, and commits need fewer fsyncs.
+
+# The pragmas of the BANK_ACCOUNTS_SQLITE_PRAGMAS setting are set on every new SQLite connection (see signals). The
+# mysite3.settings_sqlite profile sets them to TUNED and keeps connections open between requests (CONN_MAX_AGE), so
+# each process connects and sets them once instead of on every request. Compare profiles with the bench_sqlite command.
+
+# journal_mode is stored in the database file, so it lasts until set back to DELETE. The other pragmas only last for
+# the connection.
+
+from django.conf import settings
+
+TUNED = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # In WAL mode commits survive a crash of the process, but may be lost on power loss
+    'busy_timeout': 5000,  # Milliseconds to wait for another connection's lock before "database is locked"
+    'cache_size': -64000,  # Pages cached per connection. Negative is in KiB, so about 64 MB.
+    'mmap_size': 256 * 1024 * 1024,  # Bytes of the database file read through memory mapping instead of read()
+    'temp_store': 'MEMORY',  # Temporary tables and indexes, e.g. for sorting
+}
+
+
+def configure(connection, pragmas=None):
+    """
+    Sets pragmas on a database connection, if it is SQLite. They are set on the underlying connection, so they are not
+    counted as queries of the request that happens to connect.
+    :param connection: Django database connection, connected
+    :param pragmas: dict of value by pragma name, defaults to the BANK_ACCOUNTS_SQLITE_PRAGMAS setting
+    :return:
+    """
+    if connection.vendor != 'sqlite':
+        return
+    if pragmas is None:
+        pragmas = getattr(settings, 'BANK_ACCOUNTS_SQLITE_PRAGMAS', {})
+    for name, value in pragmas.items():
+        connection.connection.execute('PRAGMA %s = %s' % (name, value))
+
+
+def current(connection, names=TUNED):
+    """
+    :param connection: Django database connection to SQLite, connected
+    :param names: names of pragmas
+    :return: dict of the current value of each pragma by name, None for those that don't apply (e.g. mmap_size of an
+    in-memory database)
+    """
+    values = {}
+    for name in names:
+        row = connection.connection.execute('PRAGMA %s' % name).fetchone()
+        values[name] = row[0] if row else None
+    return values
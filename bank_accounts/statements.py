@@ -0,0 +1,245 @@
+# Statements
+# Writes a monthly statement of every Account to disk, as HTML (rendered with the statement template) and CSV. A
+# statement lists the Account's ledger entries of the month in date order, with a running balance, between the opening
+# and closing balances and the month's totals. Balances come from BalanceCheckpoints as in bank_accounts.ledger, so no
+# Account's whole history is ever read.
+
+# Accounts are split into chunks that a pool of processes works through, each process with its own database
+# connections. The statements of a chunk are read together, in a few queries. Each statement is written to a temporary
+# file and then renamed, and its CSV file last, so a statement whose CSV file exists is complete. Running the same month
+# again after a crash skips those and writes the rest.
+
+# Every shard's Accounts get statements (see bank_accounts.routers). Account pks are only unique within a shard, so when
+# sharding each shard's statements go in a subdirectory named after it.
+
+import csv
+import datetime
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import Account, InternalTransferReceipt, ExternalTransferReceipt, LedgerEntry, BalanceCheckpoint
+from .exports import DELETED_USER, _account_label
+from . import archive, routers
+
+# Accounts handed to a process at a time
+CHUNK_SIZE = 500
+
+CSV_FIELDS = ['date', 'kind', 'description', 'amount', 'balance']
+
+
+def period_bounds(period):
+    """
+    :param period: month as YYYY-MM
+    :return: (start, end) datetimes of the month in the current time zone, end excluded
+    :raise ValueError: if period is not a month
+    """
+    start = datetime.datetime.strptime(period, '%Y-%m')
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return timezone.make_aware(start), timezone.make_aware(end)
+
+
+def previous_period():
+    """
+    :return: the month before the current one, as YYYY-MM
+    """
+    start, _ = period_bounds(timezone.localtime().strftime('%Y-%m'))
+    return timezone.localtime(start - datetime.timedelta(days=1)).strftime('%Y-%m')
+
+
+def statements(accounts, start, end):
+    """
+    Reads the statements of some Accounts, with a few queries for all of them.
+    :param accounts: list of Accounts, with their holders
+    :param start: datetime the statements start at
+    :param end: datetime the statements end before
+    :return: generator of dicts for the statement template. Accounts opened after the statements end have none.
+    """
+    pks = [account.pk for account in accounts]
+
+    # Latest checkpoint before the statement, or the opening checkpoint of an Account opened during it
+    checkpoints = {}
+    for account_pk, date, balance in BalanceCheckpoint.objects.filter(account_id__in=pks, date__lt=end)\
+            .order_by('account_id', 'date').values_list('account_id', 'date', 'balance'):
+        if account_pk not in checkpoints or date < start:
+            checkpoints[account_pk] = (date, balance)
+    if not checkpoints:
+        return
+
+    # Entries since each Account's checkpoint, oldest first
+    entries = {}
+    since = min(date for date, _ in checkpoints.values())
+    for account_pk, date, kind, receipt_pk, amount in LedgerEntry.objects\
+            .filter(account_id__in=pks, date__gt=since, date__lt=end).order_by('account_id', 'date', 'id')\
+            .values_list('account_id', 'date', 'kind', 'receipt_id', 'amount').iterator(chunk_size=2000):
+        if date > checkpoints.get(account_pk, (end, 0))[0]:
+            entries.setdefault(account_pk, []).append((date, kind, receipt_pk, amount))
+    descriptions = _describe(entries)
+
+    for account in accounts:
+        if account.pk not in checkpoints:
+            continue
+        checkpoint_date, opening = checkpoints[account.pk]
+        lines = []
+        for date, kind, receipt_pk, amount in entries.get(account.pk, ()):
+            if date < start:
+                opening += amount
+                continue
+            balance = (lines[-1]['balance'] if lines else opening) + amount
+            lines.append({'date': date, 'kind': kind, 'amount': amount, 'balance': balance,
+                          'description': descriptions.get((account.pk, kind, receipt_pk), '')})
+
+        yield {
+            'account': account,
+            'holder': account.holder.username if account.holder else DELETED_USER,
+            'start': start,
+            'end': end,
+            'opened': checkpoint_date if checkpoint_date >= start else None,
+            'opening': opening,
+            'closing': lines[-1]['balance'] if lines else opening,
+            'credits': sum(line['amount'] for line in lines if line['amount'] > 0),
+            'debits': -sum(line['amount'] for line in lines if line['amount'] < 0),
+            'lines': lines,
+        }
+
+
+def write(data, directory):
+    """
+    Writes a statement's HTML and CSV files.
+    :param data: statement, see statement
+    :param directory:
+    :return:
+    """
+    path = os.path.join(directory, 'account-%d' % data['account'].pk)
+    _replace(path + '.html', render_to_string('bank_accounts/statement.html', data))
+
+    with open(path + '.csv.tmp', 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for line in data['lines']:
+            writer.writerow(dict(line, date=line['date'].isoformat()))
+    os.replace(path + '.csv.tmp', path + '.csv')  # Last, marks the statement complete
+
+
+def generate(period, directory, processes=1, chunk_size=CHUNK_SIZE, log=None):
+    """
+    Writes the statements of every Account for a month that are not written yet.
+    :param period: month as YYYY-MM
+    :param directory: statements are written to a subdirectory per month
+    :param processes: number of processes. With 1, statements are written in this process.
+    :param chunk_size: Accounts handed to a process at a time
+    :param log: function called with progress messages
+    :return: dict with counts of statements written and Accounts skipped (already written or opened later), and
+    seconds taken
+    """
+    start_time = time.perf_counter()
+    log = log or (lambda message: None)
+    period_bounds(period)  # Fails early on a bad period
+    directory = os.path.join(directory, period)
+
+    chunks = []  # (shard alias, shard's directory, Account pks)
+    accounts = 0
+    for alias in routers.all_shards():
+        shard_directory = os.path.join(directory, alias) if routers.shards() else directory
+        os.makedirs(shard_directory, exist_ok=True)
+        with routers.using_shard(alias):
+            pks = list(Account.objects.order_by('pk').values_list('pk', flat=True))
+        chunks += [(alias, shard_directory, pks[offset:offset + chunk_size])
+                   for offset in range(0, len(pks), chunk_size)]
+        accounts += len(pks)
+
+    totals = {'written': 0, 'skipped': 0}
+    if processes == 1:
+        results = (write_chunk(period, shard_directory, chunk, alias) for alias, shard_directory, chunk in chunks)
+    else:
+        connections.close_all()  # Connections can't be shared with the new processes
+        executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'))
+        results = (future.result() for future in
+                   as_completed([executor.submit(write_chunk, period, shard_directory, chunk, alias)
+                                 for alias, shard_directory, chunk in chunks]))
+    try:
+        for written, skipped in results:
+            totals['written'] += written
+            totals['skipped'] += skipped
+            done = totals['written'] + totals['skipped']
+            log('%d of %d Accounts, %.0f accounts/s' % (done, accounts, done / (time.perf_counter() - start_time)))
+    finally:
+        if processes != 1:
+            executor.shutdown(cancel_futures=True)
+
+    totals['seconds'] = time.perf_counter() - start_time
+    return totals
+
+
+def write_chunk(period, directory, pks, alias=DEFAULT_DB_ALIAS):
+    """
+    Writes the statements of some Accounts. Runs in a worker process.
+    :param alias: alias of the shard holding the Accounts
+    :return: (statements written, Accounts skipped)
+    """
+    with routers.using_shard(alias):
+        return _write_chunk(period, directory, pks)
+
+
+def _write_chunk(period, directory, pks):
+    start, end = period_bounds(period)
+    # Statements written before a crash are skipped
+    accounts = [account for account in Account.objects.filter(pk__in=pks).select_related('holder').order_by('pk')
+                if not os.path.exists(os.path.join(directory, 'account-%d.csv' % account.pk))]
+    written = 0
+    for data in statements(accounts, start, end):
+        write(data, directory)
+        written += 1
+    skipped = len(pks) - written  # Also counts Accounts deleted or opened after the statements end
+    return written, skipped
+
+
+def _describe(entries):
+    """
+    Describes the transfers behind Accounts' ledger entries, reading each kind of receipt in one query.
+    :param entries: dict of lists of (date, kind, receipt pk, amount) by Account pk
+    :return: dict of description by (Account pk, kind, receipt pk)
+    """
+    wanted = {}
+    for account_entries in entries.values():
+        for _, kind, receipt_pk, _ in account_entries:
+            wanted.setdefault(kind, set()).add(receipt_pk)
+
+    descriptions = {}
+    if LedgerEntry.INTERNAL_TRANSFER in wanted:
+        for model in archive.receipt_models(InternalTransferReceipt):
+            for pk, from_pk, from_type, to_pk, to_type in model.objects\
+                    .filter(pk__in=wanted[LedgerEntry.INTERNAL_TRANSFER])\
+                    .values_list('pk', 'from_account_id', 'from_account__account_type', 'to_account_id',
+                                 'to_account__account_type'):
+                kind = LedgerEntry.INTERNAL_TRANSFER
+                descriptions[(from_pk, kind, pk)] = 'Transfer to ' + _account_label(to_pk, to_type)
+                descriptions[(to_pk, kind, pk)] = 'Transfer from ' + _account_label(from_pk, from_type)
+
+    if LedgerEntry.EXTERNAL_TRANSFER in wanted:
+        for model in archive.receipt_models(ExternalTransferReceipt):
+            for pk, from_pk, to_pk, payer, payee, comment in model.objects\
+                    .filter(pk__in=wanted[LedgerEntry.EXTERNAL_TRANSFER])\
+                    .values_list('pk', 'from_account_id', 'to_account_id', 'payer__username', 'payee__username',
+                                 'comment'):
+                kind = LedgerEntry.EXTERNAL_TRANSFER
+                comment = ': ' + comment if comment else ''
+                descriptions[(from_pk, kind, pk)] = 'Payment to ' + (payee or DELETED_USER) + comment
+                descriptions[(to_pk, kind, pk)] = 'Payment from ' + (payer or DELETED_USER) + comment
+
+    for account_pk, account_entries in entries.items():
+        for _, kind, receipt_pk, _ in account_entries:
+            if kind == LedgerEntry.INTEREST:
+                descriptions[(account_pk, kind, receipt_pk)] = 'Interest'
+    return descriptions
+
+
+def _replace(path, text):
+    with open(path + '.tmp', 'w') as file:
+        file.write(text)
+    os.replace(path + '.tmp', path)
@@ -1,12 +1,40 @@
 # Tests are project specific
 
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.test import TestCase as DjangoTestCase, AsyncClient, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.db.models import Max
+from django.db.backends.signals import connection_created
+from django.core.cache import caches
 from django.urls import reverse
-
-from bank_accounts.models import Account
+from django.utils import timezone
+
+from bank_accounts.models import Account, InternalTransferReceipt, ExternalTransferReceipt, LedgerEntry, \
+    BalanceCheckpoint, BalanceSlot, IdempotencyKey, RecurringTransfer, QueuedTransfer, InterestAccrual, DailyAccountTotal, PayeeTotal, \
+    CrossShardTransfer, ArchivedInternalTransferReceipt, ArchivedExternalTransferReceipt, DefaultReceivingAccount
+from bank_accounts.exceptions import InsufficientFunds, InvalidAccount, NotCheckingAccount, ConcurrentUpdate, \
+    NoCheckingAccount, InvalidPayee, InvalidAmount, VelocityLimitExceeded
+from bank_accounts import transfers, payees, ledger, slots, idempotency, account_cache, exports, datagen, loadtest, \
+    instrumentation, recurring, workers, transfer_queue, interest, statements, rollups, batch, versioning, routers, \
+    cross_shard, sqlite_tuning, archive, pagination, receiving, events, velocity
+from bank_accounts.views import AccountListView
 from django.contrib.auth.models import User
 
+import asyncio
+import calendar
+import csv
+import datetime
+import json
+import os
+import pickle
 import random
+import shutil
+import tempfile
+import time
+from fractions import Fraction
+from unittest import mock, skipUnless
 
 # Create your tests here.
 
@@ -14,6 +42,20 @@ import random
 # TODO: Emailing users password resets.
 
 
+@override_settings(BANK_ACCOUNTS_ENFORCE_QUERY_BUDGETS=True)  # A view issuing more queries than its budget fails
+class TestCase(DjangoTestCase):
+    """
+    Clears caches before each test. Rolling back a test's database changes doesn't clear them, and primary keys are
+    reused between tests.
+    """
+    def setUp(self):
+        caches[account_cache.CACHE_ALIAS].clear()
+        payees._search_cache.clear()
+        idempotency._recent.clear()
+        receiving._cache.clear()
+        velocity._counters.clear()
+
+
 class UserTests(TestCase):
     """
     Testing clients who are logged in as Users.
@@ -551,6 +593,2030 @@ class InternalTransferReceiptListViewTests(TestCase):
         
         self.assertEqual(response.status_code, 200)  # OK
 
+    def test_pagination(self):
+        """
+        History is shown newest first, one page at a time, and each page costs the same number of queries, but for the
+        last, which also looks for archived receipts.
+        :return:
+        """
+        user = create_user('username', 'password')
+        account_1 = create_account(holder=user, balance=100)
+        account_2 = create_account(holder=user, balance=100)
+        date = timezone.now()
+        InternalTransferReceipt.objects.bulk_create([
+            InternalTransferReceipt(user=user, from_account=account_1, to_account=account_2, amount=i, date=date)
+            for i in range(120)])
+        self.client.login(username='username', password='password')
+
+        seen = []
+        cursor = None
+        page_queries = []
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.url, {'cursor': cursor} if cursor else {})
+            page_queries.append(len(queries))
+            seen.extend(receipt.amount for receipt in response.context['receipts'])
+            cursor = response.context['page_obj'].next_cursor
+            if cursor is None:
+                break
+
+        # Receipts with the same date are ordered by id, and every receipt is shown exactly once
+        self.assertEqual(seen, list(reversed(range(120))))
+        self.assertEqual(len(page_queries), 3)
+        self.assertEqual(page_queries[1], page_queries[0])
+        self.assertEqual(page_queries[2], page_queries[0] + 1)
+
+
+class ExternalTransferViewTests(TestCase):
+
+    url = reverse('bank_accounts:external_transfer')
+
+    def test_valid_payment(self):
+        """
+        Users can pay another User, whose Checking Account receives the funds.
+        :return:
+        """
+        payer = create_user('payer', 'password')
+        payee = create_user('payee', 'password')
+        from_account = create_account(holder=payer, account_type=Account.CHECKING, balance=100)
+        to_account = create_account(holder=payee, account_type=Account.CHECKING, balance=0)
+        self.client.login(username='payer', password='password')
+
+        response = self.client.post(path=self.url, data={
+            'from_account': from_account.pk,
+            'payee': payee.pk,
+            'amount': 40,
+            'comment': 'Rent'})
+
+        self.assertRedirects(response, reverse('bank_accounts:home'))
+        self.assertEqual(Account.objects.get(pk=from_account.pk).balance, 60)
+        self.assertEqual(Account.objects.get(pk=to_account.pk).balance, 40)
+        self.assertEqual(ExternalTransferReceipt.objects.get().comment, 'Rent')
+
+    def test_not_authorized(self):
+        """
+        Users cannot pay from an Account they don't hold.
+        :return:
+        """
+        payer = create_user('payer', 'password')
+        payee = create_user('payee', 'password')
+        create_account(holder=payer, account_type=Account.CHECKING, balance=100)
+        payee_account = create_account(holder=payee, account_type=Account.CHECKING, balance=100)
+        self.client.login(username='payer', password='password')
+
+        # Payer attempts to pay the payee using the payee's own Account
+        self.client.post(path=self.url, data={
+            'from_account': payee_account.pk,
+            'payee': payee.pk,
+            'amount': 100})
+
+        # Payment does not occur
+        self.assertEqual(Account.objects.get(pk=payee_account.pk).balance, 100)
+        self.assertFalse(ExternalTransferReceipt.objects.exists())
+
+    def test_not_enough_funds(self):
+        """
+        Users cannot pay more than they have, and a refused payment leaves both Accounts untouched.
+        :return:
+        """
+        payer = create_user('payer', 'password')
+        payee = create_user('payee', 'password')
+        from_account = create_account(holder=payer, account_type=Account.CHECKING, balance=100)
+        to_account = create_account(holder=payee, account_type=Account.CHECKING, balance=0)
+        self.client.login(username='payer', password='password')
+
+        self.client.post(path=self.url, data={
+            'from_account': from_account.pk,
+            'payee': payee.pk,
+            'amount': 101})
+
+        self.assertEqual(Account.objects.get(pk=from_account.pk).balance, 100)
+        self.assertEqual(Account.objects.get(pk=to_account.pk).balance, 0)
+        self.assertFalse(ExternalTransferReceipt.objects.exists())
+
+    def test_pay_by_username(self):
+        """
+        Users can choose who to pay by username.
+        :return:
+        """
+        payer = create_user('payer', 'password')
+        payee = create_user('payee', 'password')
+        from_account = create_account(holder=payer, account_type=Account.CHECKING, balance=100)
+        to_account = create_account(holder=payee, account_type=Account.CHECKING, balance=0)
+        self.client.login(username='payer', password='password')
+
+        self.client.post(path=self.url, data={
+            'from_account': from_account.pk,
+            'payee_username': 'payee',
+            'amount': 100})
+
+        self.assertEqual(Account.objects.get(pk=to_account.pk).balance, 100)
+
+
+    def test_receipt_pagination(self):
+        """
+        Payments sent and received are merged into one history, newest first, each page costing the same. Pages are
+        read through the payer and payee indexes, bounded by the cursor, without sorting the whole history.
+        :return:
+        """
+        user = create_user('username', 'password')
+        other = create_user('other', 'password')
+        account = create_account(holder=user, balance=100)
+        other_account = create_account(holder=other, balance=100)
+        date = timezone.now()
+        ExternalTransferReceipt.objects.bulk_create([
+            ExternalTransferReceipt(payer=user, payee=other, from_account=account, to_account=other_account, amount=i,
+                                    date=date - datetime.timedelta(seconds=i)) if i % 3 else
+            ExternalTransferReceipt(payer=other, payee=user, from_account=other_account, to_account=account, amount=i,
+                                    date=date - datetime.timedelta(seconds=i))
+            for i in range(120)])
+        self.client.login(username='username', password='password')
+
+        seen = []
+        cursor = None
+        page_queries = []
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('bank_accounts:external_transfer_receipt_list'),
+                                           {'cursor': cursor} if cursor else {})
+            page_queries.append(len(queries))
+            seen.extend(receipt.amount for receipt in response.context['receipts'])
+            cursor = response.context['page_obj'].next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(seen, list(range(120)))
+        self.assertEqual(page_queries[1], page_queries[0])
+
+        if connection.vendor == 'sqlite':
+            position = pagination.decode_cursor(pagination.encode_cursor(ExternalTransferReceipt.objects.first()))
+            for side in ({'payer': user}, {'payee': user}):
+                plan = pagination._after(ExternalTransferReceipt.objects.filter(**side), position)[:50].explain()
+                self.assertIn('date<', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+
+class PayeeSearchViewTests(TestCase):
+
+    url = reverse('bank_accounts:payee_search')
+
+    def test_prefix_search(self):
+        """
+        Searching returns Users whose username starts with the query, except the searching User, up to a limit.
+        :return:
+        """
+        create_user('alice', 'password')
+        for i in range(payees.MAX_RESULTS + 5):
+            create_user('bob%02d' % i, 'password')
+        create_user('carol', 'password')
+        self.client.login(username='alice', password='password')
+
+        response = self.client.get(self.url, {'q': 'bob'})
+        usernames = [result['username'] for result in response.json()['results']]
+        self.assertEqual(usernames, ['bob%02d' % i for i in range(payees.MAX_RESULTS)])
+
+        response = self.client.get(self.url, {'q': 'a'})
+        self.assertEqual(response.json()['results'], [])
+
+        # Repeated searches are answered from the cache
+        with self.assertNumQueries(2):  # Session and User only
+            self.client.get(self.url, {'q': 'bob'})
+
+
+class TransferServiceTests(TestCase):
+    """
+    Testing bank_accounts.transfers directly.
+    """
+    def test_refused_credit_rolls_back_debit(self):
+        """
+        If the deposit side of a transfer is refused after the withdrawal ran, then the withdrawal is undone.
+        :return:
+        """
+        user_1 = create_user('user_1', 'password')
+        user_2 = create_user('user_2', 'password')
+        account_1 = create_account(holder=user_1, balance=100)
+        account_2 = create_account(holder=user_2, balance=100)  # Higher pk, so it is updated second
+
+        with self.assertRaises(InvalidAccount):
+            transfers.internal_transfer(user_1, account_1.pk, account_2.pk, 50)
+
+        self.assertEqual(Account.objects.get(pk=account_1.pk).balance, 100)
+        self.assertEqual(Account.objects.get(pk=account_2.pk).balance, 100)
+
+    def test_internal_transfer_queries(self):
+        """
+        A successful internal transfer costs three UPDATEs and three INSERTs.
+        :return:
+        """
+        user = create_user('username', 'password')
+        account_1 = create_account(holder=user, balance=100)
+        account_2 = create_account(holder=user, balance=100)
+
+        with CaptureQueriesContext(connection) as queries:
+            transfers.internal_transfer(user, account_2.pk, account_1.pk, 100)
+
+        # TestCase wraps the transfer's transaction in a savepoint, which we don't count
+        statements = [query['sql'] for query in queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 6)
+
+        self.assertEqual(Account.objects.get(pk=account_1.pk).balance, 200)
+        self.assertEqual(Account.objects.get(pk=account_2.pk).balance, 0)
+
+    def test_withdraw(self):
+        """
+        Account.withdraw refuses to overdraw.
+        :return:
+        """
+        account = create_account(holder=create_user(), balance=100)
+        with self.assertRaises(InsufficientFunds):
+            account.withdraw(101)
+        account.withdraw(100)
+        self.assertEqual(account.balance, 0)
+
+
+class BatchTransferViewTests(TestCase):
+
+    url = reverse('bank_accounts:batch_transfer')
+
+    def test_json_batch(self):
+        """
+        A batch applies each accepted transfer in order and reports refused ones without stopping.
+        :return:
+        """
+        user = create_user('username', 'password')
+        payee = create_user('payee', 'password')
+        checking = create_account(holder=user, account_type=Account.CHECKING, balance=100)
+        savings = create_account(holder=user, account_type=Account.SAVINGS, balance=0)
+        payee_checking = create_account(holder=payee, account_type=Account.CHECKING, balance=0)
+        self.client.login(username='username', password='password')
+
+        transfers = [
+            {'type': 'internal', 'from_account': checking.pk, 'to_account': savings.pk, 'amount': 60},
+            {'type': 'external', 'from_account': checking.pk, 'payee': payee.pk, 'amount': 50},  # Not enough left
+            {'type': 'external', 'from_account': checking.pk, 'payee': payee.pk, 'amount': 40, 'comment': 'Pay'},
+            {'type': 'internal', 'from_account': savings.pk, 'to_account': savings.pk, 'amount': 1},
+            {'type': 'internal', 'from_account': 'not a number'},
+        ]
+        response = self.client.post(self.url, data=json.dumps({'transfers': transfers}),
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['ok'] for result in results], [True, False, True, False, False])
+        self.assertEqual(results[1]['error'], 'Not enough funds.')
+        self.assertEqual(Account.objects.get(pk=checking.pk).balance, 0)
+        self.assertEqual(Account.objects.get(pk=savings.pk).balance, 60)
+        self.assertEqual(Account.objects.get(pk=payee_checking.pk).balance, 40)
+        self.assertEqual(InternalTransferReceipt.objects.count(), 1)
+        self.assertEqual(ExternalTransferReceipt.objects.get().comment, 'Pay')
+
+    def test_csv_batch(self):
+        """
+        Batches may be submitted as CSV, and their cost in queries does not grow with their size.
+        :return:
+        """
+        user = create_user('username', 'password')
+        accounts = [create_account(holder=user, balance=1000) for i in range(10)]
+        self.client.login(username='username', password='password')
+
+        rows = ['type,from_account,to_account,amount']
+        for i in range(200):
+            rows.append('internal,%d,%d,1' % (accounts[i % 10].pk, accounts[(i + 1) % 10].pk))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, data='\n'.join(rows), content_type='text/csv')
+
+        self.assertEqual(response.json()['succeeded'], 200)
+        self.assertLess(len(queries), 20)
+        self.assertEqual(InternalTransferReceipt.objects.count(), 200)
+        self.assertEqual(sum(Account.objects.values_list('balance', flat=True)), 10000)
+
+    def test_amounts_must_be_integers(self):
+        """
+        Amounts that aren't integers, such as fractions or text, are refused rather than rounded or converted.
+        :return:
+        """
+        user = create_user('username', 'password')
+        checking = create_account(holder=user, account_type=Account.CHECKING, balance=100)
+        savings = create_account(holder=user, account_type=Account.SAVINGS, balance=0)
+        self.client.login(username='username', password='password')
+
+        items = [{'type': 'internal', 'from_account': checking.pk, 'to_account': savings.pk, 'amount': amount}
+                 for amount in (12.9, '5', True, 7)]
+        response = self.client.post(self.url, data=json.dumps(items), content_type='application/json')
+        results = response.json()['results']
+        self.assertEqual([result['ok'] for result in results], [False, False, False, True])
+        self.assertEqual(results[0]['error'], batch.ERROR_MESSAGES[InvalidAmount])
+        self.assertEqual(Account.objects.get(pk=savings.pk).balance, 7)
+
+        rows = ['type,from_account,to_account,amount', 'internal,%d,%d,3' % (checking.pk, savings.pk),
+                'internal,%d,%d,2.5' % (checking.pk, savings.pk)]
+        response = self.client.post(self.url, data='\n'.join(rows), content_type='text/csv')
+        self.assertEqual([result['ok'] for result in response.json()['results']], [True, False])
+        self.assertEqual(Account.objects.get(pk=savings.pk).balance, 10)
+
+    def test_invalid_batch(self):
+        """
+        A body that isn't a batch of transfers is rejected.
+        :return:
+        """
+        create_user('username', 'password')
+        self.client.login(username='username', password='password')
+
+        response = self.client.post(self.url, data='{not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class LedgerTests(TestCase):
+    """
+    Testing bank_accounts.ledger.
+    """
+    def test_transfer_entries(self):
+        """
+        Each transfer adds a debit and a credit that balance out.
+        :return:
+        """
+        user = create_user('username', 'password')
+        account_1 = create_account(holder=user, balance=100)
+        account_2 = create_account(holder=user, balance=100)
+
+        receipt = transfers.internal_transfer(user, account_1.pk, account_2.pk, 30)
+
+        entries = LedgerEntry.objects.filter(receipt_id=receipt.pk, kind=LedgerEntry.INTERNAL_TRANSFER)
+        self.assertEqual(sorted(entries.values_list('account_id', 'amount')),
+                         sorted([(account_1.pk, -30), (account_2.pk, 30)]))
+
+    def test_balance_at(self):
+        """
+        The balance at any time is derived from checkpoints and the entries since.
+        :return:
+        """
+        user = create_user('username', 'password')
+        account_1 = create_account(holder=user, balance=100)
+        account_2 = create_account(holder=user, balance=0)
+        opened = timezone.now()
+
+        for i in range(5):
+            transfers.internal_transfer(user, account_1.pk, account_2.pk, 10)
+        middle = timezone.now()
+        self.assertEqual(ledger.checkpoint_accounts(cutoff=middle), 2)
+        for i in range(3):
+            transfers.internal_transfer(user, account_1.pk, account_2.pk, 10)
+
+        self.assertEqual(ledger.balance_at(account_1.pk, opened), 100)
+        self.assertEqual(ledger.balance_at(account_1.pk, middle), 50)
+        self.assertEqual(ledger.balance_at(account_1.pk, timezone.now()), 20)
+        self.assertEqual(ledger.balance_at(account_2.pk, timezone.now()), 80)
+
+        # Idle Accounts are not checkpointed again
+        self.assertEqual(ledger.checkpoint_accounts(cutoff=middle), 0)
+
+    def test_checkpoint_idle_accounts(self):
+        """
+        With min_entries=0 every Account is checkpointed, including those without new entries.
+        :return:
+        """
+        user = create_user('username', 'password')
+        account = create_account(holder=user, balance=100)
+        cutoff = timezone.now()
+
+        self.assertEqual(ledger.checkpoint_accounts(cutoff=cutoff, min_entries=0), 1)
+        self.assertEqual(BalanceCheckpoint.objects.get(account=account, date=cutoff).balance, 100)
+        with self.assertRaises(ValueError):
+            ledger.checkpoint_accounts(min_entries=-1)
+
+    def test_migrate_receipts(self):
+        """
+        Receipts saved before the ledger existed are migrated into it, with opening balances that explain the
+        Accounts' current balances.
+        :return:
+        """
+        user = create_user('username', 'password')
+        account_1 = create_account(holder=user, balance=70)
+        account_2 = create_account(holder=user, balance=30)
+        InternalTransferReceipt.objects.create(user=user, from_account=account_1, to_account=account_2, amount=30)
+        # Pretend the ledger didn't exist
+        BalanceCheckpoint.objects.all().delete()
+
+        self.assertEqual(ledger.migrate_receipts(), (2, 2))
+        self.assertEqual(ledger.migrate_receipts(), (0, 0))  # Nothing left to migrate
+
+        self.assertEqual(BalanceCheckpoint.objects.get(account=account_1).balance, 100)
+        self.assertEqual(ledger.balance_at(account_1.pk, timezone.now()), 70)
+        self.assertEqual(ledger.balance_at(account_2.pk, timezone.now()), 30)
+
+    def test_migrate_receipts_with_slots(self):
+        """
+        The opening balance of an Account with balance slots also explains the funds waiting in its slots.
+        :return:
+        """
+        payer = create_user('payer', 'password')
+        payee = create_user('payee', 'password')
+        from_account = create_account(holder=payer, account_type=Account.CHECKING, balance=100)
+        hot_account = create_account(holder=payee, account_type=Account.CHECKING, balance=10)
+        slots.configure(hot_account.pk, 4)
+        transfers.external_transfer(payer, from_account.pk, payee.pk, 25)
+        # Pretend the ledger didn't exist
+        LedgerEntry.objects.all().delete()
+        BalanceCheckpoint.objects.all().delete()
+
+        self.assertEqual(ledger.migrate_receipts(), (2, 2))
+        self.assertEqual(BalanceCheckpoint.objects.get(account=hot_account).balance, 10)
+        self.assertEqual(ledger.balance_at(hot_account.pk, timezone.now()), 35)
+
+    def test_migrate_receipts_of_deleted_accounts(self):
+        """
+        Receipts whose Accounts were deleted are migrated without entries for the missing sides, and don't stop the
+        migration.
+        :return:
+        """
+        user = create_user('username', 'password')
+        account_1 = create_account(holder=user, balance=70)
+        account_2 = create_account(holder=user, balance=30)
+        account_3 = create_account(holder=user, balance=0)
+        InternalTransferReceipt.objects.create(user=user, from_account=account_1, to_account=account_2, amount=30)
+        InternalTransferReceipt.objects.create(user=user, from_account=account_3, to_account=account_2, amount=10)
+        InternalTransferReceipt.objects.create(user=user, from_account=account_3, to_account=account_1, amount=5)
+        account_2.delete()  # Leaves a receipt with neither Account
+        account_3.delete()
+        InternalTransferReceipt.objects.create(user=user, from_account=account_1, to_account=None, amount=1)
+
+        self.assertEqual(ledger.migrate_receipts(chunk_size=1), (3, 0))
+        self.assertEqual(ledger.migrate_receipts(chunk_size=1), (0, 0))
+        self.assertEqual(LedgerEntry.objects.filter(account=account_1).count(), 3)
+
+
+class BalanceSlotTests(TestCase):
+    """
+    Testing bank_accounts.slots.
+    """
+    def test_payments_into_slots(self):
+        """
+        Payments into an Account with balance slots land in the slots, and count towards its balance.
+        :return:
+        """
+        payer = create_user('payer', 'password')
+        payee = create_user('payee', 'password')
+        from_account = create_account(holder=payer, account_type=Account.CHECKING, balance=100)
+        hot_account = create_account(holder=payee, account_type=Account.CHECKING, balance=10)
+        slots.configure(hot_account.pk, 4)
+
+        for i in range(20):
+            transfers.external_transfer(payer, from_account.pk, payee.pk, 5)
+
+        hot_account.refresh_from_db()
+        self.assertEqual(hot_account.balance, 10)
+        self.assertEqual(hot_account.total_balance, 110)
+        self.assertEqual(BalanceSlot.objects.filter(account=hot_account).count(), 4)
+
+    def test_withdraw_from_slots(self):
+        """
+        Funds waiting in slots can be spent: they are consolidated when the Account's own balance isn't enough.
+        :return:
+        """
+        payer = create_user('payer', 'password')
+        payee = create_user('payee', 'password')
+        from_account = create_account(holder=payer, account_type=Account.CHECKING, balance=100)
+        hot_account = create_account(holder=payee, account_type=Account.CHECKING, balance=0)
+        savings = create_account(holder=payee, account_type=Account.SAVINGS, balance=0)
+        slots.configure(hot_account.pk, 2)
+        transfers.external_transfer(payer, from_account.pk, payee.pk, 100)
+
+        transfers.internal_transfer(payee, hot_account.pk, savings.pk, 60)
+
+        hot_account.refresh_from_db()
+        self.assertEqual(hot_account.balance, 40)  # Slots were folded into the balance
+        self.assertEqual(hot_account.total_balance, 40)
+        with self.assertRaises(InsufficientFunds):
+            transfers.internal_transfer(payee, hot_account.pk, savings.pk, 41)
+
+    def test_configure_off(self):
+        """
+        Turning slots off keeps their funds.
+        :return:
+        """
+        account = create_account(holder=create_user(), balance=0)
+        slots.configure(account.pk, 3)
+        BalanceSlot.objects.filter(account=account).update(balance=7)
+
+        slots.configure(account.pk, 0)
+
+        account.refresh_from_db()
+        self.assertEqual(account.balance, 21)
+        self.assertFalse(BalanceSlot.objects.filter(account=account).exists())
+
+
+class IdempotencyTests(TestCase):
+    """
+    Testing retries of transfer requests carrying an idempotency key.
+    """
+    def test_retried_payment(self):
+        """
+        Retrying a payment with the same Idempotency-Key header does not pay twice.
+        :return:
+        """
+        payer = create_user('payer', 'password')
+        payee = create_user('payee', 'password')
+        from_account = create_account(holder=payer, account_type=Account.CHECKING, balance=100)
+        create_account(holder=payee, account_type=Account.CHECKING, balance=0)
+        self.client.login(username='payer', password='password')
+
+        data = {'from_account': from_account.pk, 'payee': payee.pk, 'amount': 10}
+        url = reverse('bank_accounts:external_transfer')
+        self.client.post(url, data=data, HTTP_IDEMPOTENCY_KEY='payment-1')
+        self.client.post(url, data=data, HTTP_IDEMPOTENCY_KEY='payment-1')
+        self.client.post(url, data=data, HTTP_IDEMPOTENCY_KEY='payment-2')
+
+        self.assertEqual(Account.objects.get(pk=from_account.pk).balance, 80)
+        self.assertEqual(ExternalTransferReceipt.objects.count(), 2)
+
+    def test_resubmitted_form(self):
+        """
+        Resubmitting an internal transfer form does not transfer twice.
+        :return:
+        """
+        user = create_user('username', 'password')
+        account_1 = create_account(holder=user, balance=100)
+        account_2 = create_account(holder=user, balance=100)
+        self.client.login(username='username', password='password')
+
+        url = reverse('bank_accounts:internal_transfer')
+        key = self.client.get(url).context['idempotency_key']
+        for i in range(2):
+            response = self.client.post(url, data={'from_account': account_1.pk, 'to_account': account_2.pk,
+                                                   'balance': 10, 'idempotency_key': key})
+            self.assertContains(response, 'Internal transfer successful.')
+
+        self.assertEqual(Account.objects.get(pk=account_1.pk).balance, 90)
+
+    def test_replay_cost(self):
+        """
+        Replaying a transfer costs at most one query, and none when the key is cached.
+        :return:
+        """
+        user = create_user('username', 'password')
+        account_1 = create_account(holder=user, balance=100)
+        account_2 = create_account(holder=user, balance=100)
+
+        def transfer():
+            return transfers.internal_transfer(user, account_1.pk, account_2.pk, 10)
+
+        receipt_id, replayed = idempotency.run_once(user, IdempotencyKey.INTERNAL_TRANSFER, 'key', transfer)
+        self.assertFalse(replayed)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(idempotency.run_once(user, IdempotencyKey.INTERNAL_TRANSFER, 'key', transfer),
+                             (receipt_id, True))
+        idempotency._recent.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(idempotency.run_once(user, IdempotencyKey.INTERNAL_TRANSFER, 'key', transfer),
+                             (receipt_id, True))
+        self.assertEqual(Account.objects.get(pk=account_1.pk).balance, 90)
+
+
+class AccountCacheTests(TestCase):
+    """
+    Testing bank_accounts.account_cache.
+    """
+    def test_cached_account_list(self):
+        """
+        A User's Accounts are read from the database once, until one of them changes.
+        :return:
+        """
+        user = create_user('username', 'password')
+        account = create_account(holder=user, account_type=Account.CHECKING, balance=100)
+        self.client.login(username='username', password='password')
+        url = reverse('bank_accounts:account_list')
+
+        self.client.get(url)
+        with self.assertNumQueries(4):  # Session and User of each request only
+            self.client.get(url)
+            self.client.get(reverse('bank_accounts:account_detail', kwargs={'pk': account.pk}))
+
+        # Saving an Account invalidates the cache
+        account.balance = 50
+        account.save()
+        self.assertContains(self.client.get(url), '$50')
+
+    def test_transfer_invalidates(self):
+        """
+        Transfers change balances without saving Accounts, but still invalidate both holders' cached Accounts.
+        :return:
+        """
+        payer = create_user('payer', 'password')
+        payee = create_user('payee', 'password')
+        from_account = create_account(holder=payer, account_type=Account.CHECKING, balance=100)
+        to_account = create_account(holder=payee, account_type=Account.CHECKING, balance=0)
+        account_cache.holder_accounts(payer)
+        account_cache.holder_accounts(payee)
+
+        transfers.external_transfer(payer, from_account.pk, payee.pk, 30)
+
+        self.assertEqual(account_cache.holder_accounts(payer)[0].total_balance, 70)
+        self.assertEqual(account_cache.holder_accounts(payee)[0].total_balance, 30)
+
+    def test_no_user_cached(self):
+        """
+        Only Account values are cached, not the holder with the password hash, but Accounts read back have a holder.
+        :return:
+        """
+        user = create_user('username', 'password')
+        create_account(holder=user, account_type=Account.CHECKING, balance=100)
+        account_cache.holder_accounts(user)
+
+        cached = caches[account_cache.CACHE_ALIAS].get(account_cache._key(user.pk))
+        self.assertNotIn(user.password.encode(), pickle.dumps(cached))
+        self.assertEqual(account_cache.holder_accounts(user)[0].holder, user)
+
+    @override_settings(BANK_ACCOUNTS_METRICS_ALLOWED_IPS=['127.0.0.1'])
+    def test_metrics(self):
+        """
+        Cache counters can be scraped from allowed addresses.
+        :return:
+        """
+        response = self.client.get(reverse('bank_accounts:metrics'))
+        self.assertContains(response, 'bank_accounts_account_cache_hits_total')
+        response = self.client.get(reverse('bank_accounts:metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+
+class ReceiptExportTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('alice', 'password')
+        self.other = create_user('bob', 'password')
+        self.checking = create_account(self.user, Account.CHECKING, balance=1000)
+        self.savings = create_account(self.user, Account.SAVINGS, balance=0)
+        self.other_checking = create_account(self.other, Account.CHECKING, balance=1000)
+        self.client.login(username='alice', password='password')
+
+    def export(self, name, **params):
+        response = self.client.get(reverse('bank_accounts:' + name), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_internal_csv(self):
+        """
+        Internal transfers are exported oldest first, with deleted Accounts labelled.
+        :return:
+        """
+        transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 10)
+        transfers.internal_transfer(self.user, self.savings.pk, self.checking.pk, 4)
+        self.savings.delete()
+
+        lines = self.export('internal_transfer_export', format='csv').splitlines()
+        self.assertEqual(lines[0], ','.join(exports.INTERNAL_FIELDS))
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith(',10,%s,Deleted Account' % self.checking))
+        self.assertTrue(lines[2].endswith(',4,Deleted Account,%s' % self.checking))
+
+    def test_external_jsonl(self):
+        """
+        Payments sent and received are both exported, marked by direction.
+        :return:
+        """
+        transfers.external_transfer(self.user, self.checking.pk, self.other.pk, 25, 'rent')
+        transfers.external_transfer(self.other, self.other_checking.pk, self.user.pk, 5)
+
+        rows = [json.loads(line) for line in self.export('external_transfer_export', format='jsonl').splitlines()]
+        self.assertEqual([(row['direction'], row['amount'], row['payee']) for row in rows],
+                         [('sent', 25, 'bob'), ('received', 5, 'alice')])
+        self.assertEqual(rows[0]['comment'], 'rent')
+
+    def test_filters(self):
+        """
+        Exports can be limited to one Account and to a date range; bad parameters are refused.
+        :return:
+        """
+        transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 10)
+        InternalTransferReceipt.objects.update(date=timezone.now() - datetime.timedelta(days=10))
+        transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 20)
+        transfers.external_transfer(self.user, self.checking.pk, self.other.pk, 30)
+
+        start = (timezone.now() - datetime.timedelta(days=1)).date().isoformat()
+        rows = self.export('internal_transfer_export', format='jsonl', start=start).splitlines()
+        self.assertEqual([json.loads(row)['amount'] for row in rows], [20])
+
+        rows = self.export('external_transfer_export', format='jsonl', account=self.savings.pk).splitlines()
+        self.assertEqual(rows, [])
+
+        response = self.client.get(reverse('bank_accounts:internal_transfer_export'), {'start': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('bank_accounts:internal_transfer_export'), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+
+class GenerateBankDataTests(TestCase):
+
+    def test_generated_data_is_consistent(self):
+        """
+        Generated balances never go negative and agree with the ledger.
+        :return:
+        """
+        written = datagen.generate(users=30, accounts_per_user=2, internal_transfers=300, external_transfers=300,
+                                   max_balance=100, mean_amount=20, payee_skew=2.0, seed=1)
+
+        self.assertEqual(User.objects.count(), 30)
+        self.assertEqual(Account.objects.count(), written['accounts'])
+        self.assertEqual(InternalTransferReceipt.objects.count(), written['internal_transfers'])
+        self.assertEqual(ExternalTransferReceipt.objects.count(), written['external_transfers'])
+        self.assertEqual(LedgerEntry.objects.count(),
+                         2 * (written['internal_transfers'] + written['external_transfers']))
+        self.assertGreater(written['internal_transfers'], 0)
+        self.assertGreater(written['external_transfers'], 0)
+
+        now = timezone.now()
+        for account in Account.objects.all():
+            self.assertGreaterEqual(account.balance, 0)
+            self.assertEqual(ledger.balance_at(account.pk, now), account.balance)
+
+    def test_load_test(self):
+        """
+        The load driver reports latency and queries for the requests it made, none of which fail.
+        :return:
+        """
+        datagen.generate(users=10, internal_transfers=50, external_transfers=50, seed=2)
+
+        results = loadtest.run(requests=100, sessions=3, seed=3)
+        self.assertEqual(sum(row['requests'] for row in results), 100)
+        for row in results:
+            self.assertEqual(row['errors'], 0, row['name'])
+            self.assertLessEqual(row['p50'], row['p99'])
+            self.assertGreaterEqual(row['max_queries'], row['queries'])
+
+
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        instrumentation.reset()
+        self.user = create_user('alice', 'password')
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)  # May read the metrics
+        self.client.login(username='alice', password='password')
+
+    def test_metrics(self):
+        """
+        Requests are measured per view and exposed as histograms.
+        :return:
+        """
+        create_account(self.user)
+        self.client.get(reverse('bank_accounts:account_list'))
+        self.client.get(reverse('bank_accounts:account_list'))
+
+        response = self.client.get(reverse('bank_accounts:metrics'))
+        self.assertContains(response, 'bank_accounts_request_queries_count{view="bank_accounts:account_list"} 2')
+        self.assertContains(response, 'bank_accounts_request_queries_bucket{view="bank_accounts:account_list",le="3"} 2')
+        self.assertContains(response, 'bank_accounts_request_template_seconds_count{view="bank_accounts:account_list"} 2')
+
+    def test_metrics_not_public(self):
+        """
+        Metrics are hidden from anonymous clients and Users who aren't staff.
+        :return:
+        """
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('bank_accounts:metrics')).status_code, 403)
+        create_user('bob', 'password')
+        self.client.login(username='bob', password='password')
+        self.assertEqual(self.client.get(reverse('bank_accounts:metrics')).status_code, 403)
+
+    def test_measure(self):
+        """
+        Queries and template rendering are counted, but not savepoints.
+        :return:
+        """
+        with instrumentation.measure() as measurement:
+            self.client.get(reverse('bank_accounts:account_list'))
+        self.assertEqual(measurement.queries, 3)  # Session, User and Accounts
+        self.assertGreater(measurement.template_time, 0)
+        self.assertGreaterEqual(measurement.latency, measurement.db_time)
+
+    def test_budget(self):
+        """
+        A view issuing more queries than its budget fails when budgets are enforced, and is counted otherwise.
+        :return:
+        """
+        original = AccountListView.query_budget
+        AccountListView.query_budget = 1
+        try:
+            with self.assertRaises(instrumentation.QueryBudgetExceeded):
+                self.client.get(reverse('bank_accounts:account_list'))
+            with self.settings(BANK_ACCOUNTS_ENFORCE_QUERY_BUDGETS=False):
+                self.assertEqual(self.client.get(reverse('bank_accounts:account_list')).status_code, 200)
+        finally:
+            AccountListView.query_budget = original
+
+        response = self.client.get(reverse('bank_accounts:metrics'))
+        self.assertContains(response, 'bank_accounts_query_budget_exceeded_total{view="bank_accounts:account_list"} 2')
+
+
+class RecurringTransferTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('alice', 'password')
+        self.payee = create_user('bob', 'password')
+        self.checking = create_account(self.user, Account.CHECKING, balance=100)
+        self.savings = create_account(self.user, Account.SAVINGS, balance=0)
+        self.payee_checking = create_account(self.payee, Account.CHECKING, balance=0)
+
+    def test_run_due(self):
+        """
+        Due standing orders are made once and move on to their next date.
+        :return:
+        """
+        due = timezone.now() - datetime.timedelta(hours=1)
+        internal = recurring.create(self.user, RecurringTransfer.INTERNAL_TRANSFER, self.checking.pk, 10,
+                                    RecurringTransfer.DAILY, first_run=due, to_account_pk=self.savings.pk)
+        external = recurring.create(self.user, RecurringTransfer.EXTERNAL_TRANSFER, self.checking.pk, 20,
+                                    RecurringTransfer.WEEKLY, first_run=due, payee_pk=self.payee.pk, comment='Rent')
+        recurring.create(self.user, RecurringTransfer.INTERNAL_TRANSFER, self.checking.pk, 30,
+                         RecurringTransfer.DAILY, first_run=timezone.now() + datetime.timedelta(hours=1),
+                         to_account_pk=self.savings.pk)
+
+        worker = workers.new_worker_id()
+        self.assertEqual(recurring.run_due(worker), (2, 0))
+        self.assertEqual(recurring.run_due(worker), (0, 0))
+
+        for account, balance in ((self.checking, 70), (self.savings, 10), (self.payee_checking, 20)):
+            account.refresh_from_db()
+            self.assertEqual(account.balance, balance)
+        self.assertEqual(ExternalTransferReceipt.objects.get().comment, 'Rent')
+
+        internal.refresh_from_db()
+        external.refresh_from_db()
+        self.assertEqual(internal.next_run_at, due + datetime.timedelta(days=1))
+        self.assertEqual(external.next_run_at, due + datetime.timedelta(weeks=1))
+        self.assertIsNone(internal.claimed_by)
+
+    def test_refused(self):
+        """
+        Refused transfers are recorded, and a standing order stops after refusals in a row.
+        :return:
+        """
+        order = recurring.create(self.user, RecurringTransfer.INTERNAL_TRANSFER, self.checking.pk, 1000,
+                                 RecurringTransfer.DAILY, to_account_pk=self.savings.pk)
+        worker = workers.new_worker_id()
+        for failures in range(1, recurring.MAX_FAILURES + 1):
+            RecurringTransfer.objects.filter(pk=order.pk).update(next_run_at=timezone.now())
+            self.assertEqual(recurring.run_due(worker), (0, 1))
+
+        order.refresh_from_db()
+        self.assertEqual(order.failures, recurring.MAX_FAILURES)
+        self.assertEqual(order.last_error, 'Not enough funds.')
+        self.assertIsNone(order.next_run_at)
+        self.assertEqual(InternalTransferReceipt.objects.count(), 0)
+
+    def test_create_checks_rules(self):
+        """
+        Standing orders are checked against the transfer rules when set up.
+        :return:
+        """
+        with self.assertRaises(InvalidAccount):
+            recurring.create(self.user, RecurringTransfer.INTERNAL_TRANSFER, self.checking.pk, 10,
+                             RecurringTransfer.DAILY, to_account_pk=self.payee_checking.pk)
+        with self.assertRaises(NotCheckingAccount):
+            recurring.create(self.user, RecurringTransfer.EXTERNAL_TRANSFER, self.savings.pk, 10,
+                             RecurringTransfer.DAILY, payee_pk=self.payee.pk)
+
+    def test_claims(self):
+        """
+        Workers never claim the same standing order, until a claim lapses.
+        :return:
+        """
+        for _ in range(3):
+            recurring.create(self.user, RecurringTransfer.INTERNAL_TRANSFER, self.checking.pk, 1,
+                             RecurringTransfer.DAILY, to_account_pk=self.savings.pk)
+        due = RecurringTransfer.objects.all()
+
+        first = workers.claim(due, 'first', 2, ['next_run_at'])
+        second = workers.claim(due, 'second', 2, ['next_run_at'])
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(workers.claim(due, 'third', 2, ['next_run_at']), [])
+
+        due.filter(claimed_by='first').update(claimed_until=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(sorted(workers.claim(due, 'third', 2, ['next_run_at'])), sorted(first))
+
+    def test_next_date(self):
+        """
+        Monthly runs stay on the same day of the month where they can, and go back to it after a shorter month.
+        :return:
+        """
+        date = datetime.datetime(2019, 1, 31, 9, 0)
+        date = recurring.next_date(date, RecurringTransfer.MONTHLY, day=31)
+        self.assertEqual(date, datetime.datetime(2019, 2, 28, 9, 0))
+        date = recurring.next_date(date, RecurringTransfer.MONTHLY, day=31)
+        self.assertEqual(date, datetime.datetime(2019, 3, 31, 9, 0))
+        self.assertEqual(recurring.next_date(datetime.datetime(2019, 12, 15), RecurringTransfer.MONTHLY),
+                         datetime.datetime(2020, 1, 15))
+
+        # A standing order set up on the 31st keeps coming back to it
+        order = recurring.create(self.user, RecurringTransfer.INTERNAL_TRANSFER, self.checking.pk, 1,
+                                 RecurringTransfer.MONTHLY, to_account_pk=self.savings.pk,
+                                 first_run=datetime.datetime(2019, 1, 31, 9, 0, tzinfo=datetime.timezone.utc))
+        self.assertEqual(recurring.run_due(workers.new_worker_id()), (1, 0))
+        order.refresh_from_db()
+        self.assertEqual(order.next_run_at.day,
+                         min(31, calendar.monthrange(order.next_run_at.year, order.next_run_at.month)[1]))
+
+    def test_views(self):
+        """
+        Users set up standing orders by payee username, see them listed and cancel them.
+        :return:
+        """
+        self.client.login(username='alice', password='password')
+        url = reverse('bank_accounts:recurring_transfers')
+        response = self.client.post(url, {'kind': RecurringTransfer.EXTERNAL_TRANSFER,
+                                          'from_account': self.checking.pk, 'payee_username': 'bob', 'amount': 5,
+                                          'frequency': RecurringTransfer.MONTHLY}, follow=True)
+        self.assertContains(response, 'Standing order set up.')
+        self.assertContains(response, 'to bob')
+        order = RecurringTransfer.objects.get()
+
+        response = self.client.post(url, {'kind': RecurringTransfer.EXTERNAL_TRANSFER,
+                                          'from_account': self.checking.pk, 'payee_username': 'nobody',
+                                          'amount': 5, 'frequency': RecurringTransfer.MONTHLY}, follow=True)
+        self.assertContains(response, 'does not exist')
+
+        response = self.client.post(reverse('bank_accounts:recurring_transfer_cancel', kwargs={'pk': order.pk}),
+                                    follow=True)
+        self.assertContains(response, 'Standing order cancelled.')
+        self.assertContains(response, 'Nothing as of yet!')
+
+
+class TransferQueueTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('alice', 'password')
+        self.payee = create_user('bob', 'password')
+        self.checking = create_account(self.user, Account.CHECKING, balance=100)
+        self.payee_checking = create_account(self.payee, Account.CHECKING, balance=0)
+        self.client.login(username='alice', password='password')
+        self.url = reverse('bank_accounts:external_transfer')
+
+    def test_queue_from_form(self):
+        """
+        A payment made in the background is queued, made by a worker, and its status page follows it.
+        :return:
+        """
+        response = self.client.post(self.url, {'from_account': self.checking.pk, 'payee_username': 'bob',
+                                               'amount': 30, 'in_background': '1'}, follow=True)
+        self.assertContains(response, 'Payment queued.')
+        self.assertContains(response, 'Waiting to be made')
+        self.checking.refresh_from_db()
+        self.assertEqual(self.checking.balance, 100)  # Nothing paid yet
+
+        self.assertEqual(transfer_queue.run_batch(workers.new_worker_id()), (1, 0))
+        queued = QueuedTransfer.objects.get()
+        self.assertEqual(queued.status, QueuedTransfer.DONE)
+        self.assertEqual(queued.receipt_id, ExternalTransferReceipt.objects.get().pk)
+        self.checking.refresh_from_db()
+        self.assertEqual(self.checking.balance, 70)
+
+        response = self.client.get(reverse('bank_accounts:queued_transfer', kwargs={'pk': queued.pk}))
+        self.assertContains(response, 'Payment successful.')
+
+    def test_queue_from_api(self):
+        """
+        Clients preferring an asynchronous response get a status URL to poll. Retries queue nothing new.
+        :return:
+        """
+        data = {'from_account': self.checking.pk, 'payee': self.payee.pk, 'amount': 10}
+        response = self.client.post(self.url, data, HTTP_PREFER='respond-async', HTTP_IDEMPOTENCY_KEY='key')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['status'], QueuedTransfer.PENDING)
+        retry = self.client.post(self.url, data, HTTP_PREFER='respond-async', HTTP_IDEMPOTENCY_KEY='key')
+        self.assertEqual(retry['Location'], response['Location'])
+        self.assertEqual(QueuedTransfer.objects.count(), 1)
+
+        transfer_queue.run_batch(workers.new_worker_id())
+        status = self.client.get(response['Location'], HTTP_ACCEPT='application/json').json()
+        self.assertEqual(status['status'], QueuedTransfer.DONE)
+
+        # Other Users cannot see it
+        self.client.login(username='bob', password='password')
+        self.assertEqual(self.client.get(response['Location']).status_code, 404)
+
+    def test_queue_unknown_payee(self):
+        """
+        A background payment to a User that doesn't exist is refused rather than queued.
+        :return:
+        """
+        response = self.client.post(self.url, {'from_account': self.checking.pk, 'payee': 999999, 'amount': 10,
+                                               'in_background': '1'}, follow=True)
+        self.assertContains(response, 'The user you are making the payment to does not exist.')
+        self.assertFalse(QueuedTransfer.objects.exists())
+        with self.assertRaises(InvalidPayee):
+            transfer_queue.enqueue(self.user, self.checking.pk, 999999, 10, idempotency_key='key')
+
+    def test_grouped_batch(self):
+        """
+        Payments from the same Account are made together in order, and a refused one doesn't undo the others.
+        :return:
+        """
+        other = create_user('carol', 'password')
+        other_checking = create_account(other, Account.CHECKING, balance=5)
+        for amount in (60, 60, 30):
+            transfer_queue.enqueue(self.user, self.checking.pk, self.payee.pk, amount)
+        transfer_queue.enqueue(other, other_checking.pk, self.payee.pk, 5)
+        transfer_queue.enqueue(other, self.checking.pk, self.payee.pk, 5)  # Not carol's Account
+
+        self.assertEqual(transfer_queue.run_batch(workers.new_worker_id()), (3, 2))
+        self.assertEqual(transfer_queue.run_batch(workers.new_worker_id()), (0, 0))
+
+        statuses = list(QueuedTransfer.objects.order_by('pk').values_list('status', 'error'))
+        self.assertEqual(statuses, [(QueuedTransfer.DONE, ''), (QueuedTransfer.FAILED, 'Not enough funds.'),
+                                    (QueuedTransfer.DONE, ''), (QueuedTransfer.DONE, ''),
+                                    (QueuedTransfer.FAILED, 'Accounts selected invalid.')])
+        self.payee_checking.refresh_from_db()
+        self.assertEqual(self.payee_checking.balance, 95)
+
+
+class InterestTests(TestCase):
+
+    def test_compute(self):
+        """
+        Interest is rounded down, nothing for negative balances, and the same with or without NumPy.
+        :return:
+        """
+        balances = [0, 1199, 1200, 123456, -500]
+        self.assertEqual(interest.compute(balances, Fraction(1, 1200), use_numpy=False), [0, 0, 1, 102, 0])
+        self.assertEqual(interest.compute(balances, Fraction(1, 1200)), [0, 0, 1, 102, 0])
+
+    def test_accrue_once_per_period(self):
+        """
+        Savings Accounts are credited once per period, with a ledger entry. Checking Accounts earn nothing.
+        :return:
+        """
+        user = create_user('username', 'password')
+        savings = create_account(user, Account.SAVINGS, balance=12000)
+        checking = create_account(user, Account.CHECKING, balance=12000)
+
+        self.assertEqual(interest.accrue('2020-01', annual_rate='0.12'), (1, 120))
+        self.assertEqual(interest.accrue('2020-01', annual_rate='0.12'), (0, 0))  # Already credited
+        self.assertEqual(interest.accrue('2020-02', annual_rate='0.12'), (1, 121))  # Compounds
+
+        savings.refresh_from_db()
+        checking.refresh_from_db()
+        self.assertEqual(savings.balance, 12241)
+        self.assertEqual(checking.balance, 12000)
+        self.assertEqual(list(InterestAccrual.objects.order_by('period').values_list('period', 'amount')),
+                         [('2020-01', 120), ('2020-02', 121)])
+        self.assertEqual(LedgerEntry.objects.filter(account=savings, kind=LedgerEntry.INTEREST).count(), 2)
+        self.assertEqual(ledger.balance_at(savings.pk, timezone.now()), 12241)
+
+    def test_resume(self):
+        """
+        Accruing a period again credits only the Accounts an interrupted run had not reached.
+        :return:
+        """
+        user = create_user('username', 'password')
+        accounts = [create_account(user, Account.SAVINGS, balance=1200) for i in range(5)]
+        slots.configure(accounts[0].pk, 2)
+        BalanceSlot.objects.filter(account=accounts[0]).update(balance=1200)  # Slot balances earn interest too
+
+        InterestAccrual.objects.create(account=accounts[1], period='2020-01', balance=1200, amount=1,
+                                       date=timezone.now())  # Left by an earlier run
+        self.assertEqual(interest.accrue('2020-01', annual_rate='0.01', chunk_size=2), (4, 6))
+        self.assertEqual(InterestAccrual.objects.filter(period='2020-01').count(), 5)
+        self.assertEqual(InterestAccrual.objects.get(account=accounts[0]).balance, 3600)
+
+
+class StatementTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('alice', 'password')
+        self.payee = create_user('bob', 'password')
+        self.checking = create_account(self.user, Account.CHECKING, balance=100)
+        self.savings = create_account(self.user, Account.SAVINGS, balance=50)
+        create_account(self.payee, Account.CHECKING, balance=0)
+        transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 30)
+        transfers.external_transfer(self.user, self.checking.pk, self.payee.pk, 20, 'Rent')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def read_csv(self, period, account):
+        with open(os.path.join(self.directory, period, 'account-%d.csv' % account.pk), newline='') as file:
+            return list(csv.DictReader(file))
+
+    def test_statement(self):
+        """
+        Statements list the month's transfers with a running balance, from the opening to the closing balance.
+        :return:
+        """
+        period = interest.current_period()
+        totals = statements.generate(period, self.directory)
+        self.assertEqual((totals['written'], totals['skipped']), (3, 0))
+
+        rows = self.read_csv(period, self.checking)
+        self.assertEqual([(row['description'], row['amount'], row['balance']) for row in rows],
+                         [('Transfer to Savings Account %d' % self.savings.pk, '-30', '70'),
+                          ('Payment to bob: Rent', '-20', '50')])
+        with open(os.path.join(self.directory, period, 'account-%d.html' % self.savings.pk)) as file:
+            html = file.read()
+        self.assertIn('Transfer from Checking Account %d' % self.checking.pk, html)
+        self.assertIn('Closing balance: $80', html)
+
+        # The month before, the Accounts didn't exist yet
+        start, _ = statements.period_bounds(period)
+        previous = interest.current_period(start - datetime.timedelta(days=1))
+        self.assertEqual(statements.generate(previous, self.directory)['written'], 0)
+
+    def test_opening_balance_and_resume(self):
+        """
+        Transfers before a statement are in its opening balance. Generating again writes only missing statements.
+        :return:
+        """
+        _, end = statements.period_bounds(interest.current_period())
+        period = timezone.localtime(end).strftime('%Y-%m')  # Next month
+        self.assertEqual(statements.generate(period, self.directory, chunk_size=2)['written'], 3)
+        self.assertEqual(self.read_csv(period, self.checking), [])
+        with open(os.path.join(self.directory, period, 'account-%d.html' % self.checking.pk)) as file:
+            self.assertIn('Opening balance: $50', file.read())
+
+        os.remove(os.path.join(self.directory, period, 'account-%d.csv' % self.savings.pk))  # Crashed while writing
+        totals = statements.generate(period, self.directory)
+        self.assertEqual((totals['written'], totals['skipped']), (1, 2))
+
+
+class RollupTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('alice', 'password')
+        self.checking = create_account(self.user, Account.CHECKING, balance=1000)
+        self.savings = create_account(self.user, Account.SAVINGS, balance=0)
+        self.bob = create_user('bob', 'password')
+        self.carol = create_user('carol', 'password')
+        create_account(self.bob, Account.CHECKING, balance=0)
+        create_account(self.carol, Account.CHECKING, balance=0)
+        self.client.login(username='alice', password='password')
+
+    def rollups(self):
+        daily = DailyAccountTotal.objects.values_list('account_id', 'day', 'kind', 'inflow', 'outflow', 'count')
+        return sorted(daily), sorted(PayeeTotal.objects.values_list('payer_id', 'payee_id', 'amount', 'count'))
+
+    def test_transfers_update_rollups(self):
+        """
+        Transfers and batches add to the rollups, which agree with a rebuild from the receipts.
+        :return:
+        """
+        transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 100)
+        transfers.external_transfer(self.user, self.checking.pk, self.bob.pk, 30)
+        transfers.external_transfer(self.user, self.checking.pk, self.bob.pk, 20)
+        batch.run_batch(self.user, [{'type': 'external', 'from_account': self.checking.pk, 'payee': self.carol.pk,
+                                     'amount': 70},
+                                    {'type': 'external', 'from_account': self.checking.pk, 'payee': self.bob.pk,
+                                     'amount': 5}])
+
+        total = DailyAccountTotal.objects.get(account=self.checking, kind=LedgerEntry.EXTERNAL_TRANSFER)
+        self.assertEqual((total.inflow, total.outflow, total.count), (0, 125, 4))
+        total = DailyAccountTotal.objects.get(account=self.savings, kind=LedgerEntry.INTERNAL_TRANSFER)
+        self.assertEqual((total.inflow, total.outflow, total.count), (100, 0, 1))
+        self.assertEqual(PayeeTotal.objects.get(payer=self.user, payee=self.bob).amount, 55)
+
+        incremental = self.rollups()
+        self.assertEqual(rollups.rebuild(chunk_size=2), (5, 2))
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_interest_updates_rollups(self):
+        """
+        Interest credited is added to the daily totals as interest, which agree with a rebuild.
+        :return:
+        """
+        transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 600)
+        self.assertEqual(interest.accrue(annual_rate='0.12'), (1, 6))
+
+        total = DailyAccountTotal.objects.get(account=self.savings, kind=LedgerEntry.INTEREST)
+        self.assertEqual((total.day, total.inflow, total.outflow, total.count), (timezone.localdate(), 6, 0, 1))
+
+        incremental = self.rollups()
+        self.assertEqual(rollups.rebuild(), (3, 0))
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_analytics_views(self):
+        """
+        Spending per month and top payees are read from the rollups.
+        :return:
+        """
+        transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 100)  # Not spending
+        transfers.external_transfer(self.user, self.checking.pk, self.bob.pk, 30)
+        transfers.external_transfer(self.user, self.checking.pk, self.carol.pk, 50)
+        transfers.external_transfer(self.bob, Account.objects.get(holder=self.bob).pk, self.user.pk, 10)
+
+        response = self.client.get(reverse('bank_accounts:spending'), {'format': 'json'})
+        self.assertEqual(response.json()['months'], [{'month': interest.current_period(), 'spent': 80, 'received': 10,
+                                                      'payments': 3}])
+        response = self.client.get(reverse('bank_accounts:top_payees'), HTTP_ACCEPT='application/json')
+        self.assertEqual([(payee['username'], payee['amount']) for payee in response.json()['payees']],
+                         [('carol', 50), ('bob', 30)])
+
+        self.assertContains(self.client.get(reverse('bank_accounts:top_payees')), 'carol')
+        self.assertContains(self.client.get(reverse('bank_accounts:spending')), '$80')
+        self.assertEqual(self.client.get(reverse('bank_accounts:spending'), {'months': 'x'}).status_code, 400)
+
+
+class VersioningTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('username', 'password')
+        self.account = create_account(self.user, Account.CHECKING, balance=100)
+        self.other = create_account(self.user, Account.SAVINGS, balance=100)
+
+    def test_writes_bump_version(self):
+        """
+        Transfers change the version, so a compare-and-swap of a stale Account fails.
+        :return:
+        """
+        stale = Account.objects.get(pk=self.account.pk)
+        transfers.internal_transfer(self.user, self.account.pk, self.other.pk, 10)
+        self.assertFalse(versioning.compare_and_swap(stale, account_type=Account.SAVINGS))
+
+        fresh = Account.objects.get(pk=self.account.pk)
+        self.assertTrue(versioning.compare_and_swap(fresh, account_type=Account.SAVINGS))
+        self.account.refresh_from_db()
+        self.assertEqual((self.account.account_type, self.account.balance), (Account.SAVINGS, 90))
+        self.assertEqual(self.account.version, fresh.version)
+
+    def test_retry_on_conflict(self):
+        """
+        A read-modify-write that loses a race reads again and retries, and gives up after a few tries.
+        :return:
+        """
+        calls = []
+
+        def change(account):
+            calls.append(account.balance)
+            if len(calls) == 1:
+                Account.objects.get(pk=account.pk).deposit(5)  # Someone else writes after we read
+            return {'balance': account.balance * 2}
+
+        account = versioning.update_account(self.account.pk, change)
+        self.assertEqual(calls, [100, 105])
+        self.assertEqual(Account.objects.get(pk=self.account.pk).balance, 210)
+        self.assertEqual(account.balance, 210)
+
+        def always_raced(account):
+            Account.objects.get(pk=account.pk).deposit(1)
+            return {'balance': 0}
+
+        with self.assertRaises(ConcurrentUpdate):
+            versioning.update_account(self.account.pk, always_raced, attempts=3)
+        self.assertEqual(Account.objects.get(pk=self.account.pk).balance, 213)
+
+        account = versioning.update_account(self.account.pk, lambda account: {'balance': account.balance + 1},
+                                            mode=versioning.PESSIMISTIC)
+        self.assertEqual(account.balance, 214)
+
+    def test_stale_batch(self):
+        """
+        A batch's balance changes are refused if an Account paid from changed since it was read.
+        :return:
+        """
+        stale_version = self.account.version
+        self.account.deposit(1)
+        with self.assertRaises(ConcurrentUpdate):
+            batch.apply_deltas({self.account.pk: -10, self.other.pk: 10}, versions={self.account.pk: stale_version})
+
+    def test_update_view(self):
+        """
+        Updating an Account writes only the changed field, keeping balance changes made since the form was shown.
+        :return:
+        """
+        self.client.login(username='username', password='password')
+        url = reverse('bank_accounts:update', kwargs={'pk': self.account.pk})
+        self.client.get(url)
+        transfers.internal_transfer(self.user, self.other.pk, self.account.pk, 50)
+
+        response = self.client.post(url, {'account_type': Account.SAVINGS})
+        self.assertRedirects(response, reverse('bank_accounts:account_detail', kwargs={'pk': self.account.pk}))
+        self.account.refresh_from_db()
+        self.assertEqual((self.account.account_type, self.account.balance), (Account.SAVINGS, 150))
+
+
+@skipUnless('replica' in settings.DATABASES, 'Needs the replica database of mysite3.settings_test')
+class ReplicaTests(TestCase):
+    """
+    Reads from a replica, using the extra SQLite database of the test settings. Nothing copies rows to it, so it lags behind
+    'default' indefinitely.
+    """
+    databases = {'default', 'replica'}.intersection(settings.DATABASES)  # Skipped when the settings lack it
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('username', 'password')
+        self.account = create_account(self.user, Account.CHECKING, balance=100)
+        self.other = create_account(self.user, Account.SAVINGS, balance=0)
+        self.client.login(username='username', password='password')
+
+    def listed(self):
+        return [account.pk for account in self.client.get(reverse('bank_accounts:account_list')).context['account_list']]
+
+    @override_settings(BANK_ACCOUNTS_REPLICAS={'default': ['replica']})
+    def test_read_your_writes(self):
+        """
+        Read-only views read from the replica, until the client writes. Then they read from the primary.
+        :return:
+        """
+        self.assertEqual(self.listed(), [])
+        response = self.client.post(reverse('bank_accounts:internal_transfer'), {'from_account': self.account.pk,
+                                                                  'to_account': self.other.pk, 'balance': 10})
+        self.assertEqual(Account.objects.get(pk=self.other.pk).balance, 10)
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], routers.replica_lag())
+        self.assertEqual(self.listed(), [self.account.pk, self.other.pk])
+
+    @override_settings(BANK_ACCOUNTS_REPLICAS={'default': ['replica']})
+    def test_writes_use_primary(self):
+        """
+        Views that write read from the primary, even without being pinned to it.
+        :return:
+        """
+        response = self.client.get(reverse('bank_accounts:internal_transfer'))
+        self.assertEqual(len(response.context['accounts']), 2)
+
+    def test_no_replicas(self):
+        """
+        Without replicas everything reads from 'default', and writes pin nobody.
+        :return:
+        """
+        self.assertEqual(self.listed(), [self.account.pk, self.other.pk])
+        self.assertNotIn(routers.PIN_COOKIE, self.client.post(reverse('bank_accounts:internal_transfer'), {}).cookies)
+
+
+@skipUnless('shard_1' in settings.DATABASES, 'Needs the shard_1 database of mysite3.settings_test')
+@override_settings(BANK_ACCOUNTS_SHARDS=['default', 'shard_1'])
+class ShardingTests(TestCase):
+    """
+    Accounts sharded over 'default' and the extra SQLite database of the test settings.
+    """
+    databases = {'default', 'shard_1'}.intersection(settings.DATABASES)  # Skipped when the settings lack it
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('username', 'password')
+        self.payee = create_user('payee', 'password')  # The next pk, so on the other shard
+        self.payer_shard, self.payee_shard = routers.shard_for(self.user.pk), routers.shard_for(self.payee.pk)
+        with routers.using_shard(self.payer_shard):
+            self.from_account = create_account(self.user, Account.CHECKING, balance=100)
+        with routers.using_shard(self.payee_shard):
+            self.to_account = create_account(self.payee, Account.CHECKING, balance=0)
+
+    def balances(self):
+        return (Account.objects.using(self.payer_shard).get(pk=self.from_account.pk).balance,
+                Account.objects.using(self.payee_shard).values_list('balance', flat=True).first())
+
+    def test_shards(self):
+        """
+        Each User's Accounts live on their shard, and requests read them from there. Users are copied to every shard.
+        :return:
+        """
+        self.assertNotEqual(self.payer_shard, self.payee_shard)
+        self.assertEqual(User.objects.using('shard_1').count(), 2)
+        self.assertEqual(Account.objects.using(self.payer_shard).get().holder, self.user)
+        self.assertEqual(Account.objects.using(self.payee_shard).get().holder, self.payee)
+
+        self.client.login(username='username', password='password')
+        response = self.client.get(reverse('bank_accounts:account_list'))
+        self.assertEqual([account.pk for account in response.context['account_list']], [self.from_account.pk])
+
+    def test_cross_shard_payment(self):
+        """
+        A payment to a User on another shard withdraws on one shard and deposits on the other, each with its receipt.
+        :return:
+        """
+        with self.captureOnCommitCallbacks(using=self.payer_shard, execute=True):
+            receipt = transfers.external_transfer(self.user, self.from_account.pk, self.payee.pk, 30, 'rent')
+
+        self.assertEqual(self.balances(), (70, 30))
+        self.assertEqual((receipt.from_account_id, receipt.to_account_id), (self.from_account.pk, None))
+        copy = ExternalTransferReceipt.objects.using(self.payee_shard).get()
+        self.assertEqual((copy.from_account_id, copy.to_account_id, copy.amount), (None, self.to_account.pk, 30))
+        outgoing = CrossShardTransfer.objects.using(self.payer_shard).get()
+        self.assertEqual(outgoing.status, CrossShardTransfer.COMMITTED)
+        self.assertEqual(CrossShardTransfer.objects.using(self.payee_shard).get().transfer_id, outgoing.transfer_id)
+
+        self.assertEqual(cross_shard.complete(outgoing), CrossShardTransfer.COMMITTED)  # Completing again does nothing
+        self.assertEqual(self.balances(), (70, 30))
+
+    def test_batch(self):
+        """
+        A batch's payments to Users on another shard are made after the rest of the batch.
+        :return:
+        """
+        with routers.using_shard(self.payer_shard):
+            savings = create_account(self.user, Account.SAVINGS, balance=0)
+        with self.captureOnCommitCallbacks(using=self.payer_shard, execute=True):
+            results = batch.run_batch(self.user, [
+                {'type': 'external', 'from_account': self.from_account.pk, 'payee': self.payee.pk, 'amount': 60},
+                {'type': 'internal', 'from_account': self.from_account.pk, 'to_account': savings.pk, 'amount': 50},
+            ])
+        self.assertEqual([result['ok'] for result in results], [False, True])
+        self.assertEqual(results[0]['error'], batch.ERROR_MESSAGES[InsufficientFunds])
+        self.assertEqual(self.balances(), (50, 0))
+
+    def test_resolve(self):
+        """
+        Payments left prepared are completed by resolve: deposited, or refunded if the payee's shard refuses them.
+        :return:
+        """
+        # Not completed, as if the process crashed after the first phase
+        with self.captureOnCommitCallbacks(using=self.payer_shard):
+            transfers.external_transfer(self.user, self.from_account.pk, self.payee.pk, 30)
+            transfers.external_transfer(self.user, self.from_account.pk, self.payee.pk, 20)
+        self.assertEqual(self.balances(), (50, 0))
+        self.assertEqual(cross_shard.resolve(older_than=60), (0, 0))  # Too recent
+
+        first, second = CrossShardTransfer.objects.using(self.payer_shard).order_by('pk')
+        self.assertEqual(cross_shard.complete(first), CrossShardTransfer.COMMITTED)
+        Account.objects.using(self.payee_shard).filter(pk=self.to_account.pk).delete()
+        self.assertEqual(cross_shard.resolve(older_than=0), (0, 1))
+        self.assertEqual(cross_shard.resolve(older_than=0), (0, 0))
+
+        self.assertEqual(self.balances(), (70, None))
+        self.assertEqual(ExternalTransferReceipt.objects.using(self.payer_shard).get().amount, 30)
+        with routers.using_shard(self.payer_shard):
+            self.assertEqual(ledger.balance_at(self.from_account.pk, timezone.now()), 70)
+        second.refresh_from_db()
+        self.assertEqual(second.status, CrossShardTransfer.REFUNDED)
+
+    def test_transfer_queue(self):
+        """
+        Workers make the payments queued on every shard.
+        :return:
+        """
+        Account.objects.using(self.payee_shard).filter(pk=self.to_account.pk).update(balance=20)
+        for payer, payee, account, shard, amount in ((self.user, self.payee, self.from_account, self.payer_shard, 30),
+                                                     (self.payee, self.user, self.to_account, self.payee_shard, 10)):
+            with routers.using_shard(shard):
+                transfer_queue.enqueue(payer, account.pk, payee.pk, amount)
+
+        with self.captureOnCommitCallbacks(using=self.payer_shard, execute=True), \
+                self.captureOnCommitCallbacks(using=self.payee_shard, execute=True):
+            self.assertEqual(transfer_queue.run_batch(workers.new_worker_id()), (2, 0))
+        self.assertEqual(self.balances(), (80, 40))
+        for shard in (self.payer_shard, self.payee_shard):
+            self.assertEqual(QueuedTransfer.objects.using(shard).get().status, QueuedTransfer.DONE)
+
+    def test_recurring_transfers(self):
+        """
+        Workers make the standing orders due on every shard, each transfer committing with its rescheduling.
+        :return:
+        """
+        Account.objects.using(self.payee_shard).filter(pk=self.to_account.pk).update(balance=20)
+        due = timezone.now() - datetime.timedelta(hours=1)
+        for user, account, shard in ((self.user, self.from_account, self.payer_shard),
+                                     (self.payee, self.to_account, self.payee_shard)):
+            with routers.using_shard(shard):
+                savings = create_account(user, Account.SAVINGS, balance=0)
+                recurring.create(user, RecurringTransfer.INTERNAL_TRANSFER, account.pk, 10, RecurringTransfer.DAILY,
+                                 first_run=due, to_account_pk=savings.pk)
+
+        self.assertEqual(recurring.run_due(workers.new_worker_id()), (2, 0))
+        self.assertEqual(self.balances(), (90, 10))
+        for shard in (self.payer_shard, self.payee_shard):
+            self.assertEqual(RecurringTransfer.objects.using(shard).get().next_run_at, due + datetime.timedelta(days=1))
+
+    def test_interest(self):
+        """
+        Interest is credited to the Savings Accounts of every shard.
+        :return:
+        """
+        for user, shard in ((self.user, self.payer_shard), (self.payee, self.payee_shard)):
+            with routers.using_shard(shard):
+                create_account(user, Account.SAVINGS, balance=1000)
+        self.assertEqual(interest.accrue('2020-01', annual_rate='0.12'), (2, 20))
+        for shard in (self.payer_shard, self.payee_shard):
+            self.assertEqual(InterestAccrual.objects.using(shard).get().amount, 10)
+
+
+class SqliteTuningTests(TestCase):
+
+    def test_pragmas_on_connect(self):
+        """
+        New connections get the pragmas of the settings, set without counting as queries.
+        :return:
+        """
+        original = sqlite_tuning.current(connection, ['cache_size'])
+        self.addCleanup(sqlite_tuning.configure, connection, original)
+
+        with override_settings(BANK_ACCOUNTS_SQLITE_PRAGMAS={'cache_size': -1234}):
+            with CaptureQueriesContext(connection) as queries:
+                connection_created.send(sender=connection.__class__, connection=connection)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(sqlite_tuning.current(connection, ['cache_size']), {'cache_size': -1234})
+
+    def test_no_pragmas(self):
+        """
+        Without pragmas in the settings, connections keep SQLite's defaults.
+        :return:
+        """
+        original = sqlite_tuning.current(connection)
+        connection_created.send(sender=connection.__class__, connection=connection)
+        self.assertEqual(sqlite_tuning.current(connection), original)
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('alice', 'password')
+        self.bob = create_user('bob', 'password')
+        self.checking = create_account(self.user, Account.CHECKING, balance=1000)
+        self.savings = create_account(self.user, Account.SAVINGS, balance=0)
+        self.bob_checking = create_account(self.bob, Account.CHECKING, balance=0)
+        self.client.login(username='alice', password='password')
+
+    def age(self, receipts, days=400):
+        receipts.update(date=timezone.now() - datetime.timedelta(days=days))
+
+    def rollups(self):
+        daily = DailyAccountTotal.objects.values_list('account_id', 'day', 'kind', 'inflow', 'outflow', 'count')
+        return sorted(daily), sorted(PayeeTotal.objects.values_list('payer_id', 'payee_id', 'amount', 'count'))
+
+    def test_archive(self):
+        """
+        Old receipts move to the archive, keeping their ids, and receipt lists page through both tables.
+        :return:
+        """
+        receipts = [transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, amount)
+                    for amount in range(1, 6)]
+        self.age(InternalTransferReceipt.objects.filter(pk__in=[receipt.pk for receipt in receipts[:3]]))
+        transfers.external_transfer(self.user, self.checking.pk, self.bob.pk, 50)
+
+        self.assertEqual(archive.archive(chunk_size=2), (3, 0))
+        self.assertEqual(archive.archive(), (0, 0))
+        self.assertEqual(sorted(ArchivedInternalTransferReceipt.objects.values_list('pk', flat=True)),
+                         [receipt.pk for receipt in receipts[:3]])
+        self.assertEqual(InternalTransferReceipt.objects.count(), 2)
+        self.assertEqual(ExternalTransferReceipt.objects.count(), 1)
+
+        hot = InternalTransferReceipt.objects.filter(user=self.user)
+        archived = ArchivedInternalTransferReceipt.objects.filter(user=self.user)
+        cursor, pages = None, []
+        while True:
+            page = pagination.paginate(hot, cursor, 2, archived)
+            pages.append([receipt.amount for receipt in page.object_list])
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(pages, [[5, 4], [3, 2], [1]])
+
+        response = self.client.get(reverse('bank_accounts:internal_transfer_receipt_list'))
+        self.assertEqual([receipt.amount for receipt in response.context['receipts']], [5, 4, 3, 2, 1])
+
+    def test_exports_and_rollups(self):
+        """
+        Rollups rebuild the same from both tables, exports read archived receipts unless their date range starts after
+        the horizon, and Accounts deleted after archiving read as deleted.
+        :return:
+        """
+        transfers.external_transfer(self.user, self.checking.pk, self.bob.pk, 30)
+        transfers.external_transfer(self.user, self.checking.pk, self.bob.pk, 20)
+        self.age(ExternalTransferReceipt.objects.filter(amount=30))
+        rollups.rebuild()
+        rebuilt = self.rollups()
+        self.assertEqual(archive.archive(), (0, 1))
+        rollups.rebuild()
+        self.assertEqual(self.rollups(), rebuilt)
+
+        rows = [json.loads(line) for line in
+                self.client.get(reverse('bank_accounts:external_transfer_export'), {'format': 'jsonl'})
+                .getvalue().decode().splitlines()]
+        self.assertEqual([(row['amount'], row['to_account']) for row in rows],
+                         [(30, str(self.bob_checking)), (20, str(self.bob_checking))])
+        start = (timezone.now() - datetime.timedelta(days=1)).date().isoformat()
+        rows = self.client.get(reverse('bank_accounts:external_transfer_export'), {'format': 'jsonl', 'start': start})\
+            .getvalue().decode().splitlines()
+        self.assertEqual([json.loads(row)['amount'] for row in rows], [20])
+
+        response = self.client.get(reverse('bank_accounts:external_transfer_receipt_list'))
+        self.assertEqual([receipt.amount for receipt in response.context['receipts']], [20, 30])
+
+        # Deleting an Account leaves the archive as it is, and its archived receipts then show it as deleted
+        self.bob_checking.delete()
+        rows = [json.loads(line) for line in
+                self.client.get(reverse('bank_accounts:external_transfer_export'), {'format': 'jsonl'})
+                .getvalue().decode().splitlines()]
+        self.assertEqual([row['to_account'] for row in rows], [exports.DELETED_ACCOUNT, exports.DELETED_ACCOUNT])
+        response = self.client.get(reverse('bank_accounts:external_transfer_receipt_list'))
+        self.assertEqual([receipt.to_account for receipt in response.context['receipts']], [None, None])
+
+
+class ReceivingAccountTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.payer = create_user('alice', 'password')
+        self.payer_checking = create_account(self.payer, Account.CHECKING, balance=1000)
+        self.payee = create_user('bob', 'password')
+        self.client.login(username='bob', password='password')
+
+    def receiving_pk(self):
+        return DefaultReceivingAccount.objects.filter(holder=self.payee).values_list('account_id', flat=True).first()
+
+    def test_maintained(self):
+        """
+        The first Checking Account opened receives payments until the User chooses another. Deleting it or changing its
+        type falls back to the first Checking Account left.
+        :return:
+        """
+        create_account(self.payee, Account.SAVINGS)
+        self.assertIsNone(self.receiving_pk())
+        first = create_account(self.payee, Account.CHECKING)
+        second = create_account(self.payee, Account.CHECKING)
+        self.assertEqual(self.receiving_pk(), first.pk)
+
+        response = self.client.post(reverse('bank_accounts:receiving_account'), {'account': second.pk})
+        self.assertRedirects(response, reverse('bank_accounts:receiving_account'))
+        self.assertEqual(self.receiving_pk(), second.pk)
+        receipt = transfers.external_transfer(self.payer, self.payer_checking.pk, self.payee.pk, 10)
+        self.assertEqual(receipt.to_account_id, second.pk)
+        self.assertContains(self.client.get(reverse('bank_accounts:receiving_account')),
+                            'value="%d"\n                       checked' % second.pk)
+
+        second.delete()
+        self.assertEqual(self.receiving_pk(), first.pk)
+        self.client.post(reverse('bank_accounts:update', kwargs={'pk': first.pk}), {'account_type': Account.SAVINGS})
+        self.assertIsNone(self.receiving_pk())
+        with self.assertRaises(NoCheckingAccount):
+            transfers.external_transfer(self.payer, self.payer_checking.pk, self.payee.pk, 10)
+
+        # Only the User's own Checking Accounts may receive
+        self.client.post(reverse('bank_accounts:receiving_account'), {'account': first.pk})
+        self.client.post(reverse('bank_accounts:receiving_account'), {'account': self.payer_checking.pk})
+        self.assertIsNone(self.receiving_pk())
+
+    def test_stale_cache(self):
+        """
+        A payment into a cached receiving Account that another process deleted looks the Account up again.
+        :return:
+        """
+        first = create_account(self.payee, Account.CHECKING, balance=0)
+        second = create_account(self.payee, Account.CHECKING, balance=0)
+        self.assertEqual(receiving.receiving_account(self.payee.pk), (first.pk, 0))
+        with CaptureQueriesContext(connection) as queries:
+            receiving.receiving_account(self.payee.pk)
+        self.assertEqual(len(queries), 0)
+
+        first_pk = first.pk
+        first.delete()
+        receiving._cache.set(('default', self.payee.pk), (first_pk, 0))  # As still cached by another process
+        receipt = transfers.external_transfer(self.payer, self.payer_checking.pk, self.payee.pk, 10)
+        self.assertEqual(receipt.to_account_id, second.pk)
+        self.assertEqual(Account.objects.get(pk=second.pk).balance, 10)
+        self.assertEqual(Account.objects.get(pk=self.payer_checking.pk).balance, 990)
+
+
+class ApiTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('alice', 'password')
+        self.bob = create_user('bob', 'password')
+        self.checking = create_account(self.user, Account.CHECKING, balance=1000)
+        self.savings = create_account(self.user, Account.SAVINGS, balance=0)
+        self.bob_checking = create_account(self.bob, Account.CHECKING, balance=0)
+        self.client.login(username='alice', password='password')
+
+    def post(self, name, data, **headers):
+        return self.client.post(reverse('bank_accounts:' + name), json.dumps(data), content_type='application/json',
+                                **headers)
+
+    def test_accounts(self):
+        """
+        Accounts are listed with the fields asked for, and unchanged ones are answered with 304 Not Modified.
+        :return:
+        """
+        url = reverse('bank_accounts:api_accounts')
+        response = self.client.get(url, {'fields': 'id,balance'})
+        self.assertEqual(response.content, ('{"accounts":[{"id":%d,"balance":1000},{"id":%d,"balance":0}]}' % (
+            self.checking.pk, self.savings.pk)).encode())
+        etag = response['ETag']
+
+        response = self.client.get(url, {'fields': 'id,balance'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 100)
+        response = self.client.get(url, {'fields': 'id,balance'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        self.assertEqual(self.client.get(url, {'fields': 'id,secret'}).status_code, 400)
+        response = self.client.get(reverse('bank_accounts:api_account', kwargs={'pk': self.savings.pk}))
+        self.assertEqual(response.json()['balance'], 100)
+        self.assertEqual(self.client.get(reverse('bank_accounts:api_account', kwargs={'pk': self.bob_checking.pk}))
+                         .status_code, 404)
+
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+    def test_transfers(self):
+        """
+        Transfers are made once per idempotency key, refused ones are answered with their reason, and history is paged
+        newest first with a Last-Modified date.
+        :return:
+        """
+        response = self.post('api_internal_transfers', {'from_account': self.checking.pk,
+                                                        'to_account': self.savings.pk, 'amount': 100},
+                             HTTP_IDEMPOTENCY_KEY='key')
+        self.assertEqual(response.status_code, 201)
+        response = self.post('api_internal_transfers', {'from_account': self.checking.pk,
+                                                        'to_account': self.savings.pk, 'amount': 100},
+                             HTTP_IDEMPOTENCY_KEY='key')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Account.objects.get(pk=self.savings.pk).balance, 100)
+
+        response = self.post('api_payments', {'from_account': self.checking.pk, 'payee_username': 'bob', 'amount': 30,
+                                              'comment': 'Lunch'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['to_account'], self.bob_checking.pk)
+        response = self.post('api_payments', {'from_account': self.checking.pk, 'payee': self.bob.pk,
+                                              'amount': 10000})
+        self.assertEqual((response.status_code, response.json()['error']), (400, 'Not enough funds.'))
+        self.assertEqual(self.post('api_payments', ['not', 'an', 'object']).status_code, 400)
+
+        for amount in (1, 2, 3):
+            transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, amount)
+        url = reverse('bank_accounts:api_internal_transfers')
+        response = self.client.get(url, {'page_size': 2, 'fields': 'amount'})
+        self.assertEqual(response.json()['results'], [{'amount': 3}, {'amount': 2}])
+        self.assertIn('Last-Modified', response)
+        response = self.client.get(url, {'page_size': 2, 'fields': 'amount', 'cursor': response.json()['next']})
+        self.assertEqual(response.json(), {'results': [{'amount': 1}, {'amount': 100}], 'next': None})
+        self.assertEqual(self.client.get(url, {'page_size': 0}).status_code, 400)
+
+        response = self.client.get(reverse('bank_accounts:api_payments'))
+        self.assertEqual([(payment['direction'], payment['payee'], payment['comment'])
+                          for payment in response.json()['results']], [('sent', 'bob', 'Lunch')])
+        response = self.client.get(reverse('bank_accounts:api_payments'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(BANK_ACCOUNTS_EVENTS_POLL_INTERVAL=None)  # No poller thread, tests poll themselves
+class EventStreamTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('alice', 'password')
+        self.bob = create_user('bob', 'password')
+        self.checking = create_account(self.user, Account.CHECKING, balance=1000)
+        self.savings = create_account(self.user, Account.SAVINGS, balance=0)
+        self.bob_checking = create_account(self.bob, Account.CHECKING, balance=100)
+        self.client.login(username='alice', password='password')
+
+    def open(self, **headers):
+        response = self.client.get(reverse('bank_accounts:events'), **headers)
+        self.addCleanup(response.close)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return response, iter(response.streaming_content)
+
+    def test_stream(self):
+        """
+        A stream sends the balances when opened, then each change committed to the User's Accounts, and stops
+        waiting when closed.
+        :return:
+        """
+        response, chunks = self.open()
+        chunk = next(chunks).decode()
+        self.assertTrue(chunk.startswith('retry: '))
+        self.assertIn('event: balances\ndata: {"accounts":[{"id":%d,"balance":1000},{"id":%d,"balance":0}]}' % (
+            self.checking.pk, self.savings.pk), chunk)
+        self.assertNotIn('event: transfer', chunk)
+        self.assertEqual(events.hub.subscribers(), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 100)
+        chunk = next(chunks).decode()
+        self.assertEqual(chunk.count('event: transfer'), 2)
+        self.assertIn('"amount":-100', chunk)
+        self.assertIn('"balance":900', chunk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            transfers.external_transfer(self.bob, self.bob_checking.pk, self.user.pk, 50)
+        self.assertIn('"kind":"external"', next(chunks).decode())
+
+        response.close()
+        self.assertEqual(events.hub.subscribers(), 0)
+
+    def test_catch_up_and_poll(self):
+        """
+        A reconnecting client is sent what it missed after its Last-Event-ID, and writes the hub only notices by
+        polling the ledger wake the stream too.
+        :return:
+        """
+        transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 100)
+        first, last = LedgerEntry.objects.order_by('id').values_list('id', flat=True)
+        response, chunks = self.open(HTTP_LAST_EVENT_ID=str(first))
+        chunk = next(chunks).decode()
+        self.assertNotIn('id: %d\n' % first, chunk)
+        self.assertIn('id: %d\n' % last, chunk)
+
+        events.hub.poll()  # Starts from now
+        transfers.internal_transfer(self.user, self.savings.pk, self.checking.pk, 100)  # Commit not noticed
+        events.hub.poll()
+        chunk = next(chunks).decode()
+        self.assertEqual(chunk.count('event: transfer'), 2)
+        self.assertIn('"balance":1000', chunk)
+
+        # However many entries were added since, one poll catches up with all of them
+        for i in range(events.CHUNK_SIZE // 2 + 1):
+            transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 1)
+        events.hub.poll()
+        self.assertEqual(events.hub._cursors['default'], LedgerEntry.objects.aggregate(last=Max('id'))['last'])
+        self.assertIn('"balance":%d' % (1000 - events.CHUNK_SIZE // 2 - 1), next(chunks).decode())
+
+
+class AsyncViewTests(TestCase):
+    """
+    Requests made through Django's ASGI handler, which runs async views and middleware on an event loop.
+    """
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('alice', 'password')
+        self.bob = create_user('bob', 'password')
+        self.checking = create_account(self.user, Account.CHECKING, balance=1000)
+        self.savings = create_account(self.user, Account.SAVINGS, balance=0)
+        self.bob_checking = create_account(self.bob, Account.CHECKING, balance=0)
+        transfers.internal_transfer(self.user, self.checking.pk, self.savings.pk, 100)
+        transfers.external_transfer(self.user, self.checking.pk, self.bob.pk, 50)
+
+    async def test_views(self):
+        """
+        The async views answer within their query budgets, which count the queries of the async ORM.
+        :return:
+        """
+        client = AsyncClient()
+        response = await client.get(reverse('bank_accounts:account_list'))
+        self.assertEqual(response.status_code, 302)  # To the login page
+        await client.aforce_login(self.user)
+
+        response = await client.get(reverse('bank_accounts:home'))
+        self.assertContains(response, 'alice')
+        response = await client.get(reverse('bank_accounts:account_list'))
+        self.assertEqual([account.pk for account in response.context['account_list']],
+                         [self.checking.pk, self.savings.pk])
+        response = await client.get(reverse('bank_accounts:account_detail', kwargs={'pk': self.savings.pk}))
+        self.assertEqual(response.context['account'].total_balance, 100)
+        response = await client.get(reverse('bank_accounts:account_detail', kwargs={'pk': self.bob_checking.pk}))
+        self.assertEqual(response.status_code, 403)
+        response = await client.get(reverse('bank_accounts:internal_transfer_receipt_list'))
+        self.assertEqual(len(response.context['receipts']), 1)
+        response = await client.get(reverse('bank_accounts:external_transfer_receipt_list'))
+        self.assertEqual(response.context['receipts'][0].payee, self.bob)
+
+    @override_settings(BANK_ACCOUNTS_EVENTS_POLL_INTERVAL=None)
+    async def test_event_stream(self):
+        """
+        Under ASGI an event stream waits on the event loop, and is woken by transfers committed on other threads.
+        :return:
+        """
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+        response = await client.get(reverse('bank_accounts:events'))
+        chunks = aiter(response.streaming_content)
+        self.assertIn('"balance":850', (await anext(chunks)).decode())
+
+        def transfer():
+            with self.captureOnCommitCallbacks(execute=True):
+                transfers.internal_transfer(self.user, self.savings.pk, self.checking.pk, 100)
+        await sync_to_async(transfer)()
+        chunk = (await anext(chunks)).decode()
+        self.assertEqual(chunk.count('event: transfer'), 2)
+        self.assertIn('"balance":950', chunk)
+
+        waiting = asyncio.ensure_future(anext(chunks))
+        await asyncio.sleep(0.01)
+        waiting.cancel()  # As Django does when the client disconnects
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(events.hub.subscribers(), 0)
+
+
+@override_settings(BANK_ACCOUNTS_VELOCITY_RULES=[{'per': 'user', 'window': 3600, 'max_count': 3, 'max_amount': 100},
+                                                  {'per': 'account', 'window': 60, 'max_count': 2}])
+class VelocityTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('alice', 'password')
+        self.bob = create_user('bob', 'password')
+        self.checking = create_account(self.user, Account.CHECKING, balance=1000)
+        self.other_checking = create_account(self.user, Account.CHECKING, balance=1000)
+        self.bob_checking = create_account(self.bob, Account.CHECKING, balance=0)
+
+    def pay(self, amount, account=None):
+        return transfers.external_transfer(self.user, (account or self.checking).pk, self.bob.pk, amount)
+
+    def test_limits(self):
+        """
+        Payments over a count or amount limit are refused and not counted, per Account and over all of a User's.
+        :return:
+        """
+        self.pay(10)
+        self.pay(10)
+        with self.assertRaises(VelocityLimitExceeded):  # Third payment from the Account within a minute
+            self.pay(10)
+        with self.assertRaises(VelocityLimitExceeded):  # Over 100 in an hour
+            self.pay(81, self.other_checking)
+        self.pay(80, self.other_checking)
+        with self.assertRaises(VelocityLimitExceeded):  # Fourth payment within an hour
+            self.pay(1, self.other_checking)
+        self.assertEqual(Account.objects.get(pk=self.bob_checking.pk).balance, 100)
+
+    def test_refused_payment_not_counted(self):
+        """
+        Payments refused for another reason don't count towards the limits.
+        :return:
+        """
+        with self.assertRaises(InvalidAccount):
+            self.pay(10, self.bob_checking)
+        self.pay(10)
+        self.pay(10)
+        self.pay(10, self.other_checking)
+
+    def test_rolled_back_payment_not_counted(self):
+        """
+        A payment rolled back with the idempotency key saved after it doesn't count towards the limits.
+        :return:
+        """
+        expired = IdempotencyKey.objects.create(user=self.user, kind=IdempotencyKey.EXTERNAL_TRANSFER, key='retry',
+                                                receipt_id=1)
+        IdempotencyKey.objects.filter(pk=expired.pk).update(created=timezone.now() - datetime.timedelta(days=2))
+        # Saving the key fails on the expired one, rolling the first payment back, and the key is tried again once
+        # the expired one is deleted
+        receipt_id, replay = idempotency.run_once(self.user, IdempotencyKey.EXTERNAL_TRANSFER, 'retry',
+                                                  lambda: self.pay(10))
+        self.assertFalse(replay)
+        self.assertEqual(ExternalTransferReceipt.objects.count(), 1)
+        self.pay(10)  # The second payment within a minute, not the third
+
+    def test_seeded_from_receipts(self):
+        """
+        Counters start from the payments already in the receipt tables, e.g. those made through other processes.
+        :return:
+        """
+        self.pay(60)
+        ExternalTransferReceipt.objects.create(payer=self.user, payee=self.bob, from_account=self.other_checking,
+                                               to_account=self.bob_checking, amount=30,
+                                               date=timezone.now() - datetime.timedelta(minutes=30))
+        ExternalTransferReceipt.objects.create(payer=self.user, payee=self.bob, from_account=self.other_checking,
+                                               to_account=self.bob_checking, amount=1000,
+                                               date=timezone.now() - datetime.timedelta(hours=2))  # Outside the window
+        velocity._counters.clear()  # As when the process starts
+        with self.assertRaises(VelocityLimitExceeded):
+            self.pay(11, self.other_checking)
+        self.pay(10, self.other_checking)
+
+    def test_seeded_once(self):
+        """
+        Counters are seeded from the receipts only once, and after that checking a payment reads no receipts, however
+        long the counters have been kept.
+        :return:
+        """
+        self.pay(10)
+        later = time.monotonic() + 24 * 60 * 60
+        with mock.patch('bank_accounts.lru.time.monotonic', return_value=later), \
+                CaptureQueriesContext(connection) as queries:
+            velocity.reserve(self.user.pk, self.checking.pk, 10).cancel()
+        self.assertEqual(len(queries), 0)
+
+    def test_sliding_window(self):
+        """
+        Payments leave the window once it has slid past them.
+        :return:
+        """
+        window = velocity.SlidingWindow(60)
+        window.add(1000, 5)
+        window.add(1030, 7)
+        window.expire(1050)
+        self.assertEqual((window.count, window.amount), (2, 12))
+        window.expire(1062)
+        self.assertEqual((window.count, window.amount), (1, 7))
+        window.add(1030, -7, count=-1)
+        self.assertEqual((window.count, window.amount), (0, 0))
+
+    def test_messages(self):
+        """
+        Payments over a limit are refused with a message, in a batch or through the payment form.
+        :return:
+        """
+        self.client.login(username='alice', password='password')
+        payment = {'type': 'external', 'from_account': self.checking.pk, 'payee': self.bob.pk, 'amount': 10}
+        response = self.client.post(reverse('bank_accounts:batch_transfer'), data=json.dumps([payment] * 3),
+                                    content_type='application/json')
+        self.assertEqual([result['ok'] for result in response.json()['results']], [True, True, False])
+        self.assertEqual(response.json()['results'][2]['error'], 'Payment limit reached. Please try again later.')
+
+        response = self.client.post(reverse('bank_accounts:external_transfer'),
+                                    data={'from_account': self.checking.pk, 'payee': self.bob.pk, 'amount': 10},
+                                    follow=True)
+        self.assertContains(response, 'Payment limit reached.')
+        self.assertEqual(Account.objects.get(pk=self.bob_checking.pk).balance, 20)
+
 
 def create_user(username='username', password='password'):
     new_user = User.objects.create(username=username)
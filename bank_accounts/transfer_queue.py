@@ -0,0 +1,162 @@
+# Transfer queue
+# Payments can be made in the background instead of during the request. external_transfer_view then only saves a
+# QueuedTransfer and answers right away with the URL of its status, which clients poll. The run_transfer_queue workers
+# drain the queue in batches, in any number of processes, with the database as the only broker.
+
+# A worker claims a batch of pending payments (see bank_accounts.workers) and groups them by the Account paid from.
+# Each group is made in one transaction, so its Account is locked once and committed once, rather than once per payment.
+# Every payment within the group still has its own savepoint: refusing one doesn't undo the others. A payment and its
+# status change commit together, and only while the worker still holds its claim, so no payment is made twice.
+
+# Payments are queued on the shard of the User making them (see bank_accounts.routers). Workers claim from every shard.
+
+import itertools
+import logging
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction, IntegrityError, DatabaseError
+from django.utils import timezone
+
+from .models import QueuedTransfer
+from .exceptions import TransferError, InvalidAmount, InvalidPayee, SelfPayment
+from .batch import ERROR_MESSAGES
+from . import transfers, workers, routers
+
+logger = logging.getLogger(__name__)
+
+# Queued payments claimed by a worker at a time
+BATCH_SIZE = getattr(settings, 'BANK_ACCOUNTS_QUEUE_BATCH_SIZE', 200)
+
+FORM_FIELD = 'in_background'  # Form field opting a payment into the queue
+PREFER_ASYNC = 'respond-async'  # RFC 7240 Prefer header value opting a request into the queue
+
+
+def requested(request):
+    """
+    :param request:
+    :return: True if a payment request asks to be made in the background
+    """
+    return PREFER_ASYNC in request.META.get('HTTP_PREFER', '') or bool(request.POST.get(FORM_FIELD))
+
+
+def enqueue(payer, from_account_pk, payee_pk, amount, comment='', idempotency_key=None):
+    """
+    Queues a payment. Only the checks that need no query, and that the payee exists, are made now; the rest are made
+    with the payment.
+    :param payer: User making the payment
+    :param from_account_pk:
+    :param payee_pk:
+    :param amount:
+    :param comment:
+    :param idempotency_key: key of the request. A request retried with the same key gets the same QueuedTransfer.
+    :return: QueuedTransfer
+    :raise InvalidPayee: if there is no such payee, which the QueuedTransfer couldn't refer to
+    """
+    if amount <= 0:
+        raise InvalidAmount()
+    if payer.pk == payee_pk:
+        raise SelfPayment()
+    if not User.objects.filter(pk=payee_pk).exists():
+        raise InvalidPayee()
+
+    try:
+        with transaction.atomic(using=routers.primary()):
+            return QueuedTransfer.objects.create(user=payer, from_account_pk=from_account_pk, payee_id=payee_pk,
+                                                 amount=amount, comment=comment, idempotency_key=idempotency_key)
+    except IntegrityError:
+        if idempotency_key is None:
+            raise
+        # Already queued by an earlier attempt of the same request
+        queued = QueuedTransfer.objects.filter(user=payer, idempotency_key=idempotency_key).first()
+        if queued is None:
+            raise
+        return queued
+
+
+def run_batch(worker, batch_size=BATCH_SIZE, lease=workers.DEFAULT_LEASE):
+    """
+    Claims a batch of queued payments on each shard and makes them, one transaction per Account paid from.
+    :param worker: id of the worker, see workers.new_worker_id
+    :param batch_size: payments claimed per shard
+    :param lease: how long the worker may take to make the batch
+    :return: (payments made, payments refused). Both 0 when the queue is empty.
+    """
+    made = refused = 0
+    for alias in routers.all_shards():
+        with routers.using_shard(alias):
+            shard_made, shard_refused = _run_batch(worker, batch_size, lease)
+        made += shard_made
+        refused += shard_refused
+    return made, refused
+
+
+def _run_batch(worker, batch_size, lease):
+    """
+    Claims and makes a batch of the current shard's queued payments.
+    :return: (payments made, payments refused)
+    """
+    pending = QueuedTransfer.objects.filter(status=QueuedTransfer.PENDING)
+    pks = workers.claim(pending, worker, batch_size, order_by=['pk'], lease=lease)
+
+    made = refused = 0
+    # Groups in Account order, like the row locks of a transfer, so workers' groups are less likely to deadlock
+    claimed = QueuedTransfer.objects.filter(pk__in=pks, claimed_by=worker).select_related('user')\
+        .order_by('from_account_pk', 'pk')
+    for from_account_pk, group in itertools.groupby(claimed, key=lambda queued: queued.from_account_pk):
+        group = list(group)
+        try:
+            with transaction.atomic(using=routers.primary()):
+                results = [_make(queued, worker) for queued in group]
+        except DatabaseError:  # E.g. a deadlock with another worker. The group is claimed again later.
+            logger.exception('Payments from Account %d rolled back', from_account_pk)
+            workers.release(QueuedTransfer.objects.filter(pk__in=[queued.pk for queued in group]), worker)
+            continue
+        made += results.count(True)
+        refused += results.count(False)
+    return made, refused
+
+
+def _make(queued, worker):
+    """
+    Makes one queued payment and records its outcome.
+    :return: True if made, False if refused, None if the worker lost its claim
+    """
+    try:
+        with transaction.atomic(using=routers.primary()):
+            receipt = transfers.external_transfer(queued.user, queued.from_account_pk, queued.payee_id,
+                                                  queued.amount, queued.comment)
+            _complete(queued, worker, QueuedTransfer.DONE, receipt_id=receipt.pk)
+        return True
+    except TransferError as error:
+        try:
+            _complete(queued, worker, QueuedTransfer.FAILED, error=ERROR_MESSAGES[type(error)])
+        except workers.LostClaim:
+            return None
+        return False
+    except workers.LostClaim:
+        logger.warning('Claim on queued payment %d lapsed, leaving it to another worker', queued.pk)
+        return None
+
+
+def _complete(queued, worker, status, receipt_id=None, error=''):
+    updated = QueuedTransfer.objects.filter(pk=queued.pk, claimed_by=worker, status=QueuedTransfer.PENDING)\
+        .update(status=status, receipt_id=receipt_id, error=error, completed=timezone.now(), claimed_by=None,
+                claimed_until=None)
+    if not updated:
+        raise workers.LostClaim()
+
+
+def status(queued):
+    """
+    :param queued: QueuedTransfer
+    :return: dict describing a queued payment's progress, for clients polling it
+    """
+    return {
+        'id': queued.pk,
+        'status': queued.status,
+        'error': queued.error or None,
+        'receipt_id': queued.receipt_id,
+        'created': queued.created.isoformat(),
+        'completed': queued.completed.isoformat() if queued.completed else None,
+    }
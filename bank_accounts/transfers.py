@@ -0,0 +1,191 @@
+# Transfer service
+# Every movement of funds between Accounts goes through this module so that it happens as one atomic unit.
+
+# Concurrency:
+# Balances are never loaded into Python and saved back. Each side of a transfer is a single conditional UPDATE
+# (balance = balance +/- amount), so concurrent transfers cannot lose each other's updates.
+# A debit only matches its row if the balance covers the amount. When it matches nothing we roll back.
+# The UPDATEs of one transfer are issued in ascending primary key order. Every transfer therefore takes its row locks
+# in the same order, and two transfers touching the same pair of Accounts cannot deadlock.
+
+# Payments into Accounts that use balance slots land in a random slot instead of the Account row (see
+# bank_accounts.slots).
+
+# Transfers run on the shard of the User making them (see bank_accounts.routers). Payments to a User on another shard
+# are made in two phases by bank_accounts.cross_shard.
+
+# Payments are checked against the velocity rules (see bank_accounts.velocity) before any funds move.
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import Account, InternalTransferReceipt, ExternalTransferReceipt, LedgerEntry
+from .exceptions import InsufficientFunds, InvalidAmount, InvalidAccount, SameAccount, NotCheckingAccount, \
+    SelfPayment, NoCheckingAccount
+from . import ledger, rollups, slots, account_cache, routers, cross_shard, receiving, velocity
+
+# Side of a transfer that was refused
+DEBIT = 'debit'
+CREDIT = 'credit'
+
+
+def internal_transfer(user, from_account_pk, to_account_pk, amount):
+    """
+    Moves funds between two Accounts held by the same User and saves a receipt, ledger entries and rollups.
+    On success this costs three UPDATEs and three INSERTs.
+    :param user: User making the transfer. Must hold both Accounts.
+    :param from_account_pk:
+    :param to_account_pk:
+    :param amount:
+    :return: InternalTransferReceipt of the transfer
+    """
+    if amount <= 0:
+        raise InvalidAmount()
+    if from_account_pk == to_account_pk:
+        raise SameAccount()
+
+    with routers.using_shard(routers.shard_for(user.pk)):
+        return _consolidating(from_account_pk,
+                              lambda: _internal_transfer(user, from_account_pk, to_account_pk, amount))
+
+
+def _internal_transfer(user, from_account_pk, to_account_pk, amount):
+    with transaction.atomic(using=routers.primary()):
+        refused = _move_funds(from_account_pk, to_account_pk, amount,
+                              debit=Account.objects.filter(pk=from_account_pk, holder=user),
+                              credit=Account.objects.filter(pk=to_account_pk, holder=user))
+        if refused == DEBIT and Account.objects.filter(pk=from_account_pk, holder=user).exists():
+            raise InsufficientFunds()
+        if refused:
+            raise InvalidAccount()
+
+        receipt = InternalTransferReceipt.objects.create(user=user, from_account_id=from_account_pk,
+                                                         to_account_id=to_account_pk, amount=amount)
+        ledger.record_transfers(LedgerEntry.INTERNAL_TRANSFER, [receipt])
+        rollups.record_transfers([receipt])
+        account_cache.invalidate(user.pk)
+        return receipt
+
+
+def external_transfer(payer, from_account_pk, payee_pk, amount, comment=''):
+    """
+    Pays another User from one of the payer's Checking Accounts and saves a receipt, ledger entries and rollups.
+    Funds arrive in the payee's receiving Account (see bank_accounts.receiving).
+    On success this costs four UPDATEs and four INSERTs, plus one SELECT when the receiving Account isn't cached.
+    :param payer: User making the payment. Must hold the Account paid from.
+    :param from_account_pk:
+    :param payee_pk: primary key of the User receiving the payment
+    :param amount:
+    :param comment: User comment on nature of transfer
+    :return: ExternalTransferReceipt of the payment
+    :raise VelocityLimitExceeded: if the payment would break a velocity rule
+    """
+    if amount <= 0:
+        raise InvalidAmount()
+    if payer.pk == payee_pk:
+        raise SelfPayment()
+
+    shard = routers.shard_for(payer.pk)
+    with routers.using_shard(shard):
+        reservation = velocity.reserve(payer.pk, from_account_pk, amount)
+        try:
+            if routers.shard_for(payee_pk) != shard:
+                return _consolidating(from_account_pk,
+                                      lambda: cross_shard.pay(payer, from_account_pk, payee_pk, amount, comment))
+            return _consolidating(from_account_pk,
+                                  lambda: _external_transfer(payer, from_account_pk, payee_pk, amount, comment))
+        except Exception:
+            reservation.cancel()
+            raise
+
+
+def _external_transfer(payer, from_account_pk, payee_pk, amount, comment):
+    # A deposit into a cached receiving Account matches no row if another process changed or deleted the Account
+    # meanwhile. We then roll back and try once more with the Account read from the database.
+    for cached in (True, False):
+        with transaction.atomic(using=routers.primary()):
+            to_account_pk, to_account_slots = receiving.receiving_account(payee_pk, cached)
+
+            refused = _move_funds(from_account_pk, to_account_pk, amount,
+                                  debit=Account.objects.filter(pk=from_account_pk, holder=payer,
+                                                               account_type=Account.CHECKING),
+                                  credit=slots.credit_target(to_account_pk, to_account_slots))
+            if refused == DEBIT:
+                raise _refused_debit(payer, from_account_pk)
+            if refused == CREDIT:
+                transaction.set_rollback(True, using=routers.primary())
+                continue
+
+            receipt = ExternalTransferReceipt.objects.create(payer=payer, payee_id=payee_pk,
+                                                             from_account_id=from_account_pk,
+                                                             to_account_id=to_account_pk, comment=comment,
+                                                             amount=amount)
+            ledger.record_transfers(LedgerEntry.EXTERNAL_TRANSFER, [receipt])
+            rollups.record_transfers([receipt])
+            account_cache.invalidate(payer.pk, payee_pk)
+            return receipt
+    raise NoCheckingAccount()  # Payee's Account was deleted since we looked it up
+
+
+def _consolidating(from_account_pk, transfer):
+    """
+    Runs a transfer. If the Account paid from lacks funds but has some waiting in balance slots, they are consolidated
+    and the transfer is tried once more.
+    :param from_account_pk:
+    :param transfer: function performing the transfer
+    :return: what transfer returns
+    """
+    try:
+        return transfer()
+    except InsufficientFunds:
+        if not slots.consolidate(from_account_pk):
+            raise
+    return transfer()
+
+
+def _refused_debit(payer, from_account_pk):
+    """
+    Finds out why the withdrawal of a payment matched no row.
+    :param payer:
+    :param from_account_pk:
+    :return: TransferError to raise
+    """
+    from_account = Account.objects.filter(pk=from_account_pk, holder=payer).first()
+    if from_account is None:
+        return InvalidAccount()
+    if from_account.account_type != Account.CHECKING:
+        return NotCheckingAccount()
+    return InsufficientFunds()
+
+
+def _move_funds(from_account_pk, to_account_pk, amount, debit, credit):
+    """
+    Withdraws from one Account and deposits into another. Must be called inside a transaction, which the caller rolls
+    back when one side is refused.
+    :param from_account_pk:
+    :param to_account_pk:
+    :param amount:
+    :param debit: queryset matching only the Account to withdraw from, if the withdrawal is allowed
+    :param credit: queryset matching only the row to deposit into (an Account or BalanceSlot), if the deposit is allowed
+    :return: DEBIT or CREDIT if that side matched no row, else None
+    """
+    def withdraw():
+        return debit.filter(balance__gte=amount).update(balance=F('balance') - amount, version=F('version') + 1)
+
+    def deposit():
+        if credit.model is Account:
+            return credit.update(balance=F('balance') + amount, version=F('version') + 1)
+        return credit.update(balance=F('balance') + amount)  # A BalanceSlot, which leaves the Account row alone
+
+    # Lock rows in a deterministic order
+    if from_account_pk < to_account_pk:
+        if not withdraw():
+            return DEBIT
+        if not deposit():
+            return CREDIT
+    else:
+        if not deposit():
+            return CREDIT
+        if not withdraw():
+            return DEBIT
+    return None
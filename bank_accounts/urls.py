@@ -10,7 +10,10 @@ Class-based views
 from django.urls import path
 from bank_accounts.views import home_view, AccountCreateView, AccountListView,\
     account_detail_view, account_update_view, account_delete_view, internal_transfer_view, InternalTransferReceiptList,\
-    external_transfer_view, ExternalTransferReceiptList
+    external_transfer_view, ExternalTransferReceiptList, batch_transfer_view, payee_search_view, metrics_view,\
+    internal_transfer_export_view, external_transfer_export_view, recurring_transfer_view,\
+    recurring_transfer_cancel_view, queued_transfer_view, spending_view, top_payees_view, receiving_account_view,\
+    api_accounts_view, api_account_view, api_internal_transfers_view, api_payments_view, events_view
 
 app_name = 'bank_accounts'  # URL Namespace (to distinguish view names such as 'home' and 'bank_accounts:home')
 urlpatterns = [
@@ -29,9 +32,32 @@ urlpatterns = [
     path('internal_transfer', internal_transfer_view, name='internal_transfer'),
     # path('internal_transfer', raw_internal_transfer_view, name='internal_transfer')
     path('internal_transfer_receipt_list', InternalTransferReceiptList.as_view(), name='internal_transfer_receipt_list'),
+    path('internal_transfer_export', internal_transfer_export_view, name='internal_transfer_export'),
 
     path('external_transfer', external_transfer_view, name='external_transfer'),
+    path('payee_search', payee_search_view, name='payee_search'),
+    path('queued_transfers/<int:pk>', queued_transfer_view, name='queued_transfer'),
     path('external_transfer_receipt_list', ExternalTransferReceiptList.as_view(),
          name='external_transfer_receipt_list'),
+    path('external_transfer_export', external_transfer_export_view, name='external_transfer_export'),
+    path('receiving_account', receiving_account_view, name='receiving_account'),
+
+    path('batch_transfer', batch_transfer_view, name='batch_transfer'),
+
+    path('recurring_transfers', recurring_transfer_view, name='recurring_transfers'),
+    path('recurring_transfers/<int:pk>/cancel', recurring_transfer_cancel_view, name='recurring_transfer_cancel'),
+
+    path('analytics/spending', spending_view, name='spending'),
+    path('analytics/top_payees', top_payees_view, name='top_payees'),
+
+    # JSON API, see bank_accounts.api
+    path('api/v1/accounts', api_accounts_view, name='api_accounts'),
+    path('api/v1/accounts/<int:pk>', api_account_view, name='api_account'),
+    path('api/v1/internal_transfers', api_internal_transfers_view, name='api_internal_transfers'),
+    path('api/v1/payments', api_payments_view, name='api_payments'),
+
+    path('events', events_view, name='events'),
+
+    path('metrics', metrics_view, name='metrics'),
 
 ]
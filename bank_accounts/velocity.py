@@ -0,0 +1,214 @@
+# Velocity limits
+# The rules of the BANK_ACCOUNTS_VELOCITY_RULES setting cap how much and how often a User pays others over a rolling
+# window, either per User (over all their Accounts) or per Account paid from: e.g. at most 100 payments a day per User.
+# Each rule is a dict with "per" ("user" or "account"), "window" (seconds), and "max_count" and/or "max_amount".
+
+# Summing receipts on every payment would add a scan growing with the history. Instead each process keeps a sliding
+# window counter per User or Account and rule: the number and total amount of payments in each of SLICES slices of the
+# window, plus their running sums. Checking a payment drops the slices that left the window and adds the payment to the
+# newest slice, a constant amount of work. Slices are whole, so a counter covers up to one slice more than its window:
+# a payment may be refused up to one slice early, but is never let through late.
+
+# A counter is seeded from the receipt tables once, the first time its User or Account pays in the process (or pays
+# again after the counter was evicted from the LRU), and from then on only counted, so no payment rescans the window.
+# Payments made through other processes after that are not seen: each process enforces the limits on the payments it
+# makes, plus those already made when it seeded. A payment is counted when checked, before it is made, so concurrent
+# payments cannot all slip under a limit, and uncounted if it is then refused. A payment made inside a cancel_on_error
+# block (e.g. the transaction of idempotency.run_once) is also uncounted if the block raises, since its transaction then
+# rolls the payment back; one rolled back by any other enclosing transaction stays counted until it leaves the window.
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from asgiref.local import Local
+from django.conf import settings
+from django.db.models import Q
+
+from .models import ExternalTransferReceipt
+from .exceptions import VelocityLimitExceeded
+from .lru import LRUCache
+from . import archive, routers
+
+USER = 'user'
+ACCOUNT = 'account'
+
+# Slices each rule's window is kept in
+SLICES = 60
+
+# (rules, SlidingWindows) of each scope, by (database alias, scope, User or Account pk). Kept until evicted.
+_counters = LRUCache(maxsize=getattr(settings, 'BANK_ACCOUNTS_VELOCITY_CACHE_SIZE', 10000))
+_lock = threading.Lock()  # Held while checking and counting, so concurrent payments are counted one at a time
+_local = Local()  # Reservations made in the cancel_on_error block in progress
+
+
+def rules():
+    """
+    :return: list of the velocity rules
+    """
+    return getattr(settings, 'BANK_ACCOUNTS_VELOCITY_RULES', [])
+
+
+class SlidingWindow:
+    """
+    Number and total amount of payments over a rolling window, kept in slices.
+    """
+    def __init__(self, window, slices=SLICES):
+        self.width = window / slices
+        self.slices = slices
+        self._slices = deque()  # [slice number, count, amount], oldest first
+        self.count = 0
+        self.amount = 0
+
+    def expire(self, now):
+        """
+        Drops the slices entirely older than the window.
+        :param now: timestamp
+        :return:
+        """
+        oldest = int(now // self.width) - self.slices
+        while self._slices and self._slices[0][0] < oldest:
+            _, count, amount = self._slices.popleft()
+            self.count -= count
+            self.amount -= amount
+
+    def add(self, when, amount, count=1):
+        """
+        :param when: timestamp, no older than that of the payments added before
+        :param amount:
+        :param count: 1 to add a payment, -1 to take one back out
+        :return:
+        """
+        number = int(when // self.width)
+        if self._slices and self._slices[-1][0] == number:
+            self._slices[-1][1] += count
+            self._slices[-1][2] += amount
+        elif count > 0:
+            self._slices.append([number, count, amount])
+        else:  # Taking back a payment, from the slice it was added to unless it has left the window
+            for piece in reversed(self._slices):
+                if piece[0] == number:
+                    piece[1] += count
+                    piece[2] += amount
+                    break
+            else:
+                return
+        self.count += count
+        self.amount += amount
+
+
+class Reservation:
+    """
+    A payment counted against the velocity rules.
+    """
+    def __init__(self, windows, when, amount):
+        self._windows = windows
+        self._when = when
+        self._amount = amount
+
+    def cancel(self):
+        """
+        Uncounts the payment, when it was refused after all.
+        :return:
+        """
+        with _lock:
+            for window in self._windows:
+                window.add(self._when, -self._amount, count=-1)
+        self._windows = []
+
+
+@contextmanager
+def cancel_on_error():
+    """
+    Cancels the reservations made in a block if it raises, e.g. when it is a transaction that rolls back payments made
+    in it. Reservations made in a block that completes are cancelled by the block enclosing it, if any, should that
+    one raise.
+    :return:
+    """
+    enclosing = getattr(_local, 'reservations', None)
+    _local.reservations = reservations = []
+    try:
+        yield
+    except BaseException:
+        for reservation in reservations:
+            reservation.cancel()
+        raise
+    else:
+        if enclosing is not None:
+            enclosing.extend(reservations)
+    finally:
+        _local.reservations = enclosing
+
+
+def reserve(payer_pk, account_pk, amount):
+    """
+    Counts a payment against the velocity rules, if it breaks none of them. Must be called with the payer's shard
+    current.
+    :param payer_pk:
+    :param account_pk: primary key of the Account paid from
+    :param amount:
+    :return: Reservation, to cancel if the payment is refused
+    :raise VelocityLimitExceeded: if the payment would break a rule
+    """
+    now = time.time()
+    checked = []  # (rule, SlidingWindow)
+    for scope, pk in ((USER, payer_pk), (ACCOUNT, account_pk)):
+        scoped = [rule for rule in rules() if rule['per'] == scope]
+        if scoped:
+            checked += zip(scoped, _windows(scope, pk, scoped, now))
+
+    with _lock:
+        for rule, window in checked:
+            window.expire(now)
+            if window.count + 1 > rule.get('max_count', float('inf')) or \
+                    window.amount + amount > rule.get('max_amount', float('inf')):
+                raise VelocityLimitExceeded()
+        for rule, window in checked:
+            window.add(now, amount)
+    reservation = Reservation([window for rule, window in checked], now, amount)
+    tracked = getattr(_local, 'reservations', None)
+    if tracked is not None:
+        tracked.append(reservation)
+    return reservation
+
+
+def _windows(scope, pk, scoped, now):
+    """
+    :param scope: USER or ACCOUNT
+    :param pk: primary key of the User or Account
+    :param scoped: rules of the scope
+    :param now: timestamp
+    :return: list of the SlidingWindow of each rule, seeded from the receipts if not counted yet in this process
+    """
+    key = (routers.primary(), scope, pk)
+    cached = _counters.get(key)
+    if cached is not None and cached[0] == scoped:
+        return cached[1]
+
+    windows = [SlidingWindow(rule['window']) for rule in scoped]
+    for when, amount in _payments(scope, pk, now - max(rule['window'] for rule in scoped)):
+        for window in windows:
+            window.add(when, amount)
+
+    with _lock:  # Keep the counters another payment seeded meanwhile, which may have counted it already
+        cached = _counters.get(key)
+        if cached is not None and cached[0] == scoped:
+            return cached[1]
+        _counters.set(key, (scoped, windows))
+    return windows
+
+
+def _payments(scope, pk, since):
+    """
+    :return: list of (timestamp, amount) of the payments made by a User or from an Account since a timestamp, oldest
+    first
+    """
+    condition = Q(payer_id=pk) if scope == USER else Q(from_account_id=pk)
+    start = datetime.fromtimestamp(since, tz=timezone.utc)
+    payments = []
+    for model in archive.receipt_models(ExternalTransferReceipt, start):  # Oldest first
+        payments += [(date.timestamp(), amount) for date, amount in model.objects.filter(condition, date__gte=start)
+                     .order_by('date', 'id').values_list('date', 'amount')]
+    return payments
@@ -0,0 +1,113 @@
+# Versioned Account writes
+# Every write to an Account row increments Account.version. A read-modify-write can then skip locking the row: it reads
+# the row with its version, decides what to change, and writes only the changed fields with an UPDATE that matches the
+# row only if its version is still the one read (compare-and-swap). If another write got there first the UPDATE matches
+# nothing, and we read the row again and retry after a short random backoff, a bounded number of times.
+
+# This is the optimistic mode, the default. Without contention it costs one SELECT and one UPDATE and holds no lock
+# between them. Under heavy contention retries pile up, so the pessimistic mode, which locks the row with SELECT ... FOR
+# UPDATE for the whole read-modify-write instead, can be chosen with the BANK_ACCOUNTS_LOCKING setting. Compare both
+# with the bench_account_locking command.
+
+import random
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import Account
+from .exceptions import ConcurrentUpdate
+from . import routers
+
+OPTIMISTIC = 'optimistic'
+PESSIMISTIC = 'pessimistic'
+MODE = getattr(settings, 'BANK_ACCOUNTS_LOCKING', OPTIMISTIC)
+
+# Tries of a conflicting write before giving up with ConcurrentUpdate
+MAX_ATTEMPTS = 5
+
+# Most seconds to wait before the first retry. Doubles on each retry up to MAX_BACKOFF.
+BACKOFF = 0.005
+MAX_BACKOFF = 0.1
+
+
+def compare_and_swap(account, **changes):
+    """
+    Writes changed fields of an Account only if nobody else wrote to it since it was read. On success the Account
+    instance is updated to match.
+    :param account: Account, as read
+    :param changes: new values by field name
+    :return: True if written, False if the Account changed or was deleted meanwhile
+    """
+    if not Account.objects.filter(pk=account.pk, version=account.version)\
+            .update(version=F('version') + 1, **changes):
+        return False
+    for field, value in changes.items():
+        setattr(account, field, value)
+    account.version += 1
+    return True
+
+
+def update_account(pk, change, queryset=None, account=None, mode=None, attempts=MAX_ATTEMPTS):
+    """
+    Read-modify-writes an Account, writing only the fields that change.
+    :param pk:
+    :param change: function given the Account as read, returning a dict of new values by field name (empty to change
+    nothing). May be called once per attempt.
+    :param queryset: Accounts that may be updated, e.g. those of a User. Defaults to every Account.
+    :param account: the Account already read, saving the first read. Must come from queryset.
+    :param mode: OPTIMISTIC or PESSIMISTIC, defaults to the BANK_ACCOUNTS_LOCKING setting
+    :param attempts: tries before giving up, in the optimistic mode
+    :return: the updated Account
+    :raise Account.DoesNotExist: if queryset has no such Account
+    :raise ConcurrentUpdate: if every attempt conflicted with another write
+    """
+    queryset = Account.objects.all() if queryset is None else queryset
+
+    if (mode or MODE) == PESSIMISTIC:
+        with transaction.atomic(using=routers.primary()):
+            account = queryset.select_for_update().get(pk=pk)
+            changes = change(account)
+            if changes:
+                Account.objects.filter(pk=pk).update(version=F('version') + 1, **changes)
+                for field, value in changes.items():
+                    setattr(account, field, value)
+                account.version += 1
+            return account
+
+    for attempt in range(attempts):
+        if account is None:
+            account = queryset.get(pk=pk)
+        changes = change(account)
+        if not changes or compare_and_swap(account, **changes):
+            return account
+        account = None
+        if attempt + 1 < attempts:
+            time.sleep(backoff(attempt))
+    raise ConcurrentUpdate()
+
+
+def retry(function, attempts=MAX_ATTEMPTS):
+    """
+    Calls a function until it doesn't raise ConcurrentUpdate, backing off between calls.
+    :param function: e.g. a read-modify-write done in its own transaction, raising ConcurrentUpdate on a conflict
+    :param attempts:
+    :return: what function returns
+    :raise ConcurrentUpdate: if every call raised it
+    """
+    for attempt in range(attempts):
+        try:
+            return function()
+        except ConcurrentUpdate:
+            if attempt + 1 == attempts:
+                raise
+        time.sleep(backoff(attempt))
+
+
+def backoff(attempt):
+    """
+    :param attempt: number of tries that conflicted so far, minus one
+    :return: seconds to wait before trying again: random, up to an exponentially growing bound (full jitter)
+    """
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
@@ -1,17 +1,34 @@
+import csv
+import json
+import uuid
+
 from django.shortcuts import render, reverse, redirect
 from django.utils import timezone
 
 # Create your views here.
 
-from .models import Account, InternalTransferReceipt, ExternalTransferReceipt
+from .models import Account, InternalTransferReceipt, ExternalTransferReceipt, IdempotencyKey, RecurringTransfer, \
+    QueuedTransfer, ArchivedInternalTransferReceipt, ArchivedExternalTransferReceipt
 from django.contrib.auth.models import User
 
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, Http404
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, Http404, HttpResponseNotAllowed, \
+    JsonResponse, StreamingHttpResponse
 
 from django.views.generic import CreateView, ListView, DetailView, UpdateView, DeleteView
 
-from .forms import AccountForm, AccountUpdateForm, InternalTransferForm, ExternalTransferForm
+from .forms import AccountForm, AccountUpdateForm, InternalTransferForm, ExternalTransferForm, RecurringTransferForm, \
+    ReceivingAccountForm
+from .exceptions import TransferError, InsufficientFunds, InvalidAmount, InvalidAccount, SameAccount, \
+    NotCheckingAccount, InvalidPayee, SelfPayment, NoCheckingAccount, VelocityLimitExceeded, ConcurrentUpdate
+from .pagination import KeysetPaginationMixin
+from . import transfers, batch, payees, idempotency, account_cache, exports, instrumentation, recurring, \
+    transfer_queue, rollups, versioning, receiving, routers, api, events
+from .instrumentation import query_budget
+from .routers import read_only
+from .api import api_view
 from django.contrib.auth.forms import UserCreationForm
+from django.core.handlers.asgi import ASGIRequest
+from django.utils.functional import empty
 
 # Authentication (i.e. Checking if a client is also a User)
 
@@ -26,14 +43,43 @@ from django.contrib.auth.mixins import LoginRequiredMixin  # Use for class based
 
 from django.contrib import messages
 
+# Async views
+# The views that only read (home, account list and detail, receipt lists) are async and read through the async ORM.
+# Under ASGI (see mysite3.asgi) they wait for the database without holding up the event loop. Under WSGI Django runs
+# them synchronously, like the other views.
+
+
+async def load_user(request):
+    """
+    Loads the User of a request without blocking, and replaces the lazy request.user with it, which would otherwise
+    load the User again, synchronously, when first used (e.g. by templates).
+    :param request:
+    :return: the User
+    """
+    if getattr(request.user, '_wrapped', None) is empty:  # Unless already loaded, e.g. by RoutingMiddleware when sharding
+        request.user = await request.auser()
+    return request.user
+
+
+class AsyncLoginRequiredMixin(LoginRequiredMixin):
+    """
+    LoginRequiredMixin for async class-based views.
+    """
+    async def dispatch(self, request, *args, **kwargs):
+        if not (await load_user(request)).is_authenticated:
+            return self.handle_no_permission()
+        return await super(LoginRequiredMixin, self).dispatch(request, *args, **kwargs)
+
 
 @login_required
-def home_view(request):
+@query_budget(2)
+async def home_view(request):
     """
     Displays home page.
     :param request:
     :return:
     """
+    await load_user(request)
     return render(request, 'bank_accounts/home.html')
 
 
@@ -53,6 +99,7 @@ class AccountCreateView(LoginRequiredMixin, CreateView):  # CreateView is generi
     model = Account  # Model we're creating
     form_class = AccountForm  # Django Form class we're using
     template_name = 'bank_accounts/create.html'
+    query_budget = 6  # Most queries per request, see bank_accounts.instrumentation
     # The URL that handles forms typically also displays the form
     success_url = '/bank_accounts/create'  # URL to redirect after user successfully submits form.
 
@@ -98,6 +145,7 @@ class AccountCreateView(LoginRequiredMixin, CreateView):  # CreateView is generi
 #     return render(request, 'bank_accounts/create_raw.html')
 
 @login_required
+@query_budget(8)  # Three more when the type changes and another Account must receive payments
 def account_update_view(request, pk):
     """
     Handles updating information about a bank account.
@@ -117,9 +165,26 @@ def account_update_view(request, pk):
             print("POST Request")
             if form.is_valid():  # Submitted form is valid
                 print("Valid Form")
-                # Process form data
-                account_requested.account_type = form.cleaned_data['account_type']
-                account_requested.save()
+                # Process form data. Only changed fields are written, and only if the Account didn't change since we
+                # read it, so concurrent transfers are never overwritten.
+                changed = []
+
+                def change(account):
+                    changes = {field: value for field, value in form.cleaned_data.items()
+                               if getattr(account, field) != value}
+                    changed[:] = changes
+                    return changes
+                try:
+                    versioning.update_account(account_requested.pk, change, queryset=Account.objects.filter(
+                        holder=request.user), account=account_requested)
+                except Account.DoesNotExist:  # Deleted or given away meanwhile
+                    raise Http404()
+                except ConcurrentUpdate:
+                    messages.error(request, 'The Account is busy. Please try again.')
+                    return redirect(to=reverse('bank_accounts:update', kwargs={'pk': account_requested.pk}))
+                account_cache.invalidate(request.user.pk)
+                if 'account_type' in changed:  # The User may need another Account to receive payments
+                    receiving.refresh(request.user.pk, using=routers.primary())
                 # Return to Account details
                 return redirect(to=reverse('bank_accounts:account_detail', kwargs={'pk': account_requested.pk}))
 
@@ -154,6 +219,7 @@ def account_update_view(request, pk):
 
 
 @login_required
+@query_budget(12)
 def account_delete_view(request, pk):
     """
     Displays and processes requests to delete a bank account.
@@ -186,39 +252,51 @@ def account_delete_view(request, pk):
 
 # If User is not authenticated, then we URL redirect to login (default is auth login view)
 # Display a list of a User's Accounts
-class AccountListView(LoginRequiredMixin, ListView):
+class AccountListView(AsyncLoginRequiredMixin, ListView):
     """
     Displays a list of bank accounts.
     """
     template_name = 'bank_accounts/account_list.html'
+    query_budget = 3
+    read_only = True  # Reads from replicas, see bank_accounts.routers
     model = Account
     context_object_name = 'account_list'
 
-    def get_queryset(self):  # Get the list of model instances we can display
-        return Account.objects.filter(holder=self.request.user)
+    async def get(self, request, *args, **kwargs):
+        self.object_list = await account_cache.aholder_accounts(request.user)
+        return self.render_to_response(self.get_context_data())
 
 
 # Custom account detail view that enforces: Only Authenticated, Account holders may view an Account's details
 @login_required
-def account_detail_view(request, pk):
+@read_only
+@query_budget(4)
+async def account_detail_view(request, pk):
     """
     Displays details about a specific bank account.
     :param request:
     :param pk:
     :return:
     """
-    # Access the account we want to detail
-    try:
-        account = Account.objects.get(pk=pk)
-    except Account.DoesNotExist:  # Model class supports DNE exceptions
-        raise Http404()
+    await load_user(request)
+    # Access the account we want to detail. It is usually one of the User's own, which are cached.
+    account = None
+    for held_account in await account_cache.aholder_accounts(request.user):
+        if held_account.pk == pk:
+            account = held_account
+            break
+    if account is None:
+        try:
+            account = await Account.objects.aget(pk=pk)
+        except Account.DoesNotExist:  # Model class supports DNE exceptions
+            raise Http404()
 
     context = {
         "account": account
     }
 
     # If User holds the Account, User may view Account details
-    if request.user == account.holder:
+    if account.holder_id == request.user.pk:
         return render(request=request, template_name='bank_accounts/account_detail.html', context=context)
     # Else User is not Authorized to view resource
     else:
@@ -233,8 +311,8 @@ def account_detail_view(request, pk):
     #     return Account.objects.get(holder=self.request.user)  # User can access his own accounts
 
 
-# TODO: Refreshing causes User to resubmit form. Make sure to redirect them and make them do a GET request right after.
 @login_required
+@query_budget(12)
 def internal_transfer_view(request):
     """
     Handles the display and processing of internal transfer form.
@@ -242,7 +320,7 @@ def internal_transfer_view(request):
     :return:
     """
     # Retrieve a list of User's Accounts
-    accounts = Account.objects.filter(holder=request.user)
+    accounts = account_cache.holder_accounts(request.user)
 
     if not accounts:  # User has no Accounts
         return render(request, 'bank_accounts/home.html', {'message': 'Error: No Accounts to transfer between.'})
@@ -251,53 +329,33 @@ def internal_transfer_view(request):
         # Process form
         form = InternalTransferForm(request.POST)
         if form.is_valid():
+            # Perform transfer, unless this is a retry of a request that already succeeded
             try:
-                from_account = Account.objects.get(pk=form.cleaned_data['from_account'])
-                to_account = Account.objects.get(pk=form.cleaned_data['to_account'])
-                amount = form.cleaned_data['balance']
-            except Account.DoesNotExist:
+                idempotency.run_once(request.user, IdempotencyKey.INTERNAL_TRANSFER, idempotency.request_key(request),
+                                     lambda: transfers.internal_transfer(
+                                         user=request.user,
+                                         from_account_pk=form.cleaned_data['from_account'],
+                                         to_account_pk=form.cleaned_data['to_account'],
+                                         amount=form.cleaned_data['balance']))
+            except InvalidAccount:  # Accounts don't exist or aren't held by User
                 return render(request, 'bank_accounts/account_list.html',
                               {'account_list': accounts,
                                'message': 'Error: Accounts selected invalid.'})
-
-            # Check enough funds to make transfer
-            if amount > from_account.balance:
+            except InsufficientFunds:
                 return render(request, 'bank_accounts/account_list.html',
                               {'account_list': accounts,
                                'message': 'Error: Not enough funds to make transfer.'})
-
-            # Check transfer is between valid accounts
-            account_pks = []
-            for account in accounts:
-                account_pks.append(account.pk)
-            if from_account.pk not in account_pks or to_account.pk not in account_pks:
-                return render(request, 'bank_accounts/account_list.html',
-                              {'account_list': accounts,
-                               'message': 'Error: Accounts selected invalid.'})
-
-            # Check transfer is not between the same accounts
-            if from_account.pk == to_account.pk:
+            except SameAccount:
                 return render(request, 'bank_accounts/account_list.html',
                               {'account_list': accounts,
                                'message': 'Error: Selected Accounts cannot be the same.'})
-
-            # Check that transferred funds is positive
-            if amount <= 0:
+            except InvalidAmount:  # Transferred funds must be positive
                 return render(request, 'bank_accounts/account_list.html',
                               {'account_list': accounts,
                                'message': 'Error: Amount to transfer must be positive.'})
 
-            # Perform transfer
-            # TODO: Worry about atomicity of transaction
-            from_account.withdraw(amount)
-            to_account.deposit(amount)
-
-            # Save receipt
-            InternalTransferReceipt.objects.create(user=request.user,
-                                                   from_account=from_account,
-                                                   to_account=to_account, amount=amount)
-
-            # Redirect to account list
+            # Redirect to account list, showing the balances after the transfer
+            accounts = account_cache.holder_accounts(request.user)
             return render(request, 'bank_accounts/account_list.html', {'account_list': accounts,
                                                                        'message': "Internal transfer successful."})
 
@@ -307,7 +365,9 @@ def internal_transfer_view(request):
 
     else:  # User is viewing form
         # Internal Transfers take place between two of a User's Accounts
-        return render(request, 'bank_accounts/internal_transfer.html', {'accounts': accounts})
+        # The form carries a fresh idempotency key, so resubmitting it doesn't transfer twice
+        return render(request, 'bank_accounts/internal_transfer.html', {'accounts': accounts,
+                                                                        'idempotency_key': uuid.uuid4().hex})
 # Uses Raw HTML instead of Django ModelForm. Doesn't support form validation.
 # @login_required
 # def raw_internal_transfer_view(request):
@@ -347,19 +407,33 @@ def internal_transfer_view(request):
 #             return render(request, 'bank_accounts/internal_transfer.html', context)
 
 
-class InternalTransferReceiptList(LoginRequiredMixin, ListView):
+class InternalTransferReceiptList(AsyncLoginRequiredMixin, KeysetPaginationMixin, ListView):
     """
-    Displays a history of internal transfers.
+    Displays a history of internal transfers, newest first, one page at a time.
     """
     template_name = 'bank_accounts/internal_transfer_receipt_list.html'
+    query_budget = 4  # One more for pages reaching the archive
+    read_only = True  # Reads from replicas, see bank_accounts.routers
     model = InternalTransferReceipt
     context_object_name = 'receipts'
 
     def get_queryset(self):  # Get the list of model instances we can display
-        return InternalTransferReceipt.objects.filter(user=self.request.user)
+        # Join the Accounts the template displays, instead of querying them for each receipt
+        return InternalTransferReceipt.objects.filter(user=self.request.user)\
+            .select_related('from_account', 'to_account')
+
+    def get_archived_queryset(self):
+        return ArchivedInternalTransferReceipt.objects.filter(user=self.request.user)\
+            .select_related('from_account', 'to_account')
+
+    async def get(self, request, *args, **kwargs):
+        self.object_list = self.get_queryset()
+        await self.apaginate_queryset(self.object_list)
+        return self.render_to_response(self.get_context_data())
 
 
 @login_required
+@query_budget(15)
 def external_transfer_view(request):
     """
     Handles the display and processing of external transfer form.
@@ -368,88 +442,83 @@ def external_transfer_view(request):
     """
 
     # Get list of requesting User's Accounts
-    from_accounts = Account.objects.filter(holder=request.user)
-    # TODO: What if there are 1 million Users?
-    # Get list of all Users
-    users = User.objects.all()
+    from_accounts = account_cache.holder_accounts(request.user)
+    # Users to pay are looked up by username as the User types (see payee_search_view)
 
     if not from_accounts:  # User has no Accounts
         return render(request, 'bank_accounts/home.html', {'message': 'Error: No Accounts to payments from.'})
-    if not users:
-        return render(request, 'bank_accounts/home.html', {'message': 'Error: No Users to make payments to.'})
 
     if request.method == 'GET':  # User views form
         return render(request, 'bank_accounts/external_transfer.html', {'from_accounts': from_accounts,
-                                                                        'users': users})
+                                                                        'idempotency_key': uuid.uuid4().hex})
     elif request.method == 'POST':  # User submits form
         form = ExternalTransferForm(request.POST)
         print(form)
         if form.is_valid():
 
             print('valid')
-            # Use form data to get relevant database objects
+            payee = form.cleaned_data['payee']
+            if payee is None:  # Payee given by username
+                payee = payees.payee_pk(form.cleaned_data['payee_username'])
+                if payee is None:
+                    messages.add_message(request, messages.ERROR,
+                                         'The user you are making the payment to does not exist.')
+                    return redirect(to=reverse('bank_accounts:home'))
+
+            queued = None
             try:
-                from_account = Account.objects.get(pk=form.cleaned_data['from_account'])
-            except Account.DoesNotExist:
+                if transfer_queue.requested(request):  # Queue the payment for a worker and answer right away
+                    queued = transfer_queue.enqueue(payer=request.user,
+                                                    from_account_pk=form.cleaned_data['from_account'],
+                                                    payee_pk=payee,
+                                                    amount=form.cleaned_data['amount'],
+                                                    comment=form.cleaned_data['comment'],
+                                                    idempotency_key=idempotency.request_key(request))
+                else:  # Perform transfer, unless this is a retry of a request that already succeeded
+                    idempotency.run_once(request.user, IdempotencyKey.EXTERNAL_TRANSFER,
+                                         idempotency.request_key(request),
+                                         lambda: transfers.external_transfer(
+                                             payer=request.user,
+                                             from_account_pk=form.cleaned_data['from_account'],
+                                             payee_pk=payee,
+                                             amount=form.cleaned_data['amount'],
+                                             comment=form.cleaned_data['comment']))
+            except InvalidAccount:
                 messages.add_message(request, messages.ERROR,
                                      'The account you are making the payment from does not exist.')
                 return redirect(to=reverse('bank_accounts:home'))
-
-            try:
-                payee = User.objects.get(pk=form.cleaned_data['payee'])
-            except User.DoesNotExist:
+            except InvalidPayee:
                 messages.add_message(request, messages.ERROR,
                                      'The user you are making the payment to does not exist.')
                 return redirect(to=reverse('bank_accounts:home'))
-
-            try:
-                payee_accounts = Account.objects.filter(holder=payee.pk)
-            except Account.DoesNotExist:
-                messages.add_message(request, messages.ERROR,
-                                     'The user you are making the payment to does not have any accounts.')
-                return redirect(to=reverse('bank_accounts:home'))
-
-            to_account = None
-            # for account in payee.account_set:
-            for account in payee_accounts:  # For each user account
-                if account.account_type == Account.CHECKING:
-                    to_account = account
-                    break
-            if to_account is None:
+            except NoCheckingAccount:
                 messages.add_message(request, messages.ERROR,
                                      'The user you are making the payment to does not have a checking account.')
                 return redirect(to=reverse('bank_accounts:home'))
-
-            amount = form.cleaned_data['amount']
-
-            comment = form.cleaned_data['comment']
-
-            # Check valid payment
-            if amount > from_account.balance:  # Not enough funds
+            except InsufficientFunds:  # Not enough funds
                 messages.add_message(request, messages.ERROR, 'Not enough funds.')
                 return redirect(to=reverse('bank_accounts:home'))
-            if amount <= 0:  # Non-positive amount
+            except InvalidAmount:  # Non-positive amount
                 messages.add_message(request, messages.ERROR, 'You must select a positive amount.')
                 return redirect(to=reverse('bank_accounts:home'))
-            if request.user == payee:  # Payee is User himself
+            except SelfPayment:  # Payee is User himself
                 messages.add_message(request, messages.ERROR, 'You cannot pay yourself.')
                 return redirect(to=reverse('bank_accounts:home'))
-            if from_account.account_type != Account.CHECKING:  # from account is not a Checking Account
+            except NotCheckingAccount:  # from account is not a Checking Account
                 messages.add_message(request, messages.ERROR, 'You must make a payment from a checking account.')
                 return redirect(to=reverse('bank_accounts:home'))
+            except VelocityLimitExceeded:  # Paying too much or too often, see bank_accounts.velocity
+                messages.add_message(request, messages.ERROR, batch.ERROR_MESSAGES[VelocityLimitExceeded])
+                return redirect(to=reverse('bank_accounts:home'))
 
-            # Perform transfer
-            # TODO: Worry about atomicity of transaction
-            from_account.withdraw(amount)
-            to_account.deposit(amount)
-
-            # Save receipt
-            ExternalTransferReceipt.objects.create(payer=request.user,
-                                                   payee=payee,
-                                                   from_account=from_account,
-                                                   to_account=to_account,
-                                                   comment=comment,
-                                                   amount=amount)
+            if queued is not None:
+                status_url = reverse('bank_accounts:queued_transfer', kwargs={'pk': queued.pk})
+                if transfer_queue.PREFER_ASYNC in request.META.get('HTTP_PREFER', ''):  # API client
+                    response = JsonResponse(transfer_queue.status(queued), status=202)
+                    response['Location'] = status_url
+                    return response
+                messages.add_message(request, messages.SUCCESS, 'Payment queued.')
+                return redirect(status_url)
 
             messages.add_message(request, messages.SUCCESS, 'Payment successful.')
             return redirect(reverse('bank_accounts:home'))
@@ -460,23 +529,379 @@ def external_transfer_view(request):
         # Treat it as GET request
         messages.add_message(request, messages.ERROR, 'Unrecognized request.')
         return render(request, 'bank_accounts/external_transfer.html', {'from_accounts': from_accounts,
-                                                                        'users': users})
+                                                                        'idempotency_key': uuid.uuid4().hex})
 
 
-class ExternalTransferReceiptList(LoginRequiredMixin, ListView):
+class ExternalTransferReceiptList(AsyncLoginRequiredMixin, KeysetPaginationMixin, ListView):
     """
-    Displays a history of external transfers.
+    Displays a history of external transfers, newest first, one page at a time.
     """
     template_name = 'bank_accounts/external_transfer_receipt_list.html'
+    query_budget = 6  # Two more for pages reaching the archive
+    read_only = True  # Reads from replicas, see bank_accounts.routers
     model = ExternalTransferReceipt
     context_object_name = 'receipts'
 
     def get_queryset(self):  # Get the list of model instances we can display
-        return ExternalTransferReceipt.objects.filter(payer=self.request.user) |\
-               ExternalTransferReceipt.objects.filter(payee=self.request.user)
+        return self._sides(ExternalTransferReceipt)
+
+    def get_archived_queryset(self):
+        return self._sides(ArchivedExternalTransferReceipt)
+
+    def _sides(self, model):
+        # Payments sent and received are read through their own indexes and merged, see bank_accounts.pagination.
+        # Join the Users and Accounts the template displays, instead of querying them for each receipt.
+        receipts = model.objects.select_related('payer', 'payee', 'from_account', 'to_account')
+        return [receipts.filter(payer=self.request.user), receipts.filter(payee=self.request.user)]
+
+    async def get(self, request, *args, **kwargs):
+        self.object_list = self.get_queryset()
+        await self.apaginate_queryset(self.object_list)
+        return self.render_to_response(self.get_context_data())
+
+
+@login_required
+@query_budget(3)
+def payee_search_view(request):
+    """
+    Finds Users to pay whose username starts with the "q" GET parameter.
+    :param request:
+    :return: JSON list of Users, at most payees.MAX_RESULTS long
+    """
+    results = [{'id': pk, 'username': username}
+               for pk, username in payees.search_payees(request.GET.get('q', ''))
+               if pk != request.user.pk]  # Users cannot pay themselves
+    return JsonResponse({'results': results})
+
+
+@login_required
+@read_only
+@query_budget(4)  # One more when the date range reaches the archive
+def internal_transfer_export_view(request):
+    """
+    Streams the User's internal transfers as CSV or JSON Lines. See export_response for the GET parameters.
+    :param request:
+    :return:
+    """
+    return export_response(request, exports.internal_rows, exports.INTERNAL_FIELDS, 'internal_transfers')
+
+
+@login_required
+@read_only
+@query_budget(4)  # One more when the date range reaches the archive
+def external_transfer_export_view(request):
+    """
+    Streams the payments the User sent or received as CSV or JSON Lines. See export_response for the GET parameters.
+    :param request:
+    :return:
+    """
+    return export_response(request, exports.external_rows, exports.EXTERNAL_FIELDS, 'payments')
+
+
+def export_response(request, rows, fields, filename):
+    """
+    Streams an export. GET parameters: format ("csv" or "jsonl", default csv), account (Account primary key),
+    start and end (ISO dates or datetimes, end is exclusive).
+    :param request:
+    :param rows: function generating the rows of an export, from bank_accounts.exports
+    :param fields: names of the columns
+    :param filename: name of the downloaded file, without extension
+    :return:
+    """
+    export_format = request.GET.get('format', exports.CSV)
+    if export_format not in exports.CONTENT_TYPES:
+        return HttpResponse('Unknown format.', status=400)
+    try:
+        account_pk = int(request.GET['account']) if request.GET.get('account') else None
+        start = exports.parse_bound(request.GET.get('start'))
+        end = exports.parse_bound(request.GET.get('end'))
+    except ValueError:
+        return HttpResponse('Invalid account or date.', status=400)
+
+    lines = exports.render(rows(request.user, account_pk, start, end), fields, export_format)
+    response = StreamingHttpResponse(lines, content_type=exports.CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, export_format)
+    return response
+
+
+@login_required  # No query budget: the stream queries again for every change it sends
+def events_view(request):
+    """
+    Streams server-sent events of changes to the User's Accounts. See bank_accounts.events.
+    :param request:
+    :return:
+    """
+    # Under ASGI the stream waits on the event loop instead of holding a thread
+    stream = events.astream if isinstance(request, ASGIRequest) else events.stream
+    response = StreamingHttpResponse(stream(request.user, events.last_event_id(request)),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Keeps proxies such as nginx from holding events back
+    return response
+
+
+@query_budget(2)  # Loading the session and User, unless the request comes from an allowed address
+def metrics_view(request):
+    """
+    Exposes this process's counters and request histograms in the Prometheus text format, to staff Users and allowed
+    addresses only.
+    :param request:
+    :return:
+    """
+    if not instrumentation.can_read_metrics(request):
+        return HttpResponseForbidden()
+    lines = []
+    for name, value in sorted(account_cache.stats().items()):
+        lines.append('# TYPE bank_accounts_account_cache_%s_total counter' % name)
+        lines.append('bank_accounts_account_cache_%s_total %d' % (name, value))
+    lines.extend(instrumentation.render_metrics())
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
+
+
+@login_required  # No query budget: queries grow with the size of the batch
+def batch_transfer_view(request):
+    """
+    Performs a batch of internal transfers and payments submitted as JSON, or as CSV with Content-Type text/csv.
+    See bank_accounts.batch for the format.
+    :param request:
+    :return: JSON with the result of each transfer
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        body = request.body.decode('utf-8')
+        if request.content_type == 'text/csv':
+            items = batch.parse_csv(body)
+        else:
+            items = batch.parse_json(json.loads(body))
+        results = batch.run_batch(request.user, items)
+    except (ValueError, csv.Error, batch.InvalidBatch) as error:  # Includes malformed JSON and bad encodings
+        return JsonResponse({'error': str(error)}, status=400)
+    except ConcurrentUpdate:
+        return JsonResponse({'error': 'Accounts are busy. Please try again.'}, status=409)
+
+    succeeded = sum(1 for result in results if result['ok'])
+    return JsonResponse({'succeeded': succeeded, 'failed': len(results) - succeeded, 'results': results})
+
+
+@login_required
+@query_budget(6)
+def recurring_transfer_view(request):
+    """
+    Lists the User's standing orders, and sets up new ones.
+    :param request:
+    :return:
+    """
+    if request.method == 'POST':  # User sets up a standing order
+        form = RecurringTransferForm(request.POST)
+        if not form.is_valid():
+            messages.add_message(request, messages.ERROR, 'Invalid form.')
+            return redirect(reverse('bank_accounts:recurring_transfers'))
+
+        payee = None
+        if form.cleaned_data['kind'] == RecurringTransfer.EXTERNAL_TRANSFER:
+            payee = payees.payee_pk(form.cleaned_data['payee_username'])
+            if payee is None:
+                messages.add_message(request, messages.ERROR, batch.ERROR_MESSAGES[InvalidPayee])
+                return redirect(reverse('bank_accounts:recurring_transfers'))
+
+        try:
+            recurring.create(user=request.user,
+                             kind=form.cleaned_data['kind'],
+                             from_account_pk=form.cleaned_data['from_account'],
+                             amount=form.cleaned_data['amount'],
+                             frequency=form.cleaned_data['frequency'],
+                             first_run=form.cleaned_data['first_run'],
+                             to_account_pk=form.cleaned_data['to_account'],
+                             payee_pk=payee,
+                             comment=form.cleaned_data['comment'])
+        except TransferError as error:
+            messages.add_message(request, messages.ERROR, batch.ERROR_MESSAGES[type(error)])
+            return redirect(reverse('bank_accounts:recurring_transfers'))
+
+        messages.add_message(request, messages.SUCCESS, 'Standing order set up.')
+        return redirect(reverse('bank_accounts:recurring_transfers'))
+
+    standing_orders = RecurringTransfer.objects.filter(user=request.user, next_run_at__isnull=False)\
+        .select_related('from_account', 'to_account', 'payee').order_by('next_run_at')
+    return render(request, 'bank_accounts/recurring_transfers.html',
+                  {'standing_orders': standing_orders,
+                   'accounts': account_cache.holder_accounts(request.user),
+                   'kinds': RecurringTransfer.KIND_CHOICES,
+                   'frequencies': RecurringTransfer.FREQUENCY_CHOICES})
+
+
+@login_required
+@query_budget(3)
+def recurring_transfer_cancel_view(request, pk):
+    """
+    Cancels one of the User's standing orders.
+    :param request:
+    :param pk: RecurringTransfer primary key
+    :return:
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if recurring.cancel(request.user, pk):
+        messages.add_message(request, messages.SUCCESS, 'Standing order cancelled.')
+    else:
+        messages.add_message(request, messages.ERROR, 'Standing order not found.')
+    return redirect(reverse('bank_accounts:recurring_transfers'))
+
+
+@login_required
+@query_budget(5)
+def receiving_account_view(request):
+    """
+    Shows which of the User's Checking Accounts receives payments, and lets the User choose another.
+    :param request:
+    :return:
+    """
+    if request.method == 'POST':
+        form = ReceivingAccountForm(request.POST)
+        if not form.is_valid():
+            messages.add_message(request, messages.ERROR, 'Invalid form.')
+            return redirect(reverse('bank_accounts:receiving_account'))
+        try:
+            receiving.choose(request.user, form.cleaned_data['account'])
+        except NotCheckingAccount:
+            messages.add_message(request, messages.ERROR, 'Payments can only be received in a checking account.')
+            return redirect(reverse('bank_accounts:receiving_account'))
+        except InvalidAccount:
+            messages.add_message(request, messages.ERROR, batch.ERROR_MESSAGES[InvalidAccount])
+            return redirect(reverse('bank_accounts:receiving_account'))
+        messages.add_message(request, messages.SUCCESS, 'Payments will be received in the chosen account.')
+        return redirect(reverse('bank_accounts:receiving_account'))
+
+    try:
+        receiving_account_pk, _ = receiving.receiving_account(request.user.pk)
+    except TransferError:  # No Checking Account
+        receiving_account_pk = None
+    accounts = [account for account in account_cache.holder_accounts(request.user)
+                if account.account_type == Account.CHECKING]
+    return render(request, 'bank_accounts/receiving_account.html',
+                  {'accounts': accounts, 'receiving_account_pk': receiving_account_pk})
+
+
+@login_required
+@query_budget(3)
+def queued_transfer_view(request, pk):
+    """
+    Shows the progress of a payment the User queued, as JSON when asked for (see wants_json).
+    :param request:
+    :param pk: QueuedTransfer primary key
+    :return:
+    """
+    try:
+        queued = QueuedTransfer.objects.select_related('payee').get(pk=pk, user=request.user)
+    except QueuedTransfer.DoesNotExist:
+        raise Http404()
+
+    if wants_json(request):
+        return JsonResponse(transfer_queue.status(queued))
+    return render(request, 'bank_accounts/queued_transfer.html', {'queued': queued})
+
 
+@login_required
+@read_only
+@query_budget(3)
+def spending_view(request):
+    """
+    Shows the payments the User sent and received per month, as JSON when asked for. Reads only the daily rollups, so
+    it costs the same however long the User's history is.
+    GET parameters: months (default 12).
+    :param request:
+    :return:
+    """
+    try:
+        months = max(int(request.GET.get('months', 12)), 1)
+    except ValueError:
+        return JsonResponse({'error': 'months must be a number.'}, status=400)
+
+    months = rollups.spending(request.user, months)
+    if wants_json(request):
+        return JsonResponse({'months': months})
+    return render(request, 'bank_accounts/spending.html', {'months': months})
+
+
+@login_required
+@read_only
+@query_budget(3)
+def top_payees_view(request):
+    """
+    Shows the Users the User has paid most, as JSON when asked for. Reads only the payee rollups.
+    GET parameters: limit (default 10).
+    :param request:
+    :return:
+    """
+    try:
+        limit = max(int(request.GET.get('limit', 10)), 1)
+    except ValueError:
+        return JsonResponse({'error': 'limit must be a number.'}, status=400)
+
+    top = rollups.top_payees(request.user, limit)
+    if wants_json(request):
+        return JsonResponse({'payees': top})
+    return render(request, 'bank_accounts/top_payees.html', {'payees': top})
+
+
+@api_view('GET')
+@read_only
+@query_budget(3)
+def api_accounts_view(request):
+    """
+    Lists the User's Accounts as JSON. See bank_accounts.api.
+    :param request:
+    :return:
+    """
+    return api.accounts(request)
 
-# TODO: Learn Django Concurrency
 
+@api_view('GET')
+@read_only
+@query_budget(3)
+def api_account_view(request, pk):
+    """
+    Shows one of the User's Accounts as JSON. See bank_accounts.api.
+    :param request:
+    :param pk:
+    :return:
+    """
+    return api.account(request, pk)
 
 
+@api_view('GET', 'POST')
+@read_only  # GET only, see bank_accounts.routers
+@query_budget(12)
+def api_internal_transfers_view(request):
+    """
+    Pages through the User's internal transfers, or makes one, as JSON. See bank_accounts.api.
+    :param request:
+    :return:
+    """
+    if request.method == 'POST':
+        return api.make_internal_transfer(request)
+    return api.internal_transfers(request)
+
+
+@api_view('GET', 'POST')
+@read_only  # GET only, see bank_accounts.routers
+@query_budget(15)
+def api_payments_view(request):
+    """
+    Pages through the payments the User sent and received, or makes one, as JSON. See bank_accounts.api.
+    :param request:
+    :return:
+    """
+    if request.method == 'POST':
+        return api.make_payment(request)
+    return api.payments(request)
+
+
+def wants_json(request):
+    """
+    :param request:
+    :return: True if a request asks for JSON, with its Accept header or "format=json"
+    """
+    return request.GET.get('format') == 'json' or 'application/json' in request.META.get('HTTP_ACCEPT', '')
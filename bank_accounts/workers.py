@@ -0,0 +1,112 @@
+# Worker claims
+# Lets several worker processes take rows from a table of jobs (e.g. due RecurringTransfers) in parallel, without two
+# workers ever taking the same row. A worker claims a batch of rows by writing its id and a lease expiry into their
+# claimed_by and claimed_until fields. Rows whose lease has lapsed, because their worker died, can be claimed again.
+
+# Workers run in a loop (run_worker), in as many processes as wanted (run_processes), and need no broker: the database
+# is the queue.
+
+# On databases that support SELECT ... FOR UPDATE SKIP LOCKED (PostgreSQL, MySQL 8, Oracle) candidate rows are locked
+# as they are selected, and rows locked by other workers are skipped rather than waited on. Elsewhere (SQLite) the
+# candidates are selected without locks and claimed with one conditional UPDATE that checks again that they are still
+# unclaimed. Rows another worker claimed in between are not updated, and are left out of the batch.
+
+import datetime
+import multiprocessing
+import time
+import uuid
+
+from django.db import connections, transaction, OperationalError
+from django.db.models import Q
+from django.utils import timezone
+
+DEFAULT_LEASE = datetime.timedelta(minutes=5)
+
+
+class LostClaim(Exception):
+    pass  # The claim on a row lapsed and another worker may have taken it
+
+
+def new_worker_id():
+    """
+    :return: a unique id for a worker, to claim rows with
+    """
+    return uuid.uuid4().hex
+
+
+def claim(queryset, worker, batch_size, order_by, lease=DEFAULT_LEASE):
+    """
+    Claims up to batch_size unclaimed rows of a queryset for a worker.
+    :param queryset: rows ready to be worked on, of a model with claimed_by and claimed_until fields
+    :param worker: id of the worker, see new_worker_id
+    :param batch_size:
+    :param order_by: fields to claim rows in order of, e.g. the time they are due
+    :param lease: how long the claim lasts before other workers may take the rows
+    :return: list of primary keys of the claimed rows
+    """
+    now = timezone.now()
+    unclaimed = queryset.filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+    claimed = {'claimed_by': worker, 'claimed_until': now + lease}
+
+    if connections[queryset.db].features.has_select_for_update_skip_locked:
+        with transaction.atomic(using=queryset.db):
+            pks = list(unclaimed.select_for_update(skip_locked=True).order_by(*order_by)
+                       .values_list('pk', flat=True)[:batch_size])
+            queryset.model._default_manager.using(queryset.db).filter(pk__in=pks).update(**claimed)
+        return pks
+
+    pks = list(unclaimed.order_by(*order_by).values_list('pk', flat=True)[:batch_size])
+    if not pks:
+        return []
+    unclaimed.filter(pk__in=pks).update(**claimed)
+    taken = set(queryset.model._default_manager.using(queryset.db).filter(pk__in=pks, claimed_by=worker)
+                .values_list('pk', flat=True))
+    return [pk for pk in pks if pk in taken]
+
+
+def release(queryset, worker):
+    """
+    Gives up a worker's claims on rows, e.g. rows it claimed but didn't get to.
+    :param queryset: rows of a model with claimed_by and claimed_until fields
+    :param worker: id of the worker
+    :return: number of rows released
+    """
+    return queryset.filter(claimed_by=worker).update(claimed_by=None, claimed_until=None)
+
+
+def run_worker(batch, poll=10, once=False):
+    """
+    Runs a worker: handles batch after batch, waiting poll seconds whenever there is nothing to do.
+    :param batch: function claiming and handling one batch, returning a tuple of counts (e.g. succeeded, failed),
+    all 0 when there was nothing to do
+    :param poll: seconds to wait when there is nothing to do
+    :param once: return as soon as there is nothing to do, instead of waiting
+    :return: tuple of the counts summed over every batch
+    """
+    totals = None
+    while True:
+        try:
+            counts = batch()
+        except OperationalError:  # Database busy, e.g. SQLite locked by another worker
+            time.sleep(0.01)
+            continue
+        totals = counts if totals is None else tuple(total + count for total, count in zip(totals, counts))
+        if not any(counts):
+            if once:
+                return totals
+            time.sleep(poll)
+
+
+def run_processes(processes, function, *args):
+    """
+    Calls a function in several processes at once, each with its own database connections.
+    :param processes: number of processes. With 1, the function runs in this process.
+    :param function: module-level function
+    :param args: arguments of every call
+    :return: list of the results of each process
+    """
+    if processes == 1:
+        return [function(*args)]
+    connections.close_all()  # Connections can't be shared with the new processes
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        return pool.starmap(function, [args] * processes)
@@ -0,0 +1,18 @@
+"""
+ASGI config for mysite3 project.
+
+It exposes the ASGI callable as a module-level variable named ``application``. Serve it with an ASGI server, e.g.
+``gunicorn mysite3.asgi -k uvicorn.workers.UvicornWorker``. Async views then run on each worker's event loop, and event
+streams wait there without holding a thread. Compare it with WSGI using the bench_asgi command.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/stable/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite3.settings')
+
+application = get_asgi_application()
@@ -44,6 +44,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Measures queries and latency per view. First, so the queries of the other middleware are counted too.
+    'bank_accounts.instrumentation.InstrumentationMiddleware',
+
     'django.middleware.security.SecurityMiddleware',
 
     # Default storage backend relies on sessions. Thus this middleware must appear before MessageMiddleWare
@@ -52,6 +55,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Routes queries to the User's shard and read-only views to replicas. Needs the User, so after authentication.
+    'bank_accounts.routers.RoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -60,7 +65,8 @@ ROOT_URLCONF = 'mysite3.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's template engine, timing how long templates take to render (see bank_accounts.instrumentation)
+        'BACKEND': 'bank_accounts.instrumentation.InstrumentedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates'),
                  os.path.join(BASE_DIR, 'bank_accounts/templates')]
         ,
@@ -86,9 +92,76 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    },
+}
+
+DATABASE_ROUTERS = ['bank_accounts.routers.BankRouter']
+
+# Shards and read replicas (see bank_accounts.routers) are off unless named in the environment, e.g.
+# BANK_ACCOUNTS_SHARDS=default,shard_1 and BANK_ACCOUNTS_REPLICAS=replica (replicas of 'default'). Each alias other
+# than 'default' gets a local SQLite file, db_<alias>.sqlite3, standing in for a separate server. Something outside
+# Django must keep a replica a copy of db.sqlite3. The mysite3.settings_test profile adds those the routing tests use.
+_SHARDS = [alias for alias in os.environ.get('BANK_ACCOUNTS_SHARDS', '').split(',') if alias]
+_REPLICAS = [alias for alias in os.environ.get('BANK_ACCOUNTS_REPLICAS', '').split(',') if alias]
+for _alias in _SHARDS + _REPLICAS:
+    DATABASES.setdefault(_alias, {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db_%s.sqlite3' % _alias),
+    })
+
+# Aliases of read replicas by alias of their primary, e.g. {'default': ['replica']}. Read-only views read from them.
+BANK_ACCOUNTS_REPLICAS = {'default': _REPLICAS} if _REPLICAS else {}
+
+# Seconds a client reads from the primary after writing, longer than replicas lag behind
+BANK_ACCOUNTS_REPLICA_LAG = 5
+
+# Pragmas set on every new SQLite connection, e.g. bank_accounts.sqlite_tuning.TUNED as in the mysite3.settings_sqlite
+# profile. Empty leaves SQLite's defaults.
+BANK_ACCOUNTS_SQLITE_PRAGMAS = {}
+
+# Aliases of the databases Accounts are sharded over by holder, e.g. ['default', 'shard_1']. Empty to not shard.
+# Run migrate with --database for each shard. Primary keys are allocated by each shard's database, so rows on
+# different shards may share a pk: a row is identified by its shard and pk together.
+BANK_ACCOUNTS_SHARDS = _SHARDS
+
+# Days receipts stay in the receipt tables before the archive_receipts command moves them to the archive tables. Don't
+# raise it once receipts have been archived. See bank_accounts.archive.
+BANK_ACCOUNTS_ARCHIVE_AFTER = 365
+
+# Seconds between the reads of the ledger that wake event streams on writes made by other processes. None to only
+# notice this process's writes, e.g. when running a single process. See bank_accounts.events.
+BANK_ACCOUNTS_EVENTS_POLL_INTERVAL = 1.0
+
+# Limits on how much and how often Users pay others, per User or per Account paid from, over rolling windows in seconds,
+# e.g. [{'per': 'user', 'window': 86400, 'max_amount': 10000, 'max_count': 50},
+# {'per': 'account', 'window': 600, 'max_count': 10}]. Empty for no limits. See bank_accounts.velocity.
+BANK_ACCOUNTS_VELOCITY_RULES = []
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+# Local memory is per process. Point BANK_ACCOUNTS_CACHE at a shared backend (e.g. Memcached) to share cached Accounts
+# between processes.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
+BANK_ACCOUNTS_CACHE = 'default'
+
+# Requests issuing more queries than their view's query budget raise an error instead of only being logged.
+# Tests always enforce budgets.
+BANK_ACCOUNTS_ENFORCE_QUERY_BUDGETS = False
+
+# Addresses allowed to read /metrics without logging in, e.g. that of the Prometheus server. Staff Users may always.
+BANK_ACCOUNTS_METRICS_ALLOWED_IPS = []
+
+# How Account read-modify-writes are protected from concurrent writes: 'optimistic' (version checks, retried on
+# conflict) or 'pessimistic' (row locks). See bank_accounts.versioning.
+BANK_ACCOUNTS_LOCKING = 'optimistic'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
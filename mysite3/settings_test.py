@@ -0,0 +1,16 @@
+"""
+Test profile: python manage.py test --settings=mysite3.settings_test
+
+Everything in mysite3.settings, plus the extra databases the routing tests (bank_accounts.tests.ReplicaTests and
+ShardingTests) read from and write to: a replica and a second shard. Run with other settings, those tests are skipped.
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+
+for _alias in ('replica', 'shard_1'):
+    DATABASES.setdefault(_alias, {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db_%s.sqlite3' % _alias),
+    })